@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from django.db.models import Count, Max, When, Case
 
-from core.models import ExtendedUser as User
+from core.models import ExtendedUser as User, UserDisplayName
 from .models import Achievement, Category, Claimant
 
 from enum import Enum
@@ -44,10 +44,12 @@ class AchievementSerializer(serializers.ModelSerializer):
     def get_all_claimants(self, obj):
         show_claimants = self.context.get("obtain_claimants")
         if show_claimants:
-            return ClaimantSerializer(
-                Claimant.objects.filter(achievement__id=obj.id)
-                    .order_by(get_claimant_sort(obj), '-date_unlocked'),
-                many=True).data
+            claimants = list(Claimant.objects.filter(achievement__id=obj.id)
+                .order_by(get_claimant_sort(obj), '-date_unlocked'))
+            return ClaimantSerializer(claimants, many=True, context={
+                # Resolve the names of all claimants at once
+                'display_names': UserDisplayName.get_for_users(claimant.user_id for claimant in claimants),
+            }).data
         
         user_id = self.context.get("user_id")
         if user_id:
@@ -68,11 +70,15 @@ class ClaimantSerializer(serializers.ModelSerializer):
         fields = ('name', 'date_unlocked', 'extra_data_1', 'extra_data_2', 'extra_data_3', 'user_id')
         depth = 0
     
+    # Uses the display names that were resolved in bulk, if any
     def get_user_display_name(self, obj):
+        display_names = self.context.get('display_names', {})
+        if obj.user_id in display_names:
+            return display_names[obj.user_id]
         return obj.user.get_display_name()
     
     def get_current_user_id(self, obj):
-        return obj.user.id
+        return obj.user_id
 
 
 # Dictionary representation of a Category
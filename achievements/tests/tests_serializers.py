@@ -47,6 +47,22 @@ class AchievementModelSerializersTest(TestCase):
             'claimant_count':           2,
         })
 
+    # Tests if the names of all claimants are resolved at once
+    def test_serializer_achievement_claimants_all_queries(self):
+        serializer = AchievementSerializer(self.achievement, context={
+            'obtain_claimants': True,
+        })
+        # Stores the display names
+        serializer.data
+
+        serializer = AchievementSerializer(self.achievement, context={
+            'obtain_claimants': True,
+        })
+        # Claimants, their display names, and the number of claimants
+        with self.assertNumQueries(3):
+            claimants = serializer.data['claimants']
+        self.assertEqual([claimant['name'] for claimant in claimants], ["test_user", "test_admin"])
+
     # Tests Achievement Seralizer when obtaining just a single user's data
     def test_serializer_achievement_claimants_user(self):
         serializer = AchievementSerializer(self.achievement, context={
@@ -0,0 +1 @@
+default_app_config = 'activity_calendar.apps.ActivityCalendarConfig'
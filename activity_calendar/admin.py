@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import Activity, ActivitySlot, Participant
+from .models import Activity, ActivitySlot, Participant, RegistrationTicket, CalendarToken
+from .slots import create_auto_slots
 
 
 
@@ -8,9 +10,15 @@ class ActivityAdmin(admin.ModelAdmin):
         return obj.is_recurring        
     is_recurring.boolean = True
 
+    def create_upcoming_slots(self, request, queryset):
+        num_slots = create_auto_slots(queryset, settings.ACTIVITY_AUTO_SLOTS_OCCURRENCES)
+        self.message_user(request, f"Created {num_slots} slot(s) for the upcoming occurrences of the selected activities")
+    create_upcoming_slots.short_description = 'Create slots for upcoming occurrences'
+
     list_display = ('id', 'title', 'start_date', 'is_recurring', 'subscriptions_required', )
     list_filter = ['subscriptions_required']
     list_display_links = ('id', 'title')
+    actions = ['create_upcoming_slots']
 
 admin.site.register(Activity, ActivityAdmin)
 
@@ -18,6 +26,10 @@ class ParticipantInline(admin.TabularInline):
     model = Participant
     extra = 0
 
+    # Participants are displayed by their users' names
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
+
 
 class ActivitySlotAdmin(admin.ModelAdmin):
     def recurrence_id_with_day(self, obj):
@@ -34,3 +46,20 @@ class ActivitySlotAdmin(admin.ModelAdmin):
     inlines = [ParticipantInline]
 
 admin.site.register(ActivitySlot, ActivitySlotAdmin)
+
+
+class RegistrationTicketAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'slot', 'status', 'created_date', 'processed_date')
+    list_filter = ['status']
+    list_display_links = ('id',)
+    readonly_fields = ('created_date',)
+
+admin.site.register(RegistrationTicket, RegistrationTicketAdmin)
+
+
+class CalendarTokenAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'created_date')
+    list_display_links = ('id', 'user')
+    readonly_fields = ('created_date',)
+
+admin.site.register(CalendarToken, CalendarTokenAdmin)
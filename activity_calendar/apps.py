@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ActivityCalendarConfig(AppConfig):
     name = 'activity_calendar'
+
+    def ready(self):
+        # Register signal handlers
+        from . import auto_model_update
@@ -0,0 +1,155 @@
+# Allows methods to fire automatically if a DB-model is updated
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .counters import add_slot_participants, rebuild_occurrence_statistics, recount_slot_participants
+from .models import Activity, ActivitySlot, Participant
+from .occurrences import normalize_exdates
+from .util import bump_calendar_version, bump_activity_version, bump_occurrence_version, bump_user_registrations_version
+
+##################################################################################
+# Methods that automatically keep derived activity data up to date
+# @since 18 OCT 2020
+##################################################################################
+
+# Fires when an activity is about to be created or updated
+@receiver(pre_save, sender=Activity)
+def pre_save_activity(sender, instance, raw, **kwargs):
+    # Keep the stored recurring-flag in sync with the recurrences
+    instance.recurring = instance.is_recurring
+    # Move EXDATEs to the start time of the occurrences they exclude
+    if instance.recurrences:
+        instance.recurrences.exdates = normalize_exdates(instance.recurrences.exdates, instance.start_date)
+
+# Fires when an activity gets created or updated
+@receiver(post_save, sender=Activity)
+def post_save_activity(sender, instance, raw, **kwargs):
+    # The recurrence rules or start/end dates may have changed; regenerate the stored occurrences
+    # NB: Stored occurrences are removed automatically (through a cascade) if the activity is deleted
+    instance.index_occurrences(timezone.now() + settings.ACTIVITY_OCCURRENCE_HORIZON, rebuild=True)
+
+# Fires when an activity gets created, updated or deleted
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+def invalidate_activity_cache(sender, **kwargs):
+    # Invalidate cached data derived from the activities (such as the iCalendar feed)
+    bump_activity_version()
+
+# Fires when a slot is about to be created or updated
+@receiver(pre_save, sender=ActivitySlot)
+def pre_save_slot(sender, instance, raw, **kwargs):
+    # Remember the occurrence the slot belonged to, as its statistics need to be updated if it is moved
+    instance._previous_occurrence = None
+    if instance.pk is not None:
+        instance._previous_occurrence = ActivitySlot.objects.filter(id=instance.pk) \
+            .values_list('parent_activity_id', 'recurrence_id').first()
+
+# Fires when a slot gets created or updated
+@receiver(post_save, sender=ActivitySlot)
+def post_save_slot(sender, instance, raw, created, **kwargs):
+    # Saving a slot may overwrite its participant counter with an outdated value
+    if not created:
+        recount_slot_participants(instance.id)
+
+    occurrence = (instance.parent_activity_id, instance.recurrence_id)
+    rebuild_occurrence_statistics(*occurrence)
+    bump_occurrence_version(*occurrence)
+    previous_occurrence = getattr(instance, '_previous_occurrence', None)
+    if previous_occurrence is not None and previous_occurrence != occurrence:
+        rebuild_occurrence_statistics(*previous_occurrence, create=False)
+        bump_occurrence_version(*previous_occurrence)
+        # The participants are now registered for another occurrence
+        for user_id in Participant.objects.filter(activity_slot__id=instance.id).values_list('user_id', flat=True):
+            bump_user_registrations_version(user_id)
+
+# Fires when a slot gets deleted
+@receiver(post_delete, sender=ActivitySlot)
+def post_delete_slot(sender, instance, **kwargs):
+    # NB: Statistics are not created here, as this may be part of a cascade that deletes the activity
+    rebuild_occurrence_statistics(instance.parent_activity_id, instance.recurrence_id, create=False)
+    bump_occurrence_version(instance.parent_activity_id, instance.recurrence_id)
+
+# Updates the participant counters of a slot, and notifies clients that are watching its occurrence
+# The counters are not updated if this was already done (e.g. when a place was reserved for the participant)
+def participants_changed(slot, amount, counters_updated=False):
+    if not counters_updated:
+        add_slot_participants(slot, amount)
+    bump_occurrence_version(slot.parent_activity_id, slot.recurrence_id)
+
+# Fires when a participant is about to be created or updated
+@receiver(pre_save, sender=Participant)
+def pre_save_participant(sender, instance, raw, **kwargs):
+    # Remember the slot (and user) the participant belonged to, as it may be moved to another slot
+    instance._previous_slot_id = None
+    instance._previous_user_id = None
+    if instance.pk is not None:
+        instance._previous_slot_id, instance._previous_user_id = Participant.objects.filter(id=instance.pk) \
+            .values_list('activity_slot_id', 'user_id').first() or (None, None)
+
+# Fires when a participant gets created or updated
+@receiver(post_save, sender=Participant)
+def post_save_participant(sender, instance, raw, created, **kwargs):
+    previous_slot_id = getattr(instance, '_previous_slot_id', None)
+    if created or previous_slot_id is None:
+        participants_changed(instance.activity_slot, 1, counters_updated=getattr(instance, '_counters_updated', False))
+    elif previous_slot_id != instance.activity_slot_id:
+        previous_slot = ActivitySlot.objects.filter(id=previous_slot_id).first()
+        if previous_slot is not None:
+            participants_changed(previous_slot, -1)
+        participants_changed(instance.activity_slot, 1)
+
+# Fires when a participant gets deleted (also when it's removed through slot.participants)
+@receiver(post_delete, sender=Participant)
+def post_delete_participant(sender, instance, **kwargs):
+    slot = ActivitySlot.objects.filter(id=instance.activity_slot_id).first()
+    if slot is not None:
+        participants_changed(slot, -1)
+
+# Fires when participants are added through slot.participants (or user.participant_info)
+@receiver(m2m_changed, sender=ActivitySlot.participants.through)
+def participants_added(sender, instance, action, reverse, pk_set, **kwargs):
+    # NB: Removing participants deletes Participant-instances, which are handled above
+    if action != 'post_add' or not pk_set:
+        return
+
+    if not reverse:
+        participants_changed(instance, len(pk_set))
+    else:
+        for slot in ActivitySlot.objects.filter(id__in=pk_set):
+            participants_changed(slot, 1)
+
+# Fires when the registrations of a user change
+@receiver(post_save, sender=Participant)
+@receiver(post_delete, sender=Participant)
+@receiver(m2m_changed, sender=ActivitySlot.participants.through)
+def invalidate_user_registrations_cache(sender, instance, **kwargs):
+    # NB: Removing participants deletes Participant-instances, which are handled separately
+    action = kwargs.get('action', None)
+    if action is None:
+        user_ids = {instance.user_id, getattr(instance, '_previous_user_id', None)} - {None}
+    elif action == 'post_add':
+        user_ids = [instance.id] if kwargs['reverse'] else kwargs['pk_set']
+    else:
+        return
+
+    # Invalidate cached data derived from the user's registrations (such as their calendar feed)
+    for user_id in user_ids:
+        bump_user_registrations_version(user_id)
+
+# Fires when calendar data gets created, updated or deleted
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+@receiver(post_save, sender=ActivitySlot)
+@receiver(post_delete, sender=ActivitySlot)
+@receiver(post_save, sender=Participant)
+@receiver(post_delete, sender=Participant)
+@receiver(m2m_changed, sender=ActivitySlot.participants.through)
+def invalidate_calendar_cache(sender, **kwargs):
+    # Only invalidate once the participants of a slot have actually changed
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        return
+
+    # Invalidate cached data derived from the calendar (such as the FullCalendar feed)
+    bump_calendar_version()
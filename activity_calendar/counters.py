@@ -0,0 +1,112 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, IntegerField, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import ActivityOccurrenceStatistics, ActivitySlot, Participant
+
+##################################################################################
+# Maintains the denormalized slot and participant counters of activity occurrences
+# @since 18 OCT 2020
+#
+# The counters are kept up to date by the signals in auto_model_update. Queryset
+# methods that bypass these signals (such as update() and bulk_create() on slots
+# or participants) leave them outdated; rebuild the affected statistics
+# afterwards (or all of them through the rebuild_occurrence_statistics command).
+##################################################################################
+
+# Aggregates that compute the statistics of slots (of the same occurrence)
+# The participants are counted using the slots' own participant counters
+SLOT_STATISTICS_AGGREGATES = {
+    'num_slots':            Count('id'),
+    'min_max_participants': Min('max_participants'),
+    'sum_max_participants': Sum('max_participants'),
+    'sum_num_participants': Sum('num_participants'),
+}
+
+# Converts the result of SLOT_STATISTICS_AGGREGATES to the fields of ActivityOccurrenceStatistics
+def get_slot_statistics(info):
+    return {
+        'num_slots': info['num_slots'],
+        # At least one slot allows for infinite participants
+        'num_max_slot_participants': -1 if info['min_max_participants'] == -1 else (info['sum_max_participants'] or 0),
+        'num_participants': info['sum_num_participants'] or 0,
+    }
+
+# Adds the given amount (which may be negative) to the participant counters of a slot and its occurrence
+def add_slot_participants(slot, amount):
+    ActivitySlot.objects.filter(id=slot.id).update(num_participants=F('num_participants') + amount)
+    ActivityOccurrenceStatistics.objects.filter(activity__id=slot.parent_activity_id, recurrence_id=slot.recurrence_id) \
+        .update(num_participants=F('num_participants') + amount)
+
+# Increments the participant counter of a slot, unless the slot is full
+# The limit is checked by the update itself, so concurrent reservations cannot exceed it (even without row locks)
+# Returns whether the counter was incremented
+def reserve_slot_participant(slot):
+    return bool(ActivitySlot.objects.filter(id=slot.id) \
+        .filter(Q(max_participants=-1) | Q(num_participants__lt=F('max_participants'))) \
+        .update(num_participants=F('num_participants') + 1))
+
+# Increments the participant counter of a slot's occurrence, unless it already has max_participants (-1 if unlimited)
+# The limit is checked by the update itself, so concurrent reservations cannot exceed it (even without row locks)
+# Returns whether the counter was incremented
+def reserve_occurrence_participant(slot, max_participants):
+    statistics = ActivityOccurrenceStatistics.objects.filter(activity__id=slot.parent_activity_id,
+        recurrence_id=slot.recurrence_id)
+    if max_participants != -1:
+        statistics = statistics.filter(num_participants__lt=max_participants)
+    return bool(statistics.update(num_participants=F('num_participants') + 1))
+
+# Locks the statistics of a slot's occurrence until the end of the current transaction, through an update that
+# does not change them. This serializes registrations for the same occurrence (without SELECT ... FOR UPDATE).
+# Returns whether the statistics exist
+def lock_occurrence_statistics(slot):
+    return bool(ActivityOccurrenceStatistics.objects.filter(activity__id=slot.parent_activity_id,
+        recurrence_id=slot.recurrence_id).update(num_participants=F('num_participants')))
+
+# Recounts the participants of a single slot
+def recount_slot_participants(slot_id):
+    ActivitySlot.objects.filter(id=slot_id).update(
+        num_participants=Participant.objects.filter(activity_slot__id=slot_id).count())
+
+# Recomputes the statistics of a single occurrence from its slots. The statistics are computed by the
+# update itself (rather than read first and saved afterwards), so that concurrent changes to the
+# participant counters are not lost.
+# If create is False, missing statistics are not created (e.g. while the activity is being deleted)
+def rebuild_occurrence_statistics(activity_id, recurrence_id, create=True):
+    lookup = {'activity__id': activity_id, 'recurrence_id': recurrence_id}
+    if create and not ActivityOccurrenceStatistics.objects.filter(**lookup).exists():
+        try:
+            with transaction.atomic():
+                ActivityOccurrenceStatistics.objects.create(activity_id=activity_id, recurrence_id=recurrence_id)
+        except IntegrityError:
+            # Created concurrently
+            pass
+
+    slots = ActivitySlot.objects.filter(parent_activity__id=activity_id, recurrence_id=recurrence_id).order_by() \
+        .values('parent_activity').annotate(**SLOT_STATISTICS_AGGREGATES)
+    get_statistic = lambda expression: Coalesce(Subquery(slots.annotate(value=expression).values('value')), 0)
+    ActivityOccurrenceStatistics.objects.filter(**lookup).update(
+        num_slots=get_statistic(F('num_slots')),
+        # At least one slot allows for infinite participants
+        num_max_slot_participants=get_statistic(Case(When(min_max_participants=-1, then=Value(-1)),
+            default=F('sum_max_participants'), output_field=IntegerField())),
+        num_participants=get_statistic(F('sum_num_participants')),
+    )
+    return ActivityOccurrenceStatistics.objects.filter(**lookup).first()
+
+# Recomputes all participant counters and occurrence statistics from scratch
+def rebuild_statistics():
+    with transaction.atomic():
+        num_participants = Participant.objects.filter(activity_slot=OuterRef('pk')).order_by() \
+            .values('activity_slot').annotate(count=Count('id')).values('count')
+        ActivitySlot.objects.update(num_participants=Coalesce(Subquery(num_participants), 0))
+
+        ActivityOccurrenceStatistics.objects.all().delete()
+        occurrences = ActivitySlot.objects.order_by().values('parent_activity_id', 'recurrence_id') \
+            .annotate(**SLOT_STATISTICS_AGGREGATES)
+        ActivityOccurrenceStatistics.objects.bulk_create([
+            ActivityOccurrenceStatistics(activity_id=info['parent_activity_id'], recurrence_id=info['recurrence_id'],
+                **get_slot_statistics(info))
+            for info in occurrences
+        ])
+    return len(occurrences)
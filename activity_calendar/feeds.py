@@ -1,17 +1,27 @@
-from datetime import datetime, timedelta
+from copy import copy
+from io import BytesIO
+import hashlib
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Min
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 
 import django_ical.feedgenerator
 
 from django_ical.utils import build_rrule_from_recurrences_rrule, build_rrule_from_text
 from django_ical.views import ICalFeed
 from django_ical.feedgenerator import ICal20Feed
+from icalendar import Calendar
 from icalendar.cal import Timezone, TimezoneStandard, TimezoneDaylight
 
-from .models import Activity
-from .util import generate_vtimezone
+from .models import Activity, CalendarToken, Participant
+from .util import get_vtimezone, get_calendar_validators, get_activity_version, get_user_registrations_version
 
 # Monkey-patch; Why is this not open for extension in the first place?
 django_ical.feedgenerator.ITEM_EVENT_FIELD_MAP = (
@@ -37,6 +47,42 @@ class ExtendedICal20Feed(ICal20Feed):
         super().write_items(calendar)
 
 
+class StreamingICal20Feed(ExtendedICal20Feed):
+    """
+    iCalendar 2.0 Feed implementation that serializes its header and each of its
+    items separately, so that the feed can be streamed one VEVENT at a time.
+    Concatenating these parts results in the same output as write().
+    """
+
+    # The line that closes the calendar
+    FOOTER = b"END:VCALENDAR\r\n"
+
+    def write_header(self):
+        """
+        Serializes the calendar (and its VTIMEZONE), but without any items
+        and without the line that closes the calendar.
+        """
+        items, self.items = self.items, []
+        outfile = BytesIO()
+        self.write(outfile, 'utf-8')
+        self.items = items
+
+        content = outfile.getvalue()
+        assert content.endswith(self.FOOTER)
+        return content[:-len(self.FOOTER)]
+
+    def write_item(self, item):
+        """
+        Serializes a single item as a VEVENT.
+        """
+        items, self.items = self.items, [item]
+        calendar = Calendar()
+        # NB: Skip ExtendedICal20Feed, as the VTIMEZONE is part of the header
+        super(ExtendedICal20Feed, self).write_items(calendar)
+        self.items = items
+        return calendar.subcomponents[0].to_ical()
+
+
 class CESTEventFeed(ICalFeed):
     """
     A simple event calender
@@ -48,6 +94,62 @@ class CESTEventFeed(ICalFeed):
     product_id = '-//Squire//Activity Calendar//EN'
     file_name = "knights-calendar.ics"
 
+    def __call__(self, request, *args, **kwargs):
+        feed = self.get_cached_feed(request, *args, **kwargs)
+
+        # Answer conditional requests without sending the feed
+        @condition(etag_func=lambda request, *args, **kwargs: feed['etag'],
+                last_modified_func=lambda request, *args, **kwargs: feed['last_modified'])
+        def view(request, *args, **kwargs):
+            response = HttpResponse(feed['content'], content_type=feed['content_type'])
+            if feed['content_disposition']:
+                response['Content-Disposition'] = feed['content_disposition']
+            return response
+
+        response = view(request, *args, **kwargs)
+        # Calendar clients must revalidate their copy on every poll
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    # Key under which the serialized feed is cached
+    # Changes whenever an activity changes
+    def get_cache_key(self, request, *args, **kwargs):
+        # Item URLs depend on the requested host
+        return f"activity_calendar:ical:{type(self).__module__}.{type(self).__qualname__}:" \
+            f"{get_activity_version()}:{request.build_absolute_uri('/')}"
+
+    # Obtains the serialized feed from the cache, or generates it if it is not cached (anymore)
+    def get_cached_feed(self, request, *args, **kwargs):
+        cache_key = self.get_cache_key(request, *args, **kwargs)
+        feed = cache.get(cache_key)
+
+        # Activities that get published after the feed was generated are not part of it yet
+        if feed is None or (feed['valid_until'] is not None and feed['valid_until'] <= timezone.now()):
+            feed = self.generate_feed(request, *args, **kwargs)
+            # Feeds of older versions are no longer requested, so they must expire eventually
+            cache.set(cache_key, feed, settings.ACTIVITY_CALENDAR_CACHE_TIMEOUT)
+        return feed
+
+    # Generates the serialized feed, along with the information needed to answer (conditional) requests
+    def generate_feed(self, request, *args, **kwargs):
+        now = timezone.now()
+        response = super().__call__(request, *args, **kwargs)
+
+        # Last-Modified set by Feed is based on the items' updated dates, which does not account
+        # for deleted or newly published activities
+        last_modified, _ = get_calendar_validators()
+
+        return {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'content_disposition': response.get('Content-Disposition'),
+            # The feed is deterministic, so its contents identify it
+            'etag': hashlib.sha1(response.content).hexdigest(),
+            'last_modified': last_modified,
+            'valid_until': Activity.objects.filter(published_date__gt=now) \
+                .aggregate(next_published=Min('published_date'))['next_published'],
+        }
+
     def title(self):
         # TODO: unhardcode
         return "Activiteiten Agenda - Knights"
@@ -65,16 +167,15 @@ class CESTEventFeed(ICalFeed):
     #######################################################
     # Timezone information (Daylight-saving time, etc.)    
     def vtimezone(self):
-        tz_info = generate_vtimezone(settings.TIME_ZONE, datetime(2020, 1, 1))
-        tz_info.add('x-lic-location', settings.TIME_ZONE)
-        return tz_info
+        return get_vtimezone(settings.TIME_ZONE, 2020)
 
     #######################################################
     # Activities
 
     def items(self):
         # Only consider published activities
-        return Activity.objects.filter(published_date__lte=timezone.now()).order_by('-published_date')
+        # NB: Ordered on id as well, so that the feed is deterministic
+        return Activity.objects.filter(published_date__lte=timezone.now()).order_by('-published_date', '-id')
 
     def item_guid(self, item):
         # ID should be _globally_ unique
@@ -104,8 +205,8 @@ class CESTEventFeed(ICalFeed):
         return item.last_updated_date
 
     def item_timestamp(self, item):
-        # When the item was generated, which is at this moment!
-        return timezone.now()
+        # When the item was last changed, so that the feed is identical if nothing changed
+        return item.last_updated_date
 
     def item_link(self, item):
         # There is no special page for the activity
@@ -145,18 +246,9 @@ class CESTEventFeed(ICalFeed):
     # Dates to exclude for recurrence rules
     def item_exdate(self, item):
         if item.recurrences:
-            # Each EXDATE's time needs to match the event start-time, but they default to midnigth in the widget!
-            # Since there's no possibility to select the time in the UI either, we're overriding it here
-            # and enforce each EXDATE's time to be equal to the event's start time
-            event_start_time = item.start_date.astimezone(timezone.get_current_timezone()).time()
-            item.recurrences.exdates = list(map(lambda dt:
-                    timezone.get_current_timezone().localize(
-                        datetime.combine(timezone.localtime(dt).date(),
-                        event_start_time)
-                    ),
-                    item.recurrences.exdates
-            ))
-            return item.recurrences.exdates
+            # EXDATEs are normalized to the event's start time when the activity is saved,
+            # but are exported in local time (like the event's start time)
+            return [timezone.localtime(exdate) for exdate in item.recurrences.exdates]
 
     # RECURRENCE-ID
     def item_recurrenceid(self, item):
@@ -178,3 +270,132 @@ class CESTEventFeed(ICalFeed):
         if val:
             kwargs['recurrenceid'] = val
         return kwargs
+
+
+class StreamingCESTEventFeed(CESTEventFeed):
+    """
+    The same calendar as CESTEventFeed, but streamed one activity at a time rather than
+    generated (and cached) as a whole. Hence, only a single activity is kept in memory.
+    """
+    feed_type = StreamingICal20Feed
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404("Feed object does not exist.")
+
+        @condition(last_modified_func=lambda request, *args, **kwargs: get_calendar_validators()[0])
+        def view(request, *args, **kwargs):
+            feedgen = self.get_feed(obj, request)
+            response = StreamingHttpResponse(self.generate_feed_chunks(feedgen, obj, request),
+                content_type=feedgen.mime_type)
+
+            filename = self._get_dynamic_attr('file_name', obj)
+            if filename:
+                response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+
+        response = view(request, *args, **kwargs)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    # Obtains the feed generator without any items; these are added by generate_feed_chunks
+    def get_feed(self, obj, request):
+        self_without_items = copy(self)
+        self_without_items.items = []
+        return super(StreamingCESTEventFeed, self_without_items).get_feed(obj, request)
+
+    # Generates the serialized feed, one VEVENT at a time
+    def generate_feed_chunks(self, feedgen, obj, request):
+        yield feedgen.write_header()
+
+        for item in self.items().iterator():
+            yield feedgen.write_item(self.get_feed_item(item, obj, request))
+
+        yield feedgen.FOOTER
+
+    # Obtains a single item of the feed generator, by letting Feed.get_feed build a feed of just that item.
+    # Hence, the item is built exactly like the items of the (non-streamed) CESTEventFeed
+    def get_feed_item(self, item, obj, request):
+        self_with_item = copy(self)
+        self_with_item.items = [item]
+        return super(StreamingCESTEventFeed, self_with_item).get_feed(obj, request).items[0]
+
+
+class UserRegistrationsFeed(CESTEventFeed):
+    """
+    The occurrences of activities that a user registered for. Calendar applications can
+    subscribe to it through a secret URL (see CalendarToken), without logging in.
+    Occurrences of recurring activities are included as instances (with a RECURRENCE-ID)
+    of the corresponding activity in the full calendar.
+    """
+    file_name = "knights-registrations.ics"
+
+    # Obtains the calendar token in the URL (only once per request)
+    def get_calendar_token(self, request, token):
+        if not hasattr(request, '_calendar_token'):
+            request._calendar_token = get_object_or_404(CalendarToken, token=token)
+        return request._calendar_token
+
+    def get_object(self, request, token):
+        return self.get_calendar_token(request, token).user_id
+
+    # Changes whenever an activity or the user's registrations change
+    def get_cache_key(self, request, token):
+        user_id = self.get_calendar_token(request, token).user_id
+        return f"{super().get_cache_key(request)}:{user_id}:{get_user_registrations_version(user_id)}"
+
+    def title(self):
+        # TODO: unhardcode
+        return "Mijn Activiteiten - Knights"
+
+    def description(self):
+        # TODO: unhardcode
+        return "Activiteiten waarvoor je bent ingeschreven bij Knights of the Kitchen Table."
+
+    #######################################################
+    # Registered occurrences
+
+    def items(self, user_id):
+        # The user's registrations (along with their slots and activities) are obtained in a single query
+        # NB: A user can be registered for multiple slots of the same occurrence
+        participants = Participant.objects.filter(user__id=user_id,
+                activity_slot__parent_activity__published_date__lte=timezone.now()) \
+            .select_related('activity_slot__parent_activity').order_by('id')
+
+        occurrences = {}
+        for participant in participants:
+            slot = participant.activity_slot
+            key = (slot.parent_activity_id, slot.recurrence_id)
+            if key not in occurrences:
+                occurrences[key] = self.get_occurrence(slot.parent_activity, slot.recurrence_id)
+
+        # NB: Ordered on id as well, so that the feed is deterministic
+        return sorted(occurrences.values(), key=lambda occurrence: (occurrence.start_date, occurrence.id))
+
+    # Obtains a copy of the activity that represents a single one of its occurrences
+    def get_occurrence(self, activity, recurrence_id):
+        occurrence = copy(activity)
+        occurrence.occurrence_recurrence_id = recurrence_id if activity.is_recurring else None
+        occurrence.start_date, occurrence.end_date = activity.get_occurrence_dates(occurrence.occurrence_recurrence_id)
+        return occurrence
+
+    # Instances do not repeat themselves
+    def item_rrule(self, item):
+        return None
+
+    def item_exrule(self, item):
+        return None
+
+    def item_rdate(self, item):
+        return None
+
+    def item_exdate(self, item):
+        return None
+
+    # RECURRENCE-ID; matches the (local) start time of the occurrence in the full calendar
+    def item_recurrenceid(self, item):
+        if item.occurrence_recurrence_id is not None:
+            return self.item_start_datetime(item)
+        return None
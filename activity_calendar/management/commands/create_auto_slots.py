@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from activity_calendar.models import Activity
+from activity_calendar.slots import create_auto_slots
+
+##################################################################################
+# Creates the slots of upcoming occurrences of activities that create their slots automatically,
+# so that this need not happen once the first user registers. Can safely be run repeatedly
+# (e.g. daily through a cronjob)
+# @since 18 OCT 2020
+##################################################################################
+
+class Command(BaseCommand):
+    help = "Creates slots for the upcoming occurrences of activities that create their slots automatically"
+
+    def add_arguments(self, parser):
+        parser.add_argument('activity_ids', nargs='*', type=int,
+            help="Ids of the activities to create slots for (defaults to all of them)")
+        parser.add_argument('--occurrences', type=int, default=settings.ACTIVITY_AUTO_SLOTS_OCCURRENCES,
+            help="Number of upcoming occurrences to create slots for")
+        parser.add_argument('--slots', type=int, default=1,
+            help="Number of slots to create per occurrence (limited by the maximum number of slots of the activity)")
+
+    def handle(self, *args, **options):
+        activities = Activity.objects.filter(slot_creation="CREATION_AUTO")
+        if options['activity_ids']:
+            activities = activities.filter(id__in=options['activity_ids'])
+
+        num_slots = create_auto_slots(activities, options['occurrences'], num_slots=options['slots'])
+        self.stdout.write(f"Created {num_slots} slots")
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from activity_calendar.models import Activity
+
+##################################################################################
+# Extends the stored occurrences of recurring activities to the rolling horizon.
+# Should be run periodically (e.g. daily through a cronjob)
+# @since 18 OCT 2020
+##################################################################################
+
+class Command(BaseCommand):
+    help = "Stores the occurrences of all recurring activities up until ACTIVITY_OCCURRENCE_HORIZON from now"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+            help="Discard all stored occurrences and regenerate them from scratch")
+
+    def handle(self, *args, **options):
+        until = timezone.now() + settings.ACTIVITY_OCCURRENCE_HORIZON
+        num_activities = 0
+
+        for activity in Activity.objects.filter(recurring=True):
+            activity.index_occurrences(until, rebuild=options['rebuild'])
+            num_activities += 1
+
+        self.stdout.write(f"Indexed occurrences of {num_activities} recurring activities until {until.isoformat()}")
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from activity_calendar.models import RegistrationTicket
+from activity_calendar.registration import process_registration_queue
+
+##################################################################################
+# Processes the queued registrations of activities that use an admission queue.
+# Should be kept running (e.g. as a service); only a single instance should run at a time
+# @since 18 OCT 2020
+##################################################################################
+
+class Command(BaseCommand):
+    help = "Processes queued registrations in the order they were made"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+            help="The maximum number of activities whose queues are processed concurrently (ignored on SQLite)")
+        parser.add_argument('--batch-size', type=int, default=50,
+            help="The maximum number of tickets that are processed per iteration")
+        parser.add_argument('--interval', type=float, default=1.0,
+            help="The number of seconds to wait if there are no queued tickets")
+        parser.add_argument('--once', action='store_true',
+            help="Process the currently queued tickets and stop")
+
+    def handle(self, *args, **options):
+        # Tickets that were being processed when a previous worker stopped
+        RegistrationTicket.objects.filter(status=RegistrationTicket.STATUS_PROCESSING) \
+            .update(status=RegistrationTicket.STATUS_QUEUED)
+
+        num_processed = 0
+        while True:
+            num_batch_processed = process_registration_queue(max_workers=options['workers'],
+                batch_size=options['batch_size'])
+            num_processed += num_batch_processed
+
+            if options['once'] and num_batch_processed < options['batch_size']:
+                break
+            if not num_batch_processed:
+                time.sleep(options['interval'])
+
+        self.stdout.write(f"Processed {num_processed} queued registrations")
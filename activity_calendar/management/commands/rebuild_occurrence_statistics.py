@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from activity_calendar.counters import rebuild_statistics
+
+##################################################################################
+# Recomputes the participant counters of slots and the statistics of activity occurrences.
+# These are kept up to date automatically, but e.g. queryset updates bypass this
+# @since 18 OCT 2020
+##################################################################################
+
+class Command(BaseCommand):
+    help = "Recomputes the participant counters of all slots and the statistics of all activity occurrences"
+
+    def handle(self, *args, **options):
+        num_occurrences = rebuild_statistics()
+        self.stdout.write(f"Rebuilt the statistics of {num_occurrences} activity occurrences")
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0002_auto_20200830_1534'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='occurrences_indexed_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='ActivityOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recurrence_id', models.DateTimeField()),
+                ('start_date', models.DateTimeField()),
+                ('end_date', models.DateTimeField()),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='activity_calendar.Activity')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='activityoccurrence',
+            index=models.Index(fields=['recurrence_id'], name='activity_ca_recurre_1c6975_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activityoccurrence',
+            unique_together={('activity', 'recurrence_id')},
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+def set_recurring(apps, schema_editor):
+    Activity = apps.get_model('activity_calendar', 'Activity')
+    for activity in Activity.objects.all():
+        recurrences = activity.recurrences
+        activity.recurring = bool(recurrences and (recurrences.rdates or recurrences.rrules))
+        activity.save(update_fields=['recurring'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0003_auto_20261018_2005'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='recurring',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(set_recurring, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['published_date', 'start_date', 'end_date'], name='activity_ca_publish_866c56_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['recurring', 'start_date', 'end_date'], name='activity_ca_recurri_fe3dd1_idx'),
+        ),
+    ]
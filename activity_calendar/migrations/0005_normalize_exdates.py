@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from django.db import migrations
+from django.utils import timezone
+
+
+# Moves each EXDATE to the (local) start time of its activity on that day
+def normalize_activity_exdates(apps, schema_editor):
+    Activity = apps.get_model('activity_calendar', 'Activity')
+    local_timezone = timezone.get_current_timezone()
+    for activity in Activity.objects.all():
+        recurrences = activity.recurrences
+        if recurrences and recurrences.exdates:
+            start_time = timezone.localtime(activity.start_date, local_timezone).time()
+            recurrences.exdates = [
+                timezone.make_aware(datetime.combine(timezone.localtime(exdate, local_timezone).date(), start_time),
+                    local_timezone, is_dst=False).astimezone(timezone.utc)
+                for exdate in recurrences.exdates
+            ]
+            activity.save(update_fields=['recurrences'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0004_auto_20261018_2012'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_activity_exdates, migrations.RunPython.noop),
+    ]
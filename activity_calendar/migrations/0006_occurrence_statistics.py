@@ -0,0 +1,69 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:24
+
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+# Computes the participant counters of all slots and the statistics of all occurrences
+def rebuild_counters(apps, schema_editor):
+    ActivitySlot = apps.get_model('activity_calendar', 'ActivitySlot')
+    Participant = apps.get_model('activity_calendar', 'Participant')
+    ActivityOccurrenceStatistics = apps.get_model('activity_calendar', 'ActivityOccurrenceStatistics')
+
+    num_participants = Participant.objects.filter(activity_slot=OuterRef('pk')).order_by() \
+        .values('activity_slot').annotate(count=Count('id')).values('count')
+    ActivitySlot.objects.update(num_participants=Coalesce(Subquery(num_participants), 0))
+
+    occurrences = ActivitySlot.objects.order_by().values('parent_activity_id', 'recurrence_id').annotate(
+        num_slots=Count('id'),
+        min_max_participants=Min('max_participants'),
+        sum_max_participants=Sum('max_participants'),
+        sum_num_participants=Sum('num_participants'))
+    ActivityOccurrenceStatistics.objects.bulk_create([
+        ActivityOccurrenceStatistics(activity_id=info['parent_activity_id'], recurrence_id=info['recurrence_id'],
+            num_slots=info['num_slots'],
+            # At least one slot allows for infinite participants
+            num_max_slot_participants=-1 if info['min_max_participants'] == -1 else (info['sum_max_participants'] or 0),
+            num_participants=info['sum_num_participants'] or 0)
+        for info in occurrences
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0005_normalize_exdates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activityslot',
+            name='num_participants',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ActivityOccurrenceStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recurrence_id', models.DateTimeField(blank=True, null=True)),
+                ('num_slots', models.PositiveIntegerField(default=0)),
+                ('num_max_slot_participants', models.IntegerField(default=0)),
+                ('num_participants', models.PositiveIntegerField(default=0)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrence_statistics', to='activity_calendar.Activity')),
+            ],
+            options={
+                'verbose_name_plural': 'activity occurrence statistics',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='activityoccurrencestatistics',
+            constraint=models.UniqueConstraint(condition=models.Q(recurrence_id=None), fields=('activity',), name='unique_non_recurring_statistics'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='activityoccurrencestatistics',
+            unique_together={('activity', 'recurrence_id')},
+        ),
+        migrations.RunPython(rebuild_counters, migrations.RunPython.noop),
+    ]
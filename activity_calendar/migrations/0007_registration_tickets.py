@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:26
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_presetimage'),
+        ('activity_calendar', '0006_occurrence_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='admission_queue',
+            field=models.BooleanField(default=False, help_text='Queue registrations that are made right after subscriptions open, and process them in order'),
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='admission_queue_duration',
+            field=models.DurationField(default=datetime.timedelta(seconds=900), help_text='How long registrations are queued after subscriptions open'),
+        ),
+        migrations.CreateModel(
+            name='RegistrationTicket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('PROCESSING', 'Processing'), ('ACCEPTED', 'Accepted'), ('REJECTED', 'Rejected')], default='QUEUED', max_length=15)),
+                ('message', models.CharField(blank=True, max_length=255)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('processed_date', models.DateTimeField(blank=True, null=True)),
+                ('slot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='registration_tickets', to='activity_calendar.ActivitySlot')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.ExtendedUser')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='registrationticket',
+            index=models.Index(fields=['status', 'id'], name='activity_ca_status_9bdac2_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:32
+
+from django.db import migrations, models
+
+
+def number_auto_slots(apps, schema_editor):
+    # Number the existing slots of activities that create slots automatically, in order of creation
+    ActivitySlot = apps.get_model('activity_calendar', 'ActivitySlot')
+    slot_numbers = {}
+    for slot in ActivitySlot.objects.filter(parent_activity__slot_creation='CREATION_AUTO').order_by('id'):
+        occurrence = (slot.parent_activity_id, slot.recurrence_id)
+        slot_numbers[occurrence] = slot_numbers.get(occurrence, 0) + 1
+        slot.slot_number = slot_numbers[occurrence]
+        slot.save(update_fields=['slot_number'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0007_registration_tickets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activityslot',
+            name='slot_number',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(number_auto_slots, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='activityslot',
+            unique_together={('parent_activity', 'recurrence_id', 'slot_number')},
+        ),
+        migrations.AddConstraint(
+            model_name='activityslot',
+            constraint=models.UniqueConstraint(condition=models.Q(recurrence_id=None), fields=('parent_activity', 'slot_number'), name='unique_non_recurring_slot_number'),
+        ),
+    ]
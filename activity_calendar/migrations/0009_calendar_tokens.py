@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:39
+
+import activity_calendar.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_presetimage'),
+        ('activity_calendar', '0008_auto_slot_numbers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(default=activity_calendar.models.generate_calendar_token, editable=False, max_length=64, unique=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='calendar_token', to='core.ExtendedUser')),
+            ],
+        ),
+    ]
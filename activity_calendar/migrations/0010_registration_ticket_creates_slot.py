@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity_calendar', '0009_calendar_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registrationticket',
+            name='creates_slot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='registrationticket',
+            name='slot',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='registration_tickets', to='activity_calendar.ActivitySlot'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:27
+
+from django.db import migrations
+from django.db.models import Count, F, Min
+
+
+def remove_duplicate_participants(apps, schema_editor):
+    # Users could join the same slot more than once through concurrent registrations; keep their first registration
+    Participant = apps.get_model('activity_calendar', 'Participant')
+    ActivitySlot = apps.get_model('activity_calendar', 'ActivitySlot')
+    ActivityOccurrenceStatistics = apps.get_model('activity_calendar', 'ActivityOccurrenceStatistics')
+    duplicates = Participant.objects.order_by().values('user', 'activity_slot') \
+        .annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        Participant.objects.filter(user__id=duplicate['user'], activity_slot__id=duplicate['activity_slot']) \
+            .exclude(id=duplicate['first_id']).delete()
+
+        # Keep the participant counters up to date
+        num_removed = duplicate['count'] - 1
+        slot = ActivitySlot.objects.get(id=duplicate['activity_slot'])
+        ActivitySlot.objects.filter(id=slot.id).update(num_participants=F('num_participants') - num_removed)
+        ActivityOccurrenceStatistics.objects.filter(activity__id=slot.parent_activity_id,
+            recurrence_id=slot.recurrence_id).update(num_participants=F('num_participants') - num_removed)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_userdisplayname'),
+        ('activity_calendar', '0010_registration_ticket_creates_slot'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_participants, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='participant',
+            unique_together={('user', 'activity_slot')},
+        ),
+    ]
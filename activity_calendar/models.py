@@ -1,13 +1,18 @@
+
+import secrets
+
 from django.conf import settings
 from django.core.validators import MinValueValidator, ValidationError
 from django.db import models
-from django.db.models import Count
 from django.utils import timezone
 
+from recurrence import Recurrence
 from recurrence.fields import RecurrenceField
 
 from core.models import ExtendedUser as User, PresetImage
 
+from .occurrences import compiled_recurrences, get_local_timezone, recurrences_between
+
 # Models related to the Calendar-functionality of the application.
 # @since 29 JUN 2019
 
@@ -23,6 +28,11 @@ def now_rounded():
 class Activity(models.Model):
     class Meta:
         verbose_name_plural = "activities"
+        indexes = [
+            # Used to find activities within a given timeframe
+            models.Index(fields=['published_date', 'start_date', 'end_date']),
+            models.Index(fields=['recurring', 'start_date', 'end_date']),
+        ]
 
     # The User that created the activity
     author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
@@ -48,6 +58,10 @@ class Activity(models.Model):
     # This means we do not need to store (nor create!) recurring activities separately
     recurrences = RecurrenceField(blank=True, default="")
 
+    # Whether the activity is recurring, as stored in the database (handled automatically)
+    # This allows querying for (non-)recurring activities without inspecting the recurrences
+    recurring = models.BooleanField(default=False, editable=False)
+
     # Maximum number of participants/slots
     # -1 denotes unlimited
     max_slots = models.IntegerField(default=1, validators=[MinValueValidator(-1)],
@@ -91,6 +105,17 @@ class Activity(models.Model):
     subscriptions_open = models.DurationField(default=timezone.timedelta(days=7))
     subscriptions_close = models.DurationField(default=timezone.timedelta(hours=2))
 
+    # Registrations made right after subscriptions open can be queued, so that they are processed
+    # in the order they were made (instead of by whoever happens to win the race)
+    admission_queue = models.BooleanField(default=False,
+        help_text="Queue registrations that are made right after subscriptions open, and process them in order")
+    admission_queue_duration = models.DurationField(default=timezone.timedelta(minutes=15),
+        help_text="How long registrations are queued after subscriptions open")
+
+    # Up until which date the occurrences of this (recurring) activity are stored in ActivityOccurrence
+    # None denotes that the occurrences are not indexed (yet)
+    occurrences_indexed_until = models.DateTimeField(blank=True, null=True, editable=False)
+
     @property
     def image_url(self):
         if self.image is None:
@@ -110,33 +135,53 @@ class Activity(models.Model):
     
     # Number of participants already subscribed
     def get_num_subscribed_participants(self, recurrence_id=None):
-        return self.get_subscribed_participants(recurrence_id).count()
-    
+        return self.get_occurrence_statistics(recurrence_id).num_participants
+
+    # The (denormalized) slot and participant counters of an occurrence
+    # An occurrence without statistics has no slots (and hence no participants) yet
+    def get_occurrence_statistics(self, recurrence_id=None):
+        if not self.is_recurring:
+            recurrence_id = None
+        elif recurrence_id is None:
+            raise TypeError("recurrence_id cannot be None if the activity is recurring")
+
+        statistics = ActivityOccurrenceStatistics.objects.filter(activity__id=self.id, recurrence_id=recurrence_id).first()
+        if statistics is None:
+            return ActivityOccurrenceStatistics(activity=self, recurrence_id=recurrence_id)
+        statistics.activity = self
+        return statistics
+
     # Maximum number of participants
-    def get_max_num_participants(self, recurrence_id=None):
+    # num_slots and num_max_slot_participants (the total capacity of the existing slots, or -1 if
+    # at least one of them is unlimited) can be passed if they are already known
+    def get_max_num_participants(self, recurrence_id=None, num_slots=None, num_max_slot_participants=None):
         max_participants = self.max_participants
 
+        if num_slots is None or num_max_slot_participants is None:
+            statistics = self.get_occurrence_statistics(recurrence_id)
+            num_slots = statistics.num_slots if num_slots is None else num_slots
+            if num_max_slot_participants is None:
+                num_max_slot_participants = statistics.num_max_slot_participants
+
         # At least one slot can (in theory) be created
         if self.slot_creation != "CREATION_NONE" and self.max_slots != 0:
             # New slots can actually be made (take into account the current limit)
-            if self.max_slots == -1 or self.max_slots - self.get_num_slots(recurrence_id=recurrence_id) > 0:
+            if self.max_slots == -1 or self.max_slots - num_slots > 0:
                 # Only limited by this activity's participants
                 return max_participants
 
         # Otherwise we have to deal with the limitations of the already existing slots
-        cnt = 0
-        for slot in self.get_slots(recurrence_id):
+
+        if num_max_slot_participants == -1:
             # At least one slot allows for infinite participants
-            if slot.max_participants == -1:
-                # But may still be limited by the activity's maximum amount of participants
-                return max_participants
-            cnt += slot.max_participants 
-        
+            # But may still be limited by the activity's maximum amount of participants
+            return max_participants
+
         if max_participants == -1:
             # Infinite activity participants means we're limited by the existing slots
-            return cnt
+            return num_max_slot_participants
         # Otherwise it's the smallest of the two
-        return min(max_participants, cnt)
+        return min(max_participants, num_max_slot_participants)
 
     # slots already created
     def get_slots(self, recurrence_id=None):
@@ -151,7 +196,7 @@ class Activity(models.Model):
     
     # Number of slots
     def get_num_slots(self, recurrence_id=None):
-        return self.get_slots(recurrence_id).count()
+        return self.get_occurrence_statistics(recurrence_id).num_slots
 
     # Maximum number of slots that can be created
     def get_max_num_slots(self, recurrence_id=None):
@@ -167,11 +212,14 @@ class Activity(models.Model):
             num_total_participants=None, num_max_participants=None):
         if num_user_registrations is None:
             num_user_registrations = self.get_num_user_subscriptions(user, recurrence_id=recurrence_id)
-        
-        if num_total_participants is None:
-            num_total_participants = self.get_slots(recurrence_id=recurrence_id).aggregate(Count('participants'))['participants__count']
-        if num_max_participants is None:
-            num_max_participants = self.get_max_num_participants(recurrence_id=recurrence_id)
+
+        if num_total_participants is None or num_slots is None or num_max_participants is None:
+            statistics = self.get_occurrence_statistics(recurrence_id)
+            num_total_participants = statistics.num_participants if num_total_participants is None else num_total_participants
+            num_slots = statistics.num_slots if num_slots is None else num_slots
+            if num_max_participants is None:
+                num_max_participants = self.get_max_num_participants(recurrence_id=recurrence_id,
+                    num_slots=statistics.num_slots, num_max_slot_participants=statistics.num_max_slot_participants)
 
         # Can the user (in theory) join another slot?
         user_can_join_another_slot = (self.max_slots_join_per_participant == -1 or \
@@ -185,9 +233,6 @@ class Activity(models.Model):
             return True
         
         # Finite number of slots
-        if num_slots is None:
-            num_slots = self.get_slots(recurrence_id=recurrence_id).count()
-
         # Limited slots and can join
         return num_slots < self.max_slots and user_can_join_another_slot and can_have_more_participants
 
@@ -208,7 +253,8 @@ class Activity(models.Model):
         return self.get_user_subscriptions(user, recurrence_id, participants).first() is not None
     
     # Whether a user can still subscribe to the activity
-    def can_user_subscribe(self, user, recurrence_id=None, participants=None, max_participants=None):
+    def can_user_subscribe(self, user, recurrence_id=None, participants=None, max_participants=None,
+            num_participants=None):
         if user.is_anonymous:
             # Must be logged in to register
             return False
@@ -217,17 +263,25 @@ class Activity(models.Model):
             # Must be open for registrations
             return False
 
+        statistics = None
         if max_participants is None:
-            max_participants = self.get_max_num_participants(recurrence_id)
-        
+            statistics = self.get_occurrence_statistics(recurrence_id)
+            max_participants = self.get_max_num_participants(recurrence_id, num_slots=statistics.num_slots,
+                num_max_slot_participants=statistics.num_max_slot_participants)
+
         if max_participants == -1:
             # Infinite participants are allowed
             return True
 
-        if participants is None:
-            participants = self.get_subscribed_participants(recurrence_id)
+        if num_participants is None:
+            if participants is not None:
+                num_participants = participants.count()
+            elif statistics is not None:
+                num_participants = statistics.num_participants
+            else:
+                num_participants = self.get_num_subscribed_participants(recurrence_id)
 
-        return participants.count() < max_participants
+        return num_participants < max_participants
 
     # Whether subscriptions are open
     def are_subscriptions_open(self, recurrence_id=None):
@@ -240,6 +294,20 @@ class Activity(models.Model):
         now = timezone.now()
         return recurrence_id - self.subscriptions_open <= now and now <= recurrence_id - self.subscriptions_close
 
+    # Whether registrations should be queued (instead of being processed immediately)
+    def is_admission_queue_active(self, recurrence_id=None):
+        if not self.admission_queue:
+            return False
+
+        if not self.is_recurring:
+            recurrence_id = self.start_date
+
+        if recurrence_id is None:
+            raise TypeError("recurrence_id cannot be None if the activity is recurring")
+
+        opens = recurrence_id - self.subscriptions_open
+        return opens <= timezone.now() < opens + self.admission_queue_duration
+
     # String-representation of an instance of the model
     def __str__(self):
         if self.is_recurring:
@@ -255,8 +323,79 @@ class Activity(models.Model):
     def has_occurence_at(self, date):
         if not self.is_recurring:
             return date == self.start_date
-        occurences = self.recurrences.between(date, date, dtstart=self.start_date, inc=True)
-        return bool(occurences)
+
+        # Use the compiled occurrences if the date falls within their range
+        has_occurrence = compiled_recurrences.get(self).has_occurrence_at(date)
+        if has_occurrence is not None:
+            return has_occurrence
+
+        return bool(self.expand_occurrences(date, date))
+
+    # Calculates the occurrences of this recurring activity in the given timeframe,
+    # as (recurrence_id, start_date, end_date)-tuples
+    def expand_occurrences(self, start, end):
+        recurrences = self.recurrences
+        event_start_time = self.start_date.astimezone(timezone.get_current_timezone()).time()
+
+        # EXDATEs are stored at the (DST-correct) start time of the occurrence they exclude, while recurrence
+        # expects them at the start time in UTC (ignoring DST). Hence, they're applied after localization instead.
+        # NB: A copy is made, so that the activity's recurrences remain untouched
+        exdates = set(recurrences.exdates)
+        recurrences = Recurrence(
+            rrules=recurrences.rrules, exrules=recurrences.exrules, rdates=recurrences.rdates,
+            dtend=recurrences.dtend, include_dtstart=recurrences.include_dtstart,
+        )
+
+        # If the activity ends on a different day than it starts, this also needs to be the case for the occurrence
+        time_diff = self.end_date - self.start_date
+
+        # recurrence does not handle daylight-saving time! If we were to keep the occurence as is,
+        # then summer events would occur an hour earlier in winter!
+        local_timezone = get_local_timezone(timezone.get_current_timezone())
+
+        occurrences = []
+        for recurrence_id in recurrences_between(recurrences, start, end, dtstart=self.start_date):
+            occurence = local_timezone.combine(recurrence_id, event_start_time)
+            if occurence in exdates:
+                continue
+            occurrences.append((recurrence_id, occurence, occurence + time_diff))
+        return occurrences
+
+    # Obtains the (start, end)-dates of the occurrence with the given recurrence id (corrected for
+    # daylight-saving time), or those of the activity itself if it is non-recurring
+    def get_occurrence_dates(self, recurrence_id=None):
+        if recurrence_id is None:
+            return self.start_date, self.end_date
+
+        current_timezone = timezone.get_current_timezone()
+        event_start_time = self.start_date.astimezone(current_timezone).time()
+        start_date = get_local_timezone(current_timezone).combine(recurrence_id, event_start_time)
+        return start_date, start_date + (self.end_date - self.start_date)
+
+    # Stores the occurrences of this activity up until the given date in ActivityOccurrence
+    # If rebuild is True, previously stored occurrences are discarded first
+    def index_occurrences(self, until, rebuild=False):
+        if rebuild:
+            self.occurrences.all().delete()
+            indexed_until = None
+        else:
+            indexed_until = self.occurrences_indexed_until
+
+        if not self.is_recurring:
+            # Non-recurring activities only have a single occurrence; no need to index it
+            indexed_until = None
+        elif indexed_until is None or indexed_until < until:
+            # RDATEs may lie before the activity's start date
+            start = indexed_until or min([self.start_date, *self.recurrences.rdates])
+            ActivityOccurrence.objects.bulk_create([
+                ActivityOccurrence(activity=self, recurrence_id=recurrence_id, start_date=start_date, end_date=end_date)
+                for recurrence_id, start_date, end_date in self.expand_occurrences(start, until)
+            ], ignore_conflicts=True)
+            indexed_until = until
+
+        # Do not use save(), as that would update last_updated_date (and fire signals)
+        Activity.objects.filter(id=self.id).update(occurrences_indexed_until=indexed_until)
+        self.occurrences_indexed_until = indexed_until
     
     def clean_fields(self, exclude=None):
         super().clean_fields(exclude=exclude)
@@ -294,6 +433,16 @@ class Activity(models.Model):
 
 
 class ActivitySlot(models.Model):
+    class Meta:
+        # Automatically created slots are numbered per occurrence. These numbers are unique, so that
+        # concurrently created slots cannot end up with the same number
+        unique_together = [['parent_activity', 'recurrence_id', 'slot_number']]
+        constraints = [
+            # Non-recurring activities have a single occurrence (without recurrence id)
+            models.UniqueConstraint(fields=['parent_activity', 'slot_number'], condition=models.Q(recurrence_id=None),
+                name='unique_non_recurring_slot_number'),
+        ]
+
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     location = models.CharField(max_length=255, blank=True, null=True,
@@ -315,7 +464,12 @@ class ActivitySlot(models.Model):
         help_text="If the activity is recurring, set this to the date/time of one of its occurences. Leave this field empty if the parent activity is non-recurring.",
         verbose_name="parent activity date/time")
 
+    # Number of the slot within its occurrence (only for automatically created slots)
+    slot_number = models.PositiveIntegerField(blank=True, null=True, editable=False)
+
     participants = models.ManyToManyField(User, blank=True, through="Participant", related_name="participant_info")
+    # Number of participants (handled automatically)
+    num_participants = models.PositiveIntegerField(default=0, editable=False)
     max_participants = models.IntegerField(default=-1, validators=[MinValueValidator(-1)],
         help_text="-1 denotes unlimited participants", verbose_name="maximum number of participants")
 
@@ -340,7 +494,7 @@ class ActivitySlot(models.Model):
     
     # Number of participants already subscribed
     def get_num_subscribed_participants(self):
-        return get_subscribed_participants().count()
+        return self.num_participants
 
     def clean_fields(self, exclude=None):
         super().clean_fields(exclude=exclude)
@@ -374,7 +528,136 @@ class ActivitySlot(models.Model):
     def __str__(self):
         return self.title
 
+# A stored occurrence of a recurring activity, so that the occurrences in a given
+# timeframe can be obtained without expanding the activity's recurrence rules
+class ActivityOccurrence(models.Model):
+    class Meta:
+        unique_together = [['activity', 'recurrence_id']]
+        indexes = [
+            models.Index(fields=['recurrence_id']),
+        ]
+
+    activity = models.ForeignKey(Activity, related_name="occurrences", on_delete=models.CASCADE)
+
+    # The date/time of the occurrence, as generated by the activity's recurrence rules
+    recurrence_id = models.DateTimeField()
+
+    # Start and end times of the occurrence (corrected for daylight-saving time)
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.activity.title} ({self.start_date})"
+
+# The number of slots, their capacity and the number of participants of an occurrence of an activity
+# These are kept up to date automatically, so that capacity checks need not count the slots and participants
+class ActivityOccurrenceStatistics(models.Model):
+    class Meta:
+        verbose_name_plural = "activity occurrence statistics"
+        unique_together = [['activity', 'recurrence_id']]
+        constraints = [
+            # Non-recurring activities have a single occurrence (without recurrence id)
+            models.UniqueConstraint(fields=['activity'], condition=models.Q(recurrence_id=None),
+                name='unique_non_recurring_statistics'),
+        ]
+
+    activity = models.ForeignKey(Activity, related_name="occurrence_statistics", on_delete=models.CASCADE)
+    # Matches the recurrence_id of the occurrence's slots (empty for non-recurring activities)
+    recurrence_id = models.DateTimeField(blank=True, null=True)
+
+    num_slots = models.PositiveIntegerField(default=0)
+    # The total capacity of the slots; -1 if at least one of them allows unlimited participants
+    num_max_slot_participants = models.IntegerField(default=0)
+    num_participants = models.PositiveIntegerField(default=0)
+
+    # The number of participants that can still join, or -1 if unlimited
+    def get_remaining_capacity(self):
+        max_participants = self.activity.get_max_num_participants(self.recurrence_id,
+            num_slots=self.num_slots, num_max_slot_participants=self.num_max_slot_participants)
+        if max_participants == -1:
+            return -1
+        return max(max_participants - self.num_participants, 0)
+
+    def __str__(self):
+        return f"{self.activity.title} ({self.recurrence_id or self.activity.start_date})"
+
+# A queued registration of a user for a slot. Tickets are processed in the order they were created
+class RegistrationTicket(models.Model):
+    class Meta:
+        indexes = [
+            # Used to find the queued tickets (in order)
+            models.Index(fields=['status', 'id']),
+        ]
+
+    STATUS_QUEUED = "QUEUED"
+    STATUS_PROCESSING = "PROCESSING"
+    STATUS_ACCEPTED = "ACCEPTED"
+    STATUS_REJECTED = "REJECTED"
+    STATUS_OPTIONS = [
+        (STATUS_QUEUED,     "Queued"),
+        (STATUS_PROCESSING, "Processing"),
+        (STATUS_ACCEPTED,   "Accepted"),
+        (STATUS_REJECTED,   "Rejected"),
+    ]
+    PENDING_STATUSES = [STATUS_QUEUED, STATUS_PROCESSING]
+
+    # Rejected tickets are kept (so that users can see why) if their slot is removed
+    slot = models.ForeignKey(ActivitySlot, related_name="registration_tickets", on_delete=models.SET_NULL, null=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Whether the slot was created by the user along with this registration. Such slots are removed
+    # again if the registration is rejected (and nobody else joined them in the meantime)
+    creates_slot = models.BooleanField(default=False)
+
+    status = models.CharField(max_length=15, choices=STATUS_OPTIONS, default=STATUS_QUEUED)
+    # Why the registration was rejected
+    message = models.CharField(max_length=255, blank=True)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    processed_date = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def is_pending(self):
+        return self.status in self.PENDING_STATUSES
+
+    # The position of this ticket in the queue of its activity (starting at 1), or None if it was processed
+    def get_position(self):
+        if not self.is_pending:
+            return None
+        return RegistrationTicket.objects.filter(status__in=self.PENDING_STATUSES, id__lte=self.id,
+            slot__parent_activity__in=ActivitySlot.objects.filter(id=self.slot_id).values('parent_activity')).count()
+
+    def __str__(self):
+        return f"{self.user} - {self.slot} ({self.status})"
+
+# Generates a secret token (used as a default value below)
+def generate_calendar_token():
+    return secrets.token_urlsafe(32)
+
+# A secret token that gives access to the calendar feed of the activities a user registered for,
+# so that calendar applications can subscribe to it without logging in
+class CalendarToken(models.Model):
+    user = models.OneToOneField(User, related_name="calendar_token", on_delete=models.CASCADE)
+    token = models.CharField(max_length=64, unique=True, default=generate_calendar_token, editable=False)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    # Obtains the token of the given user, and creates one if the user has none yet
+    @staticmethod
+    def get_for_user(user):
+        return CalendarToken.objects.get_or_create(user_id=user.id)[0]
+
+    # Replaces the token, so that the previous feed URL no longer works
+    def reset(self):
+        self.token = generate_calendar_token()
+        self.save(update_fields=['token'])
+
+    def __str__(self):
+        return f"Calendar token of {self.user}"
+
 class Participant(models.Model):
+    class Meta:
+        # Users can join each slot only once, even if they register concurrently
+        unique_together = [['user', 'activity_slot']]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     activity_slot = models.ForeignKey(ActivitySlot, on_delete=models.CASCADE)
     showed_up = models.BooleanField(null=True, default=None, help_text="Whether the participant actually showed up")
@@ -0,0 +1,227 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Lock
+
+from dateutil import rrule as dateutil_rrule
+from recurrence import serialize as serialize_recurrence
+
+from django.conf import settings
+from django.utils import timezone
+
+##################################################################################
+# Window-anchored expansion of recurrences
+# @since 18 OCT 2020
+##################################################################################
+
+# Rules with a fixed period length can be moved forward by a whole number of periods
+FIXED_PERIODS = {
+    dateutil_rrule.WEEKLY:      timedelta(weeks=1),
+    dateutil_rrule.DAILY:       timedelta(days=1),
+    dateutil_rrule.HOURLY:      timedelta(hours=1),
+    dateutil_rrule.MINUTELY:    timedelta(minutes=1),
+    dateutil_rrule.SECONDLY:    timedelta(seconds=1),
+}
+
+# Moves a datetime forward by the given amount of months, keeping its (wall-clock) day and time
+def add_months(dt, months):
+    year, month = divmod(dt.month - 1 + months, 12)
+    return dt.replace(year=dt.year + year, month=month + 1)
+
+# Returns a start date for the given rule that lies (at least) a period before the given date,
+# while generating the same occurrences after that date as the rule would when started at dtstart.
+# Returns None if the rule cannot be anchored (in which case it must be iterated from dtstart)
+def get_anchored_dtstart(rule, dtstart, after):
+    # COUNT depends on every occurrence since dtstart
+    if rule.count is not None or after <= dtstart:
+        return None
+
+    interval = rule.interval or 1
+    # Keep a margin of two periods, so that occurrences that lie earlier in the anchor's period
+    # (e.g. a BYDAY earlier in the week) and DST-shifts in dtstart's timezone cannot be skipped
+    if rule.freq in FIXED_PERIODS:
+        period = FIXED_PERIODS[rule.freq] * interval
+        num_periods = (after - dtstart) // period - 2
+        if num_periods <= 0:
+            return None
+        # dateutil computes occurrences in dtstart's wall-clock time, so do the same here
+        return (dtstart.replace(tzinfo=None) + period * num_periods).replace(tzinfo=dtstart.tzinfo)
+
+    if rule.freq == dateutil_rrule.MONTHLY:
+        # Not every month has a 29th, 30th or 31st day
+        if dtstart.day > 28:
+            return None
+        months = (after.year - dtstart.year) * 12 + after.month - dtstart.month
+        num_periods = months // interval - 2
+        if num_periods <= 0:
+            return None
+        return add_months(dtstart, num_periods * interval)
+
+    if rule.freq == dateutil_rrule.YEARLY:
+        # Not every year has a February 29th
+        if dtstart.month == 2 and dtstart.day == 29:
+            return None
+        num_periods = (after.year - dtstart.year) // interval - 2
+        if num_periods <= 0:
+            return None
+        return dtstart.replace(year=dtstart.year + num_periods * interval)
+
+    return None
+
+# Converts a recurrence rule to a dateutil rrule that starts as close to the given date as possible
+def to_anchored_rrule(rule, dtstart, after):
+    return rule.to_dateutil_rrule(get_anchored_dtstart(rule, dtstart, after) or dtstart)
+
+# Equivalent to recurrences.between(after, before, dtstart=dtstart, inc=True), but only
+# iterates each rule from the period before the requested window instead of from dtstart.
+# Hence, expanding the recurrences of an old activity does not become slower as time passes
+def recurrences_between(recurrences, after, before, dtstart):
+    if recurrences.dtend is not None:
+        # Rarely used; let recurrence handle it
+        return recurrences.between(after, before, dtstart=dtstart, inc=True)
+
+    rruleset = dateutil_rrule.rruleset()
+    for rule in recurrences.rrules:
+        rruleset.rrule(to_anchored_rrule(rule, dtstart, after))
+    for rule in recurrences.exrules:
+        rruleset.exrule(to_anchored_rrule(rule, dtstart, after))
+    if recurrences.include_dtstart:
+        rruleset.rdate(dtstart)
+    for rdate in recurrences.rdates:
+        rruleset.rdate(rdate)
+    for exdate in recurrences.exdates:
+        rruleset.exdate(exdate)
+    return rruleset.between(after, before, inc=True)
+
+
+##################################################################################
+# Timezone conversions with cached transitions
+# @since 18 OCT 2020
+##################################################################################
+
+# Converts between UTC and a timezone's wall-clock time. Uses the transition table of pytz
+# timezones directly, so that localizing many occurrences does not require a pytz localize each.
+# Ambiguous and non-existent wall-clock times are still delegated to the timezone itself
+class LocalTimezone:
+    def __init__(self, tz):
+        self.tz = tz
+        # Naive UTC times at which the offset of the timezone changes, and the matching offsets and tzinfos
+        self.transitions = getattr(tz, '_utc_transition_times', None)
+        if self.transitions is not None:
+            self.offsets = [info[0] for info in tz._transition_info]
+            self.tzinfos = [tz._tzinfos[info] for info in tz._transition_info]
+
+    # The index of the transition that applies at the given naive UTC time
+    def _index_at(self, utc_time):
+        return max(bisect_right(self.transitions, utc_time) - 1, 0)
+
+    # The given aware datetime, converted to this timezone
+    def localtime(self, dt):
+        if self.transitions is None:
+            return dt.astimezone(self.tz)
+        utc_time = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        index = self._index_at(utc_time)
+        return (utc_time + self.offsets[index]).replace(tzinfo=self.tzinfos[index])
+
+    # The given naive wall-clock time, made aware in this timezone
+    def localize(self, naive):
+        if self.transitions is None:
+            return timezone.make_aware(naive, self.tz)
+        # The wall-clock time lies within a period (or the one before or after it) whose
+        # offset, when applied to the wall-clock time, results in a UTC time in that same period
+        index = self._index_at(naive)
+        candidates = [i for i in range(max(index - 1, 0), min(index + 2, len(self.tzinfos)))
+            if self._index_at(naive - self.offsets[i]) == i]
+        if len(candidates) != 1:
+            # Ambiguous or non-existent wall-clock time (around a transition)
+            return self.tz.localize(naive)
+        return naive.replace(tzinfo=self.tzinfos[candidates[0]])
+
+    # The occurrence of a recurrence at the given wall-clock time, on the (local) day of the recurrence id
+    def combine(self, recurrence_id, time):
+        return self.localize(datetime.combine(self.localtime(recurrence_id).date(), time))
+
+
+@lru_cache()
+def get_local_timezone(tz):
+    return LocalTimezone(tz)
+
+# Each EXDATE's time needs to match the event start-time, but they default to midnight in the widget!
+# Since there's no possibility to select the time in the UI either, each EXDATE is moved to the
+# (local, DST-correct) start time of the event on that day. Normalized EXDATEs remain unchanged
+def normalize_exdates(exdates, start_date):
+    local_timezone = get_local_timezone(timezone.get_current_timezone())
+    event_start_time = local_timezone.localtime(start_date).time()
+    return [local_timezone.combine(exdate, event_start_time).astimezone(timezone.utc) for exdate in exdates]
+
+
+##################################################################################
+# In-memory cache of the occurrences of recurring activities
+# @since 18 OCT 2020
+##################################################################################
+
+# The occurrences (recurrence ids) of a recurring activity up until a given date, in sorted order
+class CompiledRecurrence:
+    def __init__(self, recurrence_ids, until):
+        self.recurrence_ids = sorted(recurrence_ids)
+        self.until = until
+
+    # Whether the activity occurs at the given date
+    # Returns None if the date lies beyond the compiled range
+    def has_occurrence_at(self, date):
+        if date > self.until:
+            return None
+        index = bisect_left(self.recurrence_ids, date)
+        return index < len(self.recurrence_ids) and self.recurrence_ids[index] == date
+
+    # The recurrence ids in the given timeframe (inclusive)
+    # Returns None if the timeframe lies (partially) beyond the compiled range
+    def between(self, start, end):
+        if end > self.until:
+            return None
+        return self.recurrence_ids[bisect_left(self.recurrence_ids, start):bisect_right(self.recurrence_ids, end)]
+
+
+# A least-recently-used cache of compiled recurrences, keyed by everything the occurrences depend on
+# (see get_key). Hence an activity's entry is replaced once its recurrences or start date change,
+# even if the activity was not saved (yet)
+class CompiledRecurrenceCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    # The occurrences depend on the activity's recurrences and on its start date (in the current timezone)
+    def get_key(self, activity):
+        return (serialize_recurrence(activity.recurrences), activity.recurrences.include_dtstart,
+            activity.start_date, timezone.get_current_timezone_name())
+
+    def get(self, activity):
+        key = self.get_key(activity)
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled is not None:
+                self.entries.move_to_end(key)
+
+        if compiled is None or compiled.until < timezone.now():
+            compiled = self.compile(activity)
+            with self.lock:
+                self.entries[key] = compiled
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return compiled
+
+    def compile(self, activity):
+        until = timezone.now() + settings.ACTIVITY_OCCURRENCE_HORIZON
+        # RDATEs may lie before the activity's start date
+        start = min([activity.start_date, *activity.recurrences.rdates])
+        recurrence_ids = [recurrence_id for recurrence_id, _, _ in activity.expand_occurrences(start, until)]
+        return CompiledRecurrence(recurrence_ids, until)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+compiled_recurrences = CompiledRecurrenceCache(settings.ACTIVITY_RECURRENCE_CACHE_SIZE)
@@ -0,0 +1,200 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .counters import (lock_occurrence_statistics, rebuild_occurrence_statistics, reserve_occurrence_participant,
+        reserve_slot_participant)
+from .models import ActivitySlot, Participant, RegistrationTicket
+
+##################################################################################
+# Atomic (de)registration of users for activity slots, and the admission queue
+# that processes registrations in order while registrations are busiest
+# @since 18 OCT 2020
+##################################################################################
+
+logger = logging.getLogger(__name__)
+
+# Raised if a user cannot (de)register for a slot. The message describes why
+class RegistrationError(Exception):
+    pass
+
+# Obtains the slot with the given id (and its parent activity) while locking the slot's row
+# until the end of the current transaction, where the database supports this.
+# NB: The participant limits do not depend on this lock; they are enforced by the counter updates
+def lock_slot(slot_id):
+    slot = ActivitySlot.objects.select_related('parent_activity').select_for_update().filter(id=slot_id).first()
+    if slot is None:
+        raise RegistrationError(f"Expected the id of an existing ActivitySlot, but got <{slot_id}>")
+    return slot
+
+# Registers the user for the slot with the given id. The per-slot, per-activity and per-user limits
+# are checked (using the participant counters) and the participant is created in a single transaction.
+# - A place is reserved through conditional updates of the participant counters, so concurrent
+#   registrations cannot overbook the slot or its activity.
+# - The occurrence's statistics are locked before the user's registrations are counted, so concurrent
+#   registrations of the same user for the occurrence are checked one after another.
+# - Joining the same slot twice is prevented by a unique constraint as well.
+# Returns the slot, or raises a RegistrationError if the user cannot register
+def register_participant(slot_id, user):
+    with transaction.atomic():
+        slot = lock_slot(slot_id)
+        activity = slot.parent_activity
+
+        # Subscriptions must be open
+        if user.is_anonymous or not slot.are_subscriptions_open():
+            raise RegistrationError("Cannot subscribe")
+
+        if not lock_occurrence_statistics(slot):
+            # No statistics were kept for the occurrence yet (e.g. if its slots were bulk-created)
+            rebuild_occurrence_statistics(activity.id, slot.recurrence_id)
+            lock_occurrence_statistics(slot)
+
+        # The user's registrations for the same occurrence
+        user_info = Participant.objects.filter(user__id=user.id,
+                activity_slot__in=activity.get_slots(recurrence_id=slot.recurrence_id)).aggregate(
+                num_user_registrations=Count('id'),
+                num_user_slot_registrations=Count('id', filter=Q(activity_slot__id=slot.id)))
+
+        # Can only subscribe to at most X slots
+        if activity.max_slots_join_per_participant != -1 and \
+                user_info['num_user_registrations'] >= activity.max_slots_join_per_participant:
+            raise RegistrationError("Cannot subscribe to another slot")
+
+        # Activity participants limit
+        statistics = activity.get_occurrence_statistics(slot.recurrence_id)
+        max_participants = activity.get_max_num_participants(slot.recurrence_id, num_slots=statistics.num_slots,
+            num_max_slot_participants=statistics.num_max_slot_participants)
+        if max_participants != -1 and statistics.num_participants >= max_participants:
+            raise RegistrationError("Cannot subscribe")
+
+        # Can only subscribe at most once to each slot
+        if user_info['num_user_slot_registrations']:
+            raise RegistrationError("Cannot subscribe to the same slot more than once")
+
+        # Slot participants limit
+        if slot.max_participants != -1 and slot.num_participants >= slot.max_participants:
+            raise RegistrationError("Slot is full")
+
+        # Reserve a place; this fails if the limits were reached concurrently (and rolls back the transaction)
+        if not reserve_occurrence_participant(slot, max_participants):
+            raise RegistrationError("Cannot subscribe")
+        if not reserve_slot_participant(slot):
+            raise RegistrationError("Slot is full")
+
+        participant = Participant(user_id=user.id, activity_slot=slot)
+        # The participant counters were already incremented
+        participant._counters_updated = True
+        try:
+            participant.save()
+        except IntegrityError:
+            # Registered concurrently (the transaction, including the reservation, is rolled back)
+            raise RegistrationError("Cannot subscribe to the same slot more than once")
+    return slot
+
+# Deregisters the user from the slot with the given id
+# Returns the slot, or raises a RegistrationError if the user cannot deregister
+def deregister_participant(slot_id, user):
+    with transaction.atomic():
+        slot = lock_slot(slot_id)
+
+        # Subscriptions must be open
+        if not slot.are_subscriptions_open():
+            raise RegistrationError("Cannot unsubscribe once subscriptions are closed")
+
+        Participant.objects.filter(activity_slot__id=slot.id, user__id=user.id).delete()
+    return slot
+
+# Removes the slot with the given id, unless someone joined it or has a pending registration for it
+# Returns whether the slot was removed
+def remove_unused_slot(slot_id):
+    with transaction.atomic():
+        slot = ActivitySlot.objects.select_for_update().filter(id=slot_id).first()
+        if slot is None or Participant.objects.filter(activity_slot__id=slot.id).exists() or \
+                slot.registration_tickets.filter(status__in=RegistrationTicket.PENDING_STATUSES).exists():
+            return False
+        slot.delete()
+    return True
+
+# Registers the user for the slot with the given id, or queues the registration if the slot's
+# activity uses an admission queue that is currently active. If creates_slot is True, the slot
+# was created by the user along with the registration, and is removed if a queued registration is rejected.
+# Returns a (slot, ticket)-tuple, where ticket is None if the user was registered immediately.
+# Raises a RegistrationError if the user cannot register
+def submit_registration(slot_id, user, creates_slot=False):
+    slot = ActivitySlot.objects.select_related('parent_activity').filter(id=slot_id).first()
+    if slot is None:
+        raise RegistrationError(f"Expected the id of an existing ActivitySlot, but got <{slot_id}>")
+
+    if not slot.parent_activity.is_admission_queue_active(slot.recurrence_id):
+        return register_participant(slot_id, user), None
+
+    # No need to queue the same registration more than once
+    ticket = RegistrationTicket.objects.filter(slot__id=slot.id, user__id=user.id,
+        status__in=RegistrationTicket.PENDING_STATUSES).first()
+    if ticket is None:
+        ticket = RegistrationTicket.objects.create(slot=slot, user_id=user.id, creates_slot=creates_slot)
+    return slot, ticket
+
+# Processes a single queued ticket, unless it was already claimed by someone else
+# Returns whether the ticket was processed
+def process_ticket(ticket):
+    # Claim the ticket
+    if not RegistrationTicket.objects.filter(id=ticket.id, status=RegistrationTicket.STATUS_QUEUED) \
+            .update(status=RegistrationTicket.STATUS_PROCESSING):
+        return False
+
+    try:
+        if ticket.slot_id is None:
+            raise RegistrationError("The slot no longer exists")
+        register_participant(ticket.slot_id, ticket.user)
+        ticket.status = RegistrationTicket.STATUS_ACCEPTED
+        ticket.message = ""
+    except RegistrationError as error:
+        ticket.status = RegistrationTicket.STATUS_REJECTED
+        ticket.message = str(error)
+    except Exception:
+        # Unexpected errors should not leave the ticket in processing, nor keep the next tickets from being processed
+        logger.exception(f"Could not process registration ticket <{ticket.id}>")
+        ticket.status = RegistrationTicket.STATUS_REJECTED
+        ticket.message = "Your registration could not be processed"
+
+    ticket.processed_date = timezone.now()
+    ticket.save(update_fields=['status', 'message', 'processed_date'])
+
+    # Slots are not kept if their creator could not join them
+    if ticket.status == RegistrationTicket.STATUS_REJECTED and ticket.creates_slot and ticket.slot_id is not None:
+        remove_unused_slot(ticket.slot_id)
+    return True
+
+# Processes the given tickets in order, and returns the number of processed tickets
+def process_tickets(tickets, close_connection=False):
+    try:
+        return sum(process_ticket(ticket) for ticket in tickets)
+    finally:
+        # Each worker thread has its own database connection
+        if close_connection:
+            connection.close()
+
+# Processes (at most batch_size) queued tickets in FIFO order. Tickets of the same activity are
+# processed one after another (so that earlier tickets cannot be overtaken), while the queues of
+# at most max_workers activities are processed concurrently. SQLite does not allow concurrent
+# writes, so the queues are always processed one after another on SQLite.
+# Returns the number of processed tickets
+def process_registration_queue(max_workers=1, batch_size=50):
+    tickets = RegistrationTicket.objects.filter(status=RegistrationTicket.STATUS_QUEUED) \
+        .select_related('slot', 'user').order_by('id')[:batch_size]
+
+    queues = OrderedDict()
+    for ticket in tickets:
+        # Tickets of removed slots are rejected
+        queues.setdefault(ticket.slot.parent_activity_id if ticket.slot else None, []).append(ticket)
+
+    if max_workers <= 1 or len(queues) <= 1 or connection.vendor == 'sqlite':
+        return process_tickets(ticket for queue in queues.values() for ticket in queue)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return sum(executor.map(lambda queue: process_tickets(queue, close_connection=True), queues.values()))
@@ -0,0 +1,101 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .counters import rebuild_occurrence_statistics
+from .models import ActivitySlot
+from .util import bump_calendar_version, bump_occurrence_version
+
+##################################################################################
+# Creates the slots of activities that create their slots automatically (CREATION_AUTO).
+# Such slots are numbered per occurrence ("Slot 1", "Slot 2", ...), and these numbers are
+# unique so that slots created at the same time cannot end up with the same number
+# @since 18 OCT 2020
+##################################################################################
+
+# Number of attempts to save a numbered slot before giving up
+MAX_SLOT_NUMBER_ATTEMPTS = 5
+
+# Assigns the given (numbered) slot its number and the corresponding title
+def set_slot_number(slot, slot_number):
+    slot.slot_number = slot_number
+    slot.title = f"Slot {slot_number}"
+
+# Obtains the recurrence ids of (at most) the next num_occurrences occurrences of the activity that
+# start after the given date, up to ACTIVITY_OCCURRENCE_HORIZON from then.
+# Non-recurring activities have a single occurrence, whose recurrence id is None
+def get_next_occurrences(activity, num_occurrences, after):
+    if not activity.is_recurring:
+        return [None] if activity.start_date >= after and num_occurrences > 0 else []
+
+    occurrences = activity.expand_occurrences(after, after + settings.ACTIVITY_OCCURRENCE_HORIZON)
+    return [recurrence_id for recurrence_id, start_date, end_date in occurrences
+        if start_date >= after][:num_occurrences]
+
+# Saves a new automatically created slot under the next free number of its occurrence.
+# If another slot claims that number first, the next one is tried instead
+def save_numbered_slot(slot):
+    for attempt in range(MAX_SLOT_NUMBER_ATTEMPTS):
+        last_slot_number = ActivitySlot.objects.filter(parent_activity__id=slot.parent_activity_id,
+            recurrence_id=slot.recurrence_id).aggregate(Max('slot_number'))['slot_number__max']
+        set_slot_number(slot, (last_slot_number or 0) + 1)
+        try:
+            with transaction.atomic():
+                slot.save()
+            return slot
+        except IntegrityError:
+            # Created concurrently
+            if attempt + 1 == MAX_SLOT_NUMBER_ATTEMPTS:
+                raise
+
+# Creates the slots numbered 1 up to num_slots for (at most) the next num_occurrences occurrences of
+# the given activities, using a single query. Slots that already exist are left untouched, so this can
+# safely be repeated. No more slots are created than an occurrence's activity allows (max_slots).
+# Activities that do not create slots automatically are skipped.
+# Returns the number of slots that were created
+def create_auto_slots(activities, num_occurrences, num_slots=1, after=None):
+    after = after or timezone.now()
+
+    occurrences = [
+        (activity, recurrence_id)
+        for activity in activities if activity.slot_creation == "CREATION_AUTO"
+        for recurrence_id in get_next_occurrences(activity, num_occurrences, after)
+    ]
+    if not occurrences or num_slots <= 0:
+        return 0
+
+    # The slots that already exist (and their numbers)
+    recurrence_ids = [recurrence_id for activity, recurrence_id in occurrences if recurrence_id is not None]
+    existing_slots = ActivitySlot.objects.filter(
+        Q(recurrence_id__in=recurrence_ids) | Q(recurrence_id=None),
+        parent_activity__id__in={activity.id for activity, recurrence_id in occurrences},
+    ).values_list('parent_activity_id', 'recurrence_id', 'slot_number')
+    num_existing_slots = Counter((activity_id, recurrence_id) for activity_id, recurrence_id, slot_number in existing_slots)
+    existing_slots = set(existing_slots)
+
+    slots = []
+    for activity, recurrence_id in occurrences:
+        slot_numbers = [slot_number for slot_number in range(1, num_slots + 1)
+            if (activity.id, recurrence_id, slot_number) not in existing_slots]
+        if activity.max_slots != -1:
+            slot_numbers = slot_numbers[:max(activity.max_slots - num_existing_slots[(activity.id, recurrence_id)], 0)]
+
+        for slot_number in slot_numbers:
+            slot = ActivitySlot(parent_activity=activity, recurrence_id=recurrence_id, max_participants=-1)
+            set_slot_number(slot, slot_number)
+            slots.append(slot)
+    if not slots:
+        return 0
+
+    # Slots created concurrently (with the same numbers) are skipped
+    ActivitySlot.objects.bulk_create(slots, ignore_conflicts=True)
+
+    # bulk_create does not fire signals, so update the statistics here
+    for activity_id, recurrence_id in {(slot.parent_activity_id, slot.recurrence_id) for slot in slots}:
+        rebuild_occurrence_statistics(activity_id, recurrence_id)
+        bump_occurrence_version(activity_id, recurrence_id)
+    bump_calendar_version()
+    return len(slots)
@@ -38,13 +38,17 @@ document.addEventListener('DOMContentLoaded', function() {
             success: function(response){
                 console.log('Activities were successfully fetched!')
             },
-            // extraParams: {
-            //     test: 'hi!',
-            // },
+            extraParams: {
+                // Only include the metadata of each activity once
+                format: 'compact',
+            },
         },
         // FullCalendar expects a JSON array, which is part of a JSON object of us
         eventSourceSuccess: function(content, xhr) {
-            return content.activities;
+            // Merge each activity's metadata (sent once per groupId) into its occurrences
+            return content.activities.map(function(occurrence) {
+                return Object.assign({}, content.groups[occurrence.groupId], occurrence)
+            });
         },
         eventClick: function(info) {
             onEventClick(info, this)
@@ -58,6 +62,27 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 
+// Descriptions of activities, keyed by groupId. These are not part of the (compact)
+// calendar feed, and are only fetched once an activity is opened
+var activityDescriptions = {}
+
+function loadEventDescription(event) {
+    var groupId = event.groupId
+    if (groupId in activityDescriptions) {
+        $('#event-description').text(activityDescriptions[groupId])
+        return
+    }
+
+    $('#event-description').text('')
+    $.getJSON(`/api/calendar/activities/${groupId}`, function(details) {
+        activityDescriptions[groupId] = details.description
+        // The modal may show another activity by now
+        if ($('#event-modal').data('groupId') === groupId) {
+            $('#event-description').text(details.description)
+        }
+    })
+}
+
 function onEventClick(info, calendar) {
     var event = info.event
     var start_date = event.start
@@ -118,7 +143,8 @@ function onEventClick(info, calendar) {
         $('#event-recurrence-info #exdates').text('Except on: ' + rInfo.exdates.join(' and '))
     }
     $('#event-location').text(event.extendedProps.location)
-    $('#event-description').text(event.extendedProps.description)
+    $('#event-modal').data('groupId', event.groupId)
+    loadEventDescription(event)
     
     if (event.extendedProps.isSubscribed) {
         $('#subscribe-required').hide()
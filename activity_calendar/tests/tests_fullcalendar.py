@@ -1,17 +1,28 @@
 from datetime import timedelta
+from unittest.mock import patch
 import json
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, Client
-from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, dateparse, translation
 
-from activity_calendar.models import Activity
-from activity_calendar.views import fullcalendar_feed
+from recurrence import deserialize as deserialize_recurrence
+
+from activity_calendar.models import Activity, ActivitySlot, Participant
+from core.models import ExtendedUser as User
+from activity_calendar.util import bump_calendar_version, get_calendar_version
+from activity_calendar.views import fullcalendar_feed, get_recurrence_info
 from core.util import suppress_warnings
+from core.tests.util import assertNumCacheCalls
 
 class TestCaseFullCalendar(TestCase):
     fixtures = ['test_activity_recurrence_dst.json']
 
     def setUp(self):
+        cache.clear()
         self.client = Client()
 
     def test_valid_dst_request(self):
@@ -105,3 +116,369 @@ class TestCaseFullCalendar(TestCase):
 
         # Needs valid dt-strings
         self.assertEqual(response.status_code, 400)
+
+
+class TestCaseFullCalendarStatistics(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.filter(username='test_user').first()
+        self.client.force_login(self.user)
+
+    def get_num_queries(self, start, end):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/calendar/fullcalendar', data={
+                'start': start,
+                'end': end,
+            })
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), json.loads(response.content).get('activities')
+
+    # The number of queries must not depend on the number of occurrences
+    def test_constant_num_queries(self):
+        num_queries_week, activities_week = self.get_num_queries("2020-08-17T00:00:00+02:00", "2020-08-24T00:00:00+02:00")
+        num_queries_month, activities_month = self.get_num_queries("2020-08-10T00:00:00+02:00", "2020-09-21T00:00:00+02:00")
+
+        self.assertLess(len(activities_week), len(activities_month))
+        self.assertEqual(num_queries_week, num_queries_month)
+
+    # Participant information is correctly obtained
+    def test_statistics(self):
+        _, activities = self.get_num_queries("2020-08-17T00:00:00+02:00", "2020-08-24T00:00:00+02:00")
+
+        occurrence = next(activity for activity in activities if activity.get('start') == '2020-08-19T16:00:00+02:00')
+        activity = Activity.objects.get(id=occurrence.get('groupId'))
+        recurrence_id = dateparse.parse_datetime('2020-08-19T14:00:00Z')
+
+        self.assertEqual(occurrence.get('numParticipants'), activity.get_num_subscribed_participants(recurrence_id))
+        self.assertEqual(occurrence.get('maxParticipants'), activity.get_max_num_participants(recurrence_id))
+        self.assertEqual(occurrence.get('isSubscribed'), activity.is_user_subscribed(self.user, recurrence_id))
+        self.assertTrue(occurrence.get('isSubscribed'))
+
+
+class TestCaseFullCalendarCache(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.filter(username='test_user').first()
+        self.data = {
+            'start': "2020-08-17T00:00:00+02:00",
+            'end': "2020-08-24T00:00:00+02:00",
+        }
+
+    def get_occurrence(self):
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data)
+        self.assertEqual(response.status_code, 200)
+        activities = json.loads(response.content).get('activities')
+        return next(activity for activity in activities if activity.get('start') == '2020-08-19T16:00:00+02:00')
+
+    # Versions change on every bump, and are not reused afterwards
+    def test_bump_version(self):
+        version = get_calendar_version()
+        self.assertEqual(get_calendar_version(), version)
+        bump_calendar_version()
+        self.assertNotEqual(get_calendar_version(), version)
+
+    # Cached payloads are served without expanding activities again
+    # NB: A single query is needed for the conditional request validators
+    def test_served_from_cache(self):
+        self.client.get('/api/calendar/fullcalendar', data=self.data)
+
+        # Validators (last modified, versions and subscription moments) and the payload
+        with self.assertNumQueries(1), assertNumCacheCalls(self, 6):
+            response = self.client.get('/api/calendar/fullcalendar', data=self.data)
+        self.assertEqual(response.status_code, 200)
+
+    # Changes to participants invalidate the cache
+    def test_invalidated_on_change(self):
+        num_participants = self.get_occurrence().get('numParticipants')
+
+        Participant.objects.filter(activity_slot__parent_activity__id=2).first().delete()
+        self.assertEqual(self.get_occurrence().get('numParticipants'), num_participants - 1)
+
+        slot = ActivitySlot.objects.filter(parent_activity__id=2).first()
+        slot.participants.add(self.user, through_defaults={})
+        self.assertEqual(self.get_occurrence().get('numParticipants'), num_participants)
+
+    # User-specific information is not shared between users
+    def test_user_overlay(self):
+        self.assertFalse(self.get_occurrence().get('isSubscribed'))
+
+        self.client.force_login(self.user)
+        self.assertTrue(self.get_occurrence().get('isSubscribed'))
+
+        self.client.logout()
+        self.assertFalse(self.get_occurrence().get('isSubscribed'))
+
+
+class TestCaseFullCalendarConditionalRequests(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.data = {
+            'start': "2020-10-14T00:00:00+02:00",
+            'end': "2020-10-28T00:00:00+01:00",
+        }
+
+    # Unchanged feeds are answered with 304 Not Modified
+    def test_etag(self):
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    # Conditional requests are answered without building the payload (i.e. without expanding activities)
+    def test_not_modified_without_payload(self):
+        etag = self.client.get('/api/calendar/fullcalendar', data=self.data)['ETag']
+
+        with patch('activity_calendar.views.get_cached_fullcalendar_payload', side_effect=AssertionError):
+            response = self.client.get('/api/calendar/fullcalendar', data=self.data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_last_modified(self):
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data)
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data,
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    # Changed feeds are sent again
+    def test_changed(self):
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data)
+
+        activity = Activity.objects.get(title='Weekly activity')
+        activity.title = 'Changed'
+        activity.save()
+
+        response = self.client.get('/api/calendar/fullcalendar', data=self.data, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    # Different timeframes have different ETags
+    def test_different_timeframe(self):
+        etag = self.client.get('/api/calendar/fullcalendar', data=self.data)['ETag']
+        response = self.client.get('/api/calendar/fullcalendar', HTTP_IF_NONE_MATCH=etag, data={
+            'start': "2020-10-28T00:00:00+01:00",
+            'end': "2020-11-04T00:00:00+01:00",
+        })
+        self.assertEqual(response.status_code, 200)
+
+
+class TestCaseFullCalendarCompact(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.data = {
+            'start': "2020-10-14T00:00:00+02:00",
+            'end': "2020-10-28T00:00:00+01:00",
+        }
+
+    def get_content(self, **data):
+        response = self.client.get('/api/calendar/fullcalendar', data={**self.data, **data})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    # The metadata of each activity is only sent once
+    def test_compact(self):
+        content = self.get_content(format='compact')
+        groups = content.get('groups')
+
+        self.assertEqual(set(groups), {'1', '9'})
+        self.assertEqual(groups['1'].get('title'), 'Weekly activity')
+        self.assertEqual(groups['1'].get('recurrenceInfo').get('rrules'), ['weekly, each Tuesday'])
+        self.assertNotIn('description', groups['1'])
+
+        self.assertEqual(len(content.get('activities')), 3)
+        for occurrence in content.get('activities'):
+            self.assertIn(str(occurrence.get('groupId')), groups)
+            self.assertNotIn('title', occurrence)
+            self.assertNotIn('recurrenceInfo', occurrence)
+
+    # Expanding the compact feed results in the normal feed (apart from the descriptions)
+    def test_expanded(self):
+        content = self.get_content(format='compact')
+        expanded = [{**content['groups'][str(occurrence['groupId'])], **occurrence}
+            for occurrence in content.get('activities')]
+
+        activities = self.get_content().get('activities')
+        for activity in activities:
+            del activity['description']
+        self.assertEqual(expanded, activities)
+
+    # Compact and normal feeds have different ETags
+    def test_etag(self):
+        etag = self.client.get('/api/calendar/fullcalendar', data=self.data)['ETag']
+        response = self.client.get('/api/calendar/fullcalendar', data={**self.data, 'format': 'compact'},
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    # Descriptions are obtained separately
+    @suppress_warnings
+    def test_activity_details(self):
+        response = self.client.get('/api/calendar/activities/9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {
+            'groupId': 9,
+            'description': 'Occurs every week, except once during daylight saving time (dst) and once during standard time!',
+        })
+
+        # Only for published activities
+        Activity.objects.filter(id=9).update(published_date=timezone.now() + timedelta(days=200))
+        response = self.client.get('/api/calendar/activities/9')
+        self.assertEqual(response.status_code, 404)
+
+    # Recurrence texts are rendered once per activity and language
+    def test_recurrence_info_cached(self):
+        activity = Activity.objects.get(id=1)
+        recurrence_info = get_recurrence_info(activity)
+
+        activity.recurrences = deserialize_recurrence("RRULE:FREQ=DAILY")
+        self.assertEqual(get_recurrence_info(activity), recurrence_info)
+
+        with translation.override('nl'):
+            self.assertNotEqual(get_recurrence_info(activity), recurrence_info)
+
+        # Changes to activities invalidate the cached texts
+        activity.save()
+        self.assertEqual(get_recurrence_info(activity).get('rrules'), ['daily'])
+
+
+class TestCaseOccurrenceStream(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+
+    def get_lines(self, **data):
+        response = self.client.get('/api/calendar/occurrences', data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['content-type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def get_occurrences(self, lines):
+        return [(line['groupId'], line['start']) for line in lines if line['type'] == 'occurrence']
+
+    # Occurrences in timeframes that are longer than those FullCalendar may request
+    def test_long_range(self):
+        lines = self.get_lines(range="2020-09-01T00:00:00+02:00/2021-03-01T00:00:00+01:00")
+        occurrences = self.get_occurrences(lines)
+
+        # Each activity's metadata is sent once, before its first occurrence
+        groups = [line for line in lines if line['type'] == 'group']
+        self.assertEqual(sorted(group['groupId'] for group in groups), [1, 9])
+        for group in groups:
+            self.assertLess(lines.index(group), next(index for index, line in enumerate(lines)
+                if line['type'] == 'occurrence' and line['groupId'] == group['groupId']))
+        self.assertEqual(groups[0]['title'], 'Weekly activity' if groups[0]['groupId'] == 1 else 'Weekly CEST Event')
+
+        # No occurrence is sent twice (even if it lies on the boundary of two chunks)
+        self.assertEqual(len(occurrences), len(set(occurrences)))
+        self.assertIn((1, '2020-10-20T19:30:00+02:00'), occurrences)
+        self.assertIn((1, '2020-10-27T19:30:00+01:00'), occurrences)
+
+        # Occurrences are the same as those in the FullCalendar feed
+        response = self.client.get('/api/calendar/fullcalendar', data={
+            'start': "2020-10-14T00:00:00+02:00",
+            'end': "2020-10-28T00:00:00+01:00",
+        })
+        expected = [(activity['groupId'], activity['start']) for activity in json.loads(response.content)['activities']]
+        streamed = self.get_occurrences(self.get_lines(start="2020-10-14T00:00:00+02:00", end="2020-10-28T00:00:00+01:00"))
+        self.assertEqual(sorted(streamed), sorted(expected))
+
+    # Multiple (overlapping) ranges can be requested at once
+    def test_multiple_ranges(self):
+        first = self.get_occurrences(self.get_lines(range="2020-10-14T00:00:00+02:00/2020-10-28T00:00:00+01:00"))
+        second = self.get_occurrences(self.get_lines(range="2020-10-21T00:00:00+02:00/2020-11-04T00:00:00+01:00"))
+        both = self.get_occurrences(self.get_lines(range=[
+            "2020-10-21T00:00:00+02:00/2020-11-04T00:00:00+01:00",
+            "2020-10-14T00:00:00+02:00/2020-10-28T00:00:00+01:00",
+        ]))
+        self.assertEqual(sorted(both), sorted(set(first + second)))
+
+    @suppress_warnings
+    def test_invalid_ranges(self):
+        response = self.client.get('/api/calendar/occurrences', data={})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/calendar/occurrences', data={'range': "2020-10-14T00:00:00+02:00"})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/calendar/occurrences', data={
+            'range': "2020-10-28T00:00:00+01:00/2020-10-14T00:00:00+02:00",
+        })
+        self.assertEqual(response.status_code, 400)
+
+    # The number of ranges and the total time they span are limited
+    @suppress_warnings
+    def test_limits(self):
+        response = self.client.get('/api/calendar/occurrences', data={
+            'range': ["2020-10-14T00:00:00+02:00/2020-10-28T00:00:00+01:00"] * (settings.ACTIVITY_OCCURRENCE_STREAM_MAX_RANGES + 1),
+        })
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/api/calendar/occurrences', data={
+            'range': ["2020-01-01T00:00:00+01:00/2021-06-01T00:00:00+02:00", "2021-07-01T00:00:00+02:00/2022-06-01T00:00:00+02:00"],
+        })
+        self.assertEqual(response.status_code, 400)
+
+        # Overlapping ranges count once
+        response = self.client.get('/api/calendar/occurrences', data={
+            'range': ["2020-01-01T00:00:00+01:00/2021-06-01T00:00:00+02:00", "2021-01-01T00:00:00+01:00/2021-12-01T00:00:00+01:00"],
+        })
+        self.assertEqual(response.status_code, 200)
+
+    # The chunks of the stream do not push the FullCalendar feed out of the cache
+    def test_not_cached(self):
+        with patch('activity_calendar.views.cache.set') as cache_set:
+            self.get_lines(range="2020-09-01T00:00:00+02:00/2021-03-01T00:00:00+01:00")
+        keys = [args[0] for args, kwargs in cache_set.call_args_list]
+        self.assertFalse([key for key in keys if key.startswith(('activity_calendar:fullcalendar:',
+            'activity_calendar:subscription_moments:'))])
+
+
+class TestCaseFullCalendarNonRecurring(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def get_titles(self, start, end):
+        response = Client().get('/api/calendar/fullcalendar', data={'start': start, 'end': end})
+        self.assertEqual(response.status_code, 200)
+        return [activity.get('title') for activity in json.loads(response.content).get('activities')]
+
+    # Only non-recurring activities that overlap with the timeframe are shown
+    def test_overlap(self):
+        # Activity is within the timeframe
+        self.assertIn('Single', self.get_titles("2020-08-10T00:00:00+02:00", "2020-08-17T00:00:00+02:00"))
+
+        # Activity ends within the timeframe
+        self.assertIn('Single', self.get_titles("2020-08-14T22:00:00+02:00", "2020-08-17T00:00:00+02:00"))
+
+        # Activity starts within the timeframe
+        self.assertIn('Single', self.get_titles("2020-08-10T00:00:00+02:00", "2020-08-14T22:00:00+02:00"))
+
+        # Activity lies before or after the timeframe
+        self.assertNotIn('Single', self.get_titles("2020-10-12T00:00:00+02:00", "2020-10-19T00:00:00+02:00"))
+        self.assertNotIn('Single', self.get_titles("2020-07-13T00:00:00+02:00", "2020-07-20T00:00:00+02:00"))
+
+    # The stored recurring-flag follows the activity's recurrences
+    def test_recurring_flag(self):
+        self.assertFalse(Activity.objects.get(title='Single').recurring)
+        self.assertTrue(Activity.objects.get(title='Boardgame Evening').recurring)
+
+        activity = Activity.objects.get(title='Single')
+        activity.recurrences = deserialize_recurrence("RRULE:FREQ=WEEKLY;BYDAY=FR")
+        activity.save()
+        self.assertTrue(Activity.objects.get(title='Single').recurring)
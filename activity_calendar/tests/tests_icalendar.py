@@ -1,11 +1,18 @@
 from datetime import timedelta
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
+from django.urls import reverse
 from django.utils import timezone
 
-from activity_calendar.models import Activity
-from activity_calendar.feeds import CESTEventFeed, ExtendedICal20Feed
+from activity_calendar.models import Activity, ActivitySlot, CalendarToken, Participant
+from activity_calendar.feeds import CESTEventFeed, ExtendedICal20Feed, StreamingCESTEventFeed
+from activity_calendar.util import get_vtimezone, generate_vtimezone
+
+from core.models import ExtendedUser as User
+from core.util import suppress_warnings
+from core.tests.util import assertNumCacheCalls
 
 import icalendar
 
@@ -16,6 +23,9 @@ from django_ical.views import ICalFeed
 class TestCaseICalendarExport(TestCase):
     fixtures = ['test_activity_recurrence_dst.json']
 
+    def setUp(self):
+        cache.clear()
+
     # Ensure that only published activities are exported
     def test_only_published(self):
         non_published = Activity.objects.filter(title='Weekly activity').first()
@@ -95,4 +105,263 @@ class TestCaseICalendarExport(TestCase):
                 self.assertEqual(sub["TZOFFSETTO"].to_ical(), "+0100")
             else:
                 self.fail(f"Only STANDARD or DAYLIGHT components must appear in VTIMEZONE. Got <{str(type(sub))}> instead!")
-        
\ No newline at end of file
+        
+
+    # Unchanged feeds are answered with 304 Not Modified
+    def test_conditional_request(self):
+        response = CESTEventFeed()(RequestFactory().get("/api/calendar/ical"))
+        self.assertEqual(response.status_code, 200)
+
+        request = RequestFactory().get("/api/calendar/ical", HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(CESTEventFeed()(request).status_code, 304)
+
+        request = RequestFactory().get("/api/calendar/ical", HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(CESTEventFeed()(request).status_code, 304)
+
+        # Changes result in a new feed
+        activity = Activity.objects.get(title='Weekly activity')
+        activity.title = 'Changed'
+        activity.save()
+
+        request = RequestFactory().get("/api/calendar/ical", HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(CESTEventFeed()(request).status_code, 200)
+
+
+class TestCaseICalendarCache(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def get_response(self):
+        return CESTEventFeed()(RequestFactory().get("/api/calendar/ical"))
+
+    # The feed does not change if the activities do not change
+    def test_deterministic(self):
+        content = self.get_response().content
+        cache.clear()
+        self.assertEqual(self.get_response().content, content)
+
+    # Polls are served from the cache
+    def test_served_from_cache(self):
+        content = self.get_response().content
+
+        # The feed version and the feed itself
+        with self.assertNumQueries(0), assertNumCacheCalls(self, 2):
+            response = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="knights-calendar.ics"')
+
+    # Cached feeds expire, as feeds of older versions would otherwise be kept forever
+    @override_settings(ACTIVITY_CALENDAR_CACHE_TIMEOUT=0)
+    def test_cache_expires(self):
+        self.get_response()
+        cache_key = CESTEventFeed().get_cache_key(RequestFactory().get("/api/calendar/ical"))
+        self.assertIsNone(cache.get(cache_key))
+
+    # The feed is regenerated if an activity changes
+    def test_regenerated_on_change(self):
+        self.get_response()
+
+        activity = Activity.objects.get(title='Weekly activity')
+        activity.title = 'Changed'
+        activity.save()
+
+        calendar = icalendar.Calendar.from_ical(self.get_response().content)
+        titles = [sub["SUMMARY"] for sub in calendar.subcomponents if isinstance(sub, icalendar.cal.Event)]
+        self.assertIn('Changed', titles)
+
+    # The feed is regenerated once a new activity gets published
+    def test_regenerated_on_publish(self):
+        activity = Activity.objects.get(title='Weekly activity')
+        activity.published_date = timezone.now() + timedelta(seconds=1)
+        activity.save()
+        self.assertEqual(len(icalendar.Calendar.from_ical(self.get_response().content).walk('VEVENT')), 1)
+
+        # Pretend that the publish date has passed
+        Activity.objects.filter(id=activity.id).update(published_date=timezone.now() - timedelta(seconds=1))
+        cache_key = CESTEventFeed().get_cache_key(RequestFactory().get("/api/calendar/ical"))
+        cache.set(cache_key, {**cache.get(cache_key), 'valid_until': timezone.now()})
+
+        self.assertEqual(len(icalendar.Calendar.from_ical(self.get_response().content).walk('VEVENT')), 2)
+
+
+class TestCaseICalendarStream(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def get_streamed_response(self, **kwargs):
+        response = StreamingCESTEventFeed()(RequestFactory().get("/api/calendar/ical/stream", **kwargs))
+        self.assertTrue(response.streaming)
+        return response
+
+    # The streamed feed is identical to the normal feed
+    def test_same_content(self):
+        expected = CESTEventFeed()(RequestFactory().get("/api/calendar/ical"))
+
+        response = self.get_streamed_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), expected.content)
+        self.assertEqual(response['Content-Type'], expected['Content-Type'])
+        self.assertEqual(response['Content-Disposition'], expected['Content-Disposition'])
+
+    # Items are built like those of the normal feed, including the attributes that it does not use itself
+    def test_same_items(self):
+        item_categories = lambda feed, item: ["Activity", item.title]
+        expected = type('CategorizedFeed', (CESTEventFeed,), {'item_categories': item_categories})()(
+            RequestFactory().get("/api/calendar/ical"))
+        self.assertIn(b"CATEGORIES:Activity,", expected.content)
+
+        response = type('CategorizedStreamingFeed', (StreamingCESTEventFeed,), {'item_categories': item_categories})()(
+            RequestFactory().get("/api/calendar/ical/stream"))
+        self.assertEqual(b''.join(response.streaming_content), expected.content)
+
+    # Each activity is streamed separately
+    def test_streamed_per_activity(self):
+        chunks = list(self.get_streamed_response().streaming_content)
+        num_activities = Activity.objects.filter(published_date__lte=timezone.now()).count()
+
+        self.assertEqual(len(chunks), num_activities + 2)
+        for chunk in chunks[1:-1]:
+            self.assertTrue(chunk.startswith(b"BEGIN:VEVENT\r\n"))
+            self.assertTrue(chunk.endswith(b"END:VEVENT\r\n"))
+
+    def test_last_modified(self):
+        response = self.get_streamed_response()
+        list(response.streaming_content)
+
+        response = StreamingCESTEventFeed()(RequestFactory().get("/api/calendar/ical/stream",
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']))
+        self.assertEqual(response.status_code, 304)
+
+
+class TestCaseUserRegistrationsFeed(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        # Cached feeds of earlier tests would otherwise be reused
+        cache.clear()
+        self.user = User.objects.get(username='test_admin')
+        self.token = CalendarToken.get_for_user(self.user).token
+
+    def get_response(self, token=None):
+        return self.client.get(reverse('activity_calendar:user_registrations_icalendar',
+            kwargs={'token': token or self.token}))
+
+    def get_events(self):
+        response = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        return icalendar.Calendar.from_ical(response.content).walk('VEVENT')
+
+    @suppress_warnings
+    def test_invalid_token(self):
+        self.assertEqual(self.get_response(token='invalid').status_code, 404)
+
+    # Only occurrences that the user registered for are included (once, even if registered for multiple slots)
+    def test_registered_occurrences(self):
+        events = self.get_events()
+        self.assertEqual(len(events), 1)
+
+        event = events[0]
+        self.assertEqual(event['UID'], 'activity-id-2@kotkt.nl')
+        self.assertEqual(event['RECURRENCE-ID'].to_ical(), b'20200819T160000')
+        self.assertEqual(event['RECURRENCE-ID'].params['TZID'], 'Europe/Amsterdam')
+        self.assertEqual(event['DTSTART'].to_ical(), b'20200819T160000')
+        self.assertNotIn('RRULE', event)
+
+    # Polls are served from the cache (but still need to look up the token)
+    def test_served_from_cache(self):
+        content = self.get_response().content
+
+        # The feed version, the user's registrations version and the feed itself
+        with self.assertNumQueries(1), assertNumCacheCalls(self, 3):
+            response = self.get_response()
+        self.assertEqual(response.content, content)
+
+    # The feed is regenerated if the user's registrations change
+    def test_regenerated_on_change(self):
+        self.get_events()
+
+        ActivitySlot.objects.get(id=1).participants.add(self.user, through_defaults={})
+        events = self.get_events()
+        self.assertEqual(len(events), 2)
+        # Non-recurring activities are not instances of a recurring one
+        self.assertNotIn('RECURRENCE-ID', next(event for event in events if event['UID'] == 'activity-id-1@kotkt.nl'))
+
+        Participant.objects.filter(user=self.user).delete()
+        self.assertEqual(len(self.get_events()), 0)
+
+    # Other users' feeds are not affected
+    def test_other_user(self):
+        other_token = CalendarToken.get_for_user(User.objects.get(username='test_user')).token
+        self.assertEqual(len(icalendar.Calendar.from_ical(self.get_response(other_token).content).walk('VEVENT')), 1)
+
+        ActivitySlot.objects.get(id=1).participants.add(self.user, through_defaults={})
+        self.assertEqual(len(icalendar.Calendar.from_ical(self.get_response(other_token).content).walk('VEVENT')), 1)
+
+    # The feed URL is shown on the calendar page, and can be replaced
+    @suppress_warnings
+    def test_reset_token(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('activity_calendar:activity_collection'))
+        self.assertIn(self.token, response.context['registrations_feed_url'])
+
+        self.client.post(reverse('activity_calendar:reset_calendar_token'))
+        self.assertEqual(self.get_response().status_code, 404)
+        self.assertNotEqual(CalendarToken.get_for_user(self.user).token, self.token)
+
+    # Tokens are only created on request, not by viewing the calendar page
+    def test_create_token(self):
+        user = User.objects.get(username='test_user_alt')
+        self.client.force_login(user)
+        response = self.client.get(reverse('activity_calendar:activity_collection'))
+        self.assertNotIn('registrations_feed_url', response.context)
+        self.assertFalse(CalendarToken.objects.filter(user=user).exists())
+
+        self.client.post(reverse('activity_calendar:reset_calendar_token'))
+        token = CalendarToken.objects.get(user=user).token
+        response = self.client.get(reverse('activity_calendar:activity_collection'))
+        self.assertIn(token, response.context['registrations_feed_url'])
+
+
+class TestCaseVTimezone(TestCase):
+    # VTIMEZONE components are only generated once
+    def test_memoized(self):
+        self.assertIs(get_vtimezone("Europe/Amsterdam", 2020), get_vtimezone("Europe/Amsterdam", 2020))
+        self.assertIsNot(get_vtimezone("Europe/Amsterdam", 2020), get_vtimezone("Europe/Amsterdam", 2021))
+
+    # Regular DST-changes are described by a yearly RRULE
+    def test_rrule(self):
+        vtimezone = get_vtimezone("Europe/Amsterdam", 2020)
+
+        for sub in vtimezone.subcomponents:
+            self.assertNotIn("RDATE", sub)
+            if isinstance(sub, icalendar.cal.TimezoneDaylight):
+                self.assertEqual(sub["RRULE"].to_ical(), b"FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3")
+            else:
+                self.assertEqual(sub["RRULE"].to_ical(), b"FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10")
+
+    # Rules of zones that stopped observing DST end at the last DST-change
+    def test_rrule_until(self):
+        # Moscow abolished DST in 2011
+        vtimezone = generate_vtimezone("Europe/Moscow", timezone.datetime(2005, 1, 1))
+
+        daylight = [sub for sub in vtimezone.subcomponents if isinstance(sub, icalendar.cal.TimezoneDaylight)]
+        self.assertEqual(len(daylight), 1)
+        self.assertEqual(daylight[0]["RRULE"].to_ical(), b"FREQ=YEARLY;UNTIL=20100327T230000Z;BYDAY=-1SU;BYMONTH=3")
+
+    # Irregular DST-changes (not on a fixed weekday) are listed separately
+    def test_rdate(self):
+        # Iranian DST-changes depended on the Persian calendar
+        vtimezone = generate_vtimezone("Asia/Tehran", timezone.datetime(2010, 1, 1), num_years=5)
+
+        for sub in vtimezone.subcomponents:
+            self.assertNotIn("RRULE", sub)
+            self.assertIn("RDATE", sub)
+
+    # UTC does not need a VTIMEZONE
+    def test_utc(self):
+        self.assertIsNone(get_vtimezone("UTC", 2020))
@@ -1,16 +1,23 @@
 from collections import Counter
 from datetime import datetime
+from io import StringIO
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
 from django.core.validators import ValidationError
+from django.db import connection
 from django.conf import settings
 from django.utils.http import urlencode
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from recurrence import Recurrence, deserialize as deserialize_recurrence_test
 
-from activity_calendar.models import Activity, ActivitySlot, Participant
+from activity_calendar.counters import rebuild_statistics, reserve_occurrence_participant, reserve_slot_participant
+from activity_calendar.models import Activity, ActivityOccurrenceStatistics, ActivitySlot, Participant
+from activity_calendar.slots import create_auto_slots, save_numbered_slot
+from activity_calendar.occurrences import compiled_recurrences, CompiledRecurrenceCache, get_local_timezone, normalize_exdates, recurrences_between
 from core.models import ExtendedUser as User
 from .tests_views import next_weekday
 
@@ -30,6 +37,8 @@ class ModelMethodsTest(TestCase):
         
         # Ensure that all dates are in the future (and subscriptions are open)
         ActivitySlot.objects.filter(parent_activity__id=2).update(recurrence_id=self.upcoming_occurence_date)
+        # Queryset updates bypass the (automatically maintained) occurrence statistics
+        rebuild_statistics()
         self.activity = Activity.objects.get(id=2)
         self.simple_activity = Activity.objects.get(id=1)
 
@@ -96,6 +105,7 @@ class ModelMethodsTest(TestCase):
         # Finite slots, no more slots can be created (there are already 5), infinite participants for at least 1 slot
         self.simple_activity.max_participants = -1
         ActivitySlot.objects.exclude(title='Filler').update(max_participants=-1)
+        rebuild_statistics()
         self.assertEqual(self.simple_activity.get_max_num_participants(), -1)
 
         # Finite slots, no more slots can be created (there are already 5), finite participants
@@ -225,3 +235,401 @@ class TestCaseActivityClean(TestCase):
 
         self.base_activity.recurrences = deserialize_recurrence_test("RDATE:19700101T230000Z")
         self.base_activity.clean_fields()
+
+
+# Tests the normalization of EXDATEs when saving activities
+class TestCaseActivityExdates(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        self.activity = Activity.objects.get(title='Weekly CEST Event')
+
+    # EXDATEs (stored at midnight by the widget) are moved to the event's local start time
+    def test_normalized_on_save(self):
+        self.activity.recurrences.exdates = [
+            timezone.get_current_timezone().localize(datetime(2020, 9, 5, 0, 0)),
+            timezone.get_current_timezone().localize(datetime(2020, 12, 5, 0, 0)),
+        ]
+        self.activity.save()
+
+        self.activity.refresh_from_db()
+        self.assertEqual(self.activity.recurrences.exdates, [
+            datetime(2020, 9, 5, 10, 0, tzinfo=timezone.utc),
+            # Winter time
+            datetime(2020, 12, 5, 11, 0, tzinfo=timezone.utc),
+        ])
+
+        # Excluded occurrences (by recurrence id)
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 9, 5, 10, 0, tzinfo=timezone.utc)))
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 12, 5, 10, 0, tzinfo=timezone.utc)))
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 12, 12, 10, 0, tzinfo=timezone.utc)))
+
+    # Normalized EXDATEs remain unchanged
+    def test_normalize_idempotent(self):
+        exdates = self.activity.recurrences.exdates
+        self.assertEqual(normalize_exdates(exdates, self.activity.start_date), exdates)
+
+
+# Tests the stored occurrences of recurring activities
+class TestCaseActivityOccurrenceIndex(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        self.activity = Activity.objects.get(title='Weekly CEST Event')
+
+    # Occurrences are stored when the activity is saved
+    def test_indexed_on_save(self):
+        self.assertIsNotNone(self.activity.occurrences_indexed_until)
+        self.assertGreater(self.activity.occurrences_indexed_until, timezone.now())
+
+        # Stored occurrences must match the expanded occurrences
+        start = datetime(2020, 10, 1, tzinfo=timezone.utc)
+        end = datetime(2020, 12, 1, tzinfo=timezone.utc)
+        stored = list(self.activity.occurrences.filter(recurrence_id__gte=start, recurrence_id__lte=end)
+                .order_by('recurrence_id').values_list('recurrence_id', 'start_date', 'end_date'))
+        self.assertEqual(stored, self.activity.expand_occurrences(start, end))
+
+        # EXDATEs are excluded
+        self.assertFalse(self.activity.occurrences.filter(recurrence_id=datetime(2020, 10, 17, 10, 0, tzinfo=timezone.utc)).exists())
+
+    # Occurrences are regenerated when the recurrence rules change
+    def test_reindexed_on_change(self):
+        self.activity.recurrences = deserialize_recurrence_test("RRULE:FREQ=WEEKLY;BYDAY=SU")
+        self.activity.save()
+
+        self.assertFalse(self.activity.occurrences.filter(recurrence_id=datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)).exists())
+        self.assertTrue(self.activity.occurrences.filter(recurrence_id=datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)).exists())
+
+    # Occurrences are not stored for non-recurring activities
+    def test_non_recurring(self):
+        self.activity.recurrences = deserialize_recurrence_test("")
+        self.activity.save()
+
+        self.assertIsNone(self.activity.occurrences_indexed_until)
+        self.assertFalse(self.activity.occurrences.exists())
+
+    # has_occurence_at works both within and beyond the indexed range
+    def test_has_occurence_at(self):
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)))
+
+        Activity.objects.filter(id=self.activity.id).update(occurrences_indexed_until=None)
+        self.activity.refresh_from_db()
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)))
+
+    # The management command extends the indexed range
+    def test_index_command(self):
+        Activity.objects.filter(id=self.activity.id).update(occurrences_indexed_until=datetime(2020, 9, 1, tzinfo=timezone.utc))
+        self.activity.occurrences.filter(recurrence_id__gt=datetime(2020, 9, 1, tzinfo=timezone.utc)).delete()
+
+        call_command('index_occurrences', stdout=StringIO())
+
+        self.activity.refresh_from_db()
+        self.assertGreater(self.activity.occurrences_indexed_until, timezone.now())
+        self.assertTrue(self.activity.occurrences.filter(recurrence_id=datetime(2020, 10, 24, 10, 0, tzinfo=timezone.utc)).exists())
+
+
+# Tests the in-memory cache of compiled occurrences
+class TestCaseCompiledRecurrenceCache(TestCase):
+    fixtures = ['test_activity_recurrence_dst.json']
+
+    def setUp(self):
+        compiled_recurrences.clear()
+        self.activity = Activity.objects.get(title='Weekly CEST Event')
+
+    # Membership tests do not need the database once compiled
+    def test_has_occurence_at_cached(self):
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 29, 10, 0, tzinfo=timezone.utc)))
+            self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 29, 10, 1, tzinfo=timezone.utc)))
+            # EXDATE
+            self.assertFalse(self.activity.has_occurence_at(datetime(2020, 10, 17, 10, 0, tzinfo=timezone.utc)))
+            # Before the activity's start date
+            self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 8, 10, 0, tzinfo=timezone.utc)))
+
+    # Compiled occurrences are replaced once the activity changes
+    def test_invalidated_on_save(self):
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+
+        self.activity.recurrences = deserialize_recurrence_test("RRULE:FREQ=WEEKLY;BYDAY=SU")
+        self.activity.save()
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)))
+
+    # Compiled occurrences are replaced once the activity is modified, even if it is not saved
+    def test_invalidated_on_change(self):
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+
+        self.activity.recurrences = deserialize_recurrence_test("RRULE:FREQ=WEEKLY;BYDAY=SU")
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 22, 10, 0, tzinfo=timezone.utc)))
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)))
+
+        self.activity.start_date += timezone.timedelta(hours=1)
+        self.assertFalse(self.activity.has_occurence_at(datetime(2020, 8, 23, 10, 0, tzinfo=timezone.utc)))
+        self.assertTrue(self.activity.has_occurence_at(datetime(2020, 8, 23, 11, 0, tzinfo=timezone.utc)))
+
+    # Unsaved activities are cached as well
+    def test_unsaved(self):
+        activity = Activity(title='Unsaved', start_date=self.activity.start_date, end_date=self.activity.end_date,
+            recurrences=self.activity.recurrences)
+        compiled = compiled_recurrences.get(activity)
+        self.assertIs(compiled_recurrences.get(activity), compiled)
+
+    def test_between(self):
+        compiled = compiled_recurrences.get(self.activity)
+        self.assertEqual(compiled.between(datetime(2020, 10, 10, tzinfo=timezone.utc), datetime(2020, 10, 25, tzinfo=timezone.utc)), [
+            datetime(2020, 10, 10, 10, 0, tzinfo=timezone.utc),
+            datetime(2020, 10, 24, 10, 0, tzinfo=timezone.utc),
+        ])
+
+        # Beyond the compiled range
+        self.assertIsNone(compiled.between(timezone.now(), compiled.until + timezone.timedelta(days=1)))
+        self.assertIsNone(compiled.has_occurrence_at(compiled.until + timezone.timedelta(days=1)))
+
+    # Least recently used entries are evicted
+    def test_eviction(self):
+        cache = CompiledRecurrenceCache(max_size=1)
+        other_activity = Activity.objects.get(title='Weekly activity')
+
+        cache.get(self.activity)
+        cache.get(other_activity)
+        self.assertEqual(list(cache.entries.keys()), [cache.get_key(other_activity)])
+
+
+# Tests the window-anchored expansion of recurrences
+class TestCaseRecurrencesBetween(TestCase):
+    def setUp(self):
+        self.dtstart = datetime(2015, 3, 4, 18, 30, tzinfo=timezone.utc)
+        self.after = datetime(2020, 10, 1, tzinfo=timezone.utc)
+        self.before = datetime(2020, 11, 15, tzinfo=timezone.utc)
+
+    def assertSameOccurrences(self, rules):
+        recurrences = deserialize_recurrence_test(rules)
+        expected = recurrences.between(self.after, self.before, dtstart=self.dtstart, inc=True)
+        self.assertEqual(recurrences_between(recurrences, self.after, self.before, self.dtstart), expected)
+        return expected
+
+    def test_anchored_rules(self):
+        self.assertEqual(len(self.assertSameOccurrences("RRULE:FREQ=WEEKLY")), 6)
+        self.assertSameOccurrences("RRULE:FREQ=WEEKLY;INTERVAL=3;BYDAY=MO,SA")
+        self.assertSameOccurrences("RRULE:FREQ=DAILY;INTERVAL=5")
+        self.assertSameOccurrences("RRULE:FREQ=MONTHLY;INTERVAL=2;BYDAY=1FR")
+        self.assertSameOccurrences("RRULE:FREQ=YEARLY;BYMONTH=10,11")
+        self.assertSameOccurrences("RRULE:FREQ=WEEKLY;UNTIL=20201020T000000Z\nEXRULE:FREQ=MONTHLY")
+        self.assertSameOccurrences("RRULE:FREQ=WEEKLY\nEXDATE:20201014T183000Z\nRDATE:20201016T120000Z")
+
+    def test_unanchored_rules(self):
+        # COUNT depends on all earlier occurrences
+        self.assertEqual(self.assertSameOccurrences("RRULE:FREQ=DAILY;COUNT=1900"), [])
+        self.assertSameOccurrences("RRULE:FREQ=WEEKLY;COUNT=300")
+
+        # Not every month has a 31st day
+        self.dtstart = datetime(2015, 1, 31, 18, 30, tzinfo=timezone.utc)
+        self.assertEqual(len(self.assertSameOccurrences("RRULE:FREQ=MONTHLY")), 1)
+
+    # Expanding recurrences of old activities does not iterate all of their earlier occurrences
+    def test_iterations_independent_of_age(self):
+        recurrences = deserialize_recurrence_test("RRULE:FREQ=DAILY")
+        rrule = recurrences.rrules[0]
+        calls = []
+        original = rrule.to_dateutil_rrule
+        rrule.to_dateutil_rrule = lambda dtstart, *args, **kwargs: calls.append(dtstart) or original(dtstart, *args, **kwargs)
+
+        recurrences_between(recurrences, self.after, self.before, self.dtstart)
+        self.assertLessEqual(self.after - calls[0], timezone.timedelta(days=3))
+
+
+# Tests conversions using the cached transitions of a timezone
+class TestCaseLocalTimezone(TestCase):
+    def setUp(self):
+        self.tz = timezone.get_current_timezone()
+        self.local_timezone = get_local_timezone(self.tz)
+
+    def test_localize(self):
+        for naive in [datetime(2020, 7, 1, 14, 0), datetime(2020, 12, 1, 14, 0),
+                # Non-existent and ambiguous wall-clock times
+                datetime(2020, 3, 29, 2, 30), datetime(2020, 10, 25, 2, 30)]:
+            self.assertEqual(str(self.local_timezone.localize(naive)), str(self.tz.localize(naive)))
+
+    def test_localtime(self):
+        for dt in [datetime(2020, 7, 1, 14, 0, tzinfo=timezone.utc), datetime(2020, 10, 25, 0, 30, tzinfo=timezone.utc),
+                datetime(2020, 10, 25, 1, 30, tzinfo=timezone.utc)]:
+            self.assertEqual(str(self.local_timezone.localtime(dt)), str(timezone.localtime(dt)))
+
+    def test_combine(self):
+        # Summer and winter events start at the same wall-clock time
+        summer = self.local_timezone.combine(datetime(2020, 10, 24, 12, 0, tzinfo=timezone.utc), datetime(2020, 1, 1, 14, 0).time())
+        winter = self.local_timezone.combine(datetime(2020, 10, 31, 12, 0, tzinfo=timezone.utc), datetime(2020, 1, 1, 14, 0).time())
+        self.assertEqual(summer, datetime(2020, 10, 24, 12, 0, tzinfo=timezone.utc))
+        self.assertEqual(winter, datetime(2020, 10, 31, 13, 0, tzinfo=timezone.utc))
+
+
+# Tests the automatically maintained slot and participant counters
+class TestCaseOccurrenceStatistics(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='test_user_alt')
+        self.activity = Activity.objects.get(id=2)
+        self.recurrence_id = datetime(2020, 8, 19, 14, 0, tzinfo=timezone.utc)
+
+    def assertStatistics(self, num_slots, num_max_slot_participants, num_participants):
+        statistics = self.activity.get_occurrence_statistics(self.recurrence_id)
+        self.assertEqual(statistics.num_slots, num_slots)
+        self.assertEqual(statistics.num_max_slot_participants, num_max_slot_participants)
+        self.assertEqual(statistics.num_participants, num_participants)
+
+    def test_initial(self):
+        self.assertStatistics(5, -1, 3)
+        self.assertEqual(ActivitySlot.objects.get(id=6).num_participants, 2)
+
+        # Non-recurring activities
+        self.assertEqual(Activity.objects.get(id=1).get_occurrence_statistics().num_slots, 1)
+
+    def test_participants(self):
+        slot = ActivitySlot.objects.get(id=2)
+        slot.participants.add(self.user, through_defaults={})
+        self.assertStatistics(5, -1, 4)
+        self.assertEqual(ActivitySlot.objects.get(id=2).num_participants, 1)
+
+        slot.participants.remove(self.user)
+        self.assertStatistics(5, -1, 3)
+        self.assertEqual(ActivitySlot.objects.get(id=2).num_participants, 0)
+
+        Participant.objects.create(user=self.user, activity_slot=slot)
+        Participant.objects.filter(activity_slot__id=6).delete()
+        self.assertStatistics(5, -1, 2)
+        self.assertEqual(ActivitySlot.objects.get(id=6).num_participants, 0)
+
+    def test_slots(self):
+        ActivitySlot.objects.filter(parent_activity__id=2).exclude(id=6).delete()
+        self.assertStatistics(1, 1, 2)
+
+        slot = ActivitySlot.objects.create(title="New slot", parent_activity=self.activity,
+            recurrence_id=self.recurrence_id, max_participants=3)
+        self.assertStatistics(2, 4, 2)
+
+        # Saving a slot does not overwrite its participant counter
+        slot = ActivitySlot.objects.get(id=6)
+        Participant.objects.create(user=self.user, activity_slot=slot)
+        slot.max_participants = 5
+        slot.save()
+        self.assertStatistics(2, 8, 3)
+        self.assertEqual(ActivitySlot.objects.get(id=6).num_participants, 3)
+
+        # Moving a slot to another occurrence
+        slot.recurrence_id = self.recurrence_id + timezone.timedelta(days=7)
+        slot.save()
+        self.assertStatistics(1, 3, 0)
+
+    def test_rebuild(self):
+        ActivitySlot.objects.update(num_participants=0)
+        ActivityOccurrenceStatistics.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_occurrence_statistics', stdout=out)
+        self.assertStatistics(5, -1, 3)
+        self.assertEqual(ActivitySlot.objects.get(id=6).num_participants, 2)
+
+    def test_remaining_capacity(self):
+        statistics = self.activity.get_occurrence_statistics(self.recurrence_id)
+        self.assertEqual(statistics.get_remaining_capacity(), 27)
+
+        self.activity.max_participants = -1
+        self.assertEqual(statistics.get_remaining_capacity(), -1)
+
+    # Places can only be reserved while the counters are below their limits
+    def test_reserve(self):
+        slot = ActivitySlot.objects.get(id=6)
+        self.assertFalse(reserve_slot_participant(slot))
+        self.assertEqual(ActivitySlot.objects.get(id=6).num_participants, 2)
+
+        slot = ActivitySlot.objects.get(id=2)
+        self.assertTrue(reserve_slot_participant(slot))
+        self.assertEqual(ActivitySlot.objects.get(id=2).num_participants, 1)
+
+        self.assertFalse(reserve_occurrence_participant(slot, 3))
+        self.assertStatistics(5, -1, 3)
+        self.assertTrue(reserve_occurrence_participant(slot, 4))
+        self.assertTrue(reserve_occurrence_participant(slot, -1))
+        self.assertStatistics(5, -1, 5)
+
+# Tests the creation of slots for activities that create their slots automatically
+class TestCaseAutoSlots(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        Activity.objects.filter(id=2).update(slot_creation="CREATION_AUTO")
+        self.activity = Activity.objects.get(id=2)
+        self.after = datetime(2020, 8, 20, 0, 0, tzinfo=timezone.utc)
+        self.recurrence_ids = [datetime(2020, 8, 26, 14, 0, tzinfo=timezone.utc) + timezone.timedelta(days=7 * i)
+            for i in range(3)]
+
+    def get_slot_numbers(self, recurrence_id):
+        return list(ActivitySlot.objects.filter(parent_activity__id=2, recurrence_id=recurrence_id)
+            .order_by('slot_number').values_list('slot_number', 'title'))
+
+    def test_create_auto_slots(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(create_auto_slots([self.activity], 3, num_slots=2, after=self.after), 6)
+        # All slots are inserted at once
+        inserts = [query for query in context.captured_queries
+            if query['sql'].startswith('INSERT') and 'INTO "activity_calendar_activityslot"' in query['sql']]
+        self.assertEqual(len(inserts), 1)
+
+        for recurrence_id in self.recurrence_ids:
+            self.assertEqual(self.get_slot_numbers(recurrence_id), [(1, "Slot 1"), (2, "Slot 2")])
+            self.assertEqual(self.activity.get_num_slots(recurrence_id=recurrence_id), 2)
+        # The next occurrence is left untouched
+        self.assertEqual(self.get_slot_numbers(self.recurrence_ids[-1] + timezone.timedelta(days=7)), [])
+
+    def test_idempotent(self):
+        create_auto_slots([self.activity], 2, after=self.after)
+        self.assertEqual(create_auto_slots([self.activity], 2, after=self.after), 0)
+
+        # Only missing slots are created
+        self.assertEqual(create_auto_slots([self.activity], 3, num_slots=2, after=self.after), 4)
+        for recurrence_id in self.recurrence_ids:
+            self.assertEqual(self.get_slot_numbers(recurrence_id), [(1, "Slot 1"), (2, "Slot 2")])
+
+    # No more slots are created than the activity allows
+    def test_max_slots(self):
+        Activity.objects.filter(id=2).update(max_slots=2)
+        self.activity = Activity.objects.get(id=2)
+        ActivitySlot.objects.create(title="Own slot", parent_activity=self.activity, recurrence_id=self.recurrence_ids[0])
+
+        self.assertEqual(create_auto_slots([self.activity], 2, num_slots=3, after=self.after), 3)
+        self.assertEqual(self.get_slot_numbers(self.recurrence_ids[0]), [(None, "Own slot"), (1, "Slot 1")])
+        self.assertEqual(self.get_slot_numbers(self.recurrence_ids[1]), [(1, "Slot 1"), (2, "Slot 2")])
+
+    def test_skips_other_activities(self):
+        activities = Activity.objects.filter(id__in=[1, 3])
+        self.assertEqual(create_auto_slots(activities, 3, after=self.after), 0)
+
+        # Non-recurring activities have a single occurrence
+        after = datetime(2020, 8, 1, tzinfo=timezone.utc)
+        # (its first slot already exists)
+        self.assertEqual(create_auto_slots(activities, 3, num_slots=2, after=after), 1)
+        self.assertEqual(Activity.objects.get(id=1).get_num_slots(), 2)
+        self.assertEqual(Activity.objects.get(id=3).get_num_slots(), 0)
+
+    def test_save_numbered_slot(self):
+        create_auto_slots([self.activity], 1, after=self.after)
+
+        slot = ActivitySlot(parent_activity=self.activity, recurrence_id=self.recurrence_ids[0])
+        save_numbered_slot(slot)
+        self.assertEqual((slot.slot_number, slot.title), (2, "Slot 2"))
+        self.assertEqual(self.activity.get_num_slots(recurrence_id=self.recurrence_ids[0]), 2)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('create_auto_slots', '2', '--occurrences', '3', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Created 3 slots")
+
+        recurrence_ids = ActivitySlot.objects.filter(parent_activity__id=2, slot_number=1) \
+            .order_by('recurrence_id').values_list('recurrence_id', flat=True)
+        self.assertEqual(len(recurrence_ids), 3)
+        self.assertGreaterEqual(recurrence_ids[0], timezone.now())
@@ -1,13 +1,24 @@
 import datetime
+import json
+from io import StringIO
+from unittest.mock import patch
 
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone, dateparse
 from django.utils.http import urlencode
 
-from activity_calendar.models import ActivitySlot, Activity, Participant
-from core.models import ExtendedUser as User
+from activity_calendar.counters import rebuild_statistics
+from activity_calendar.models import ActivitySlot, Activity, Participant, RegistrationTicket
+from activity_calendar.registration import (register_participant, submit_registration, process_registration_queue,
+    RegistrationError)
+from core.models import ExtendedUser as User, PresetImage
 from core.util import suppress_warnings
+from core.tests.util import assertNumCacheCalls
 
 ##################################################################################
 # Test cases for the activity views
@@ -32,12 +43,15 @@ class ActivityAdminTest(TestCase):
         self.encoded_upcoming_occurence_date = urlencode({'date': self.upcoming_occurence_date.isoformat()})
 
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.user = User.objects.filter(username='test_user').first()
         self.client.force_login(self.user)
         
         # Ensure that all dates are in the future (and subscriptions are open)
         ActivitySlot.objects.filter(parent_activity__id=2).update(recurrence_id=self.upcoming_occurence_date)
+        # Queryset updates bypass the (automatically maintained) occurrence statistics
+        rebuild_statistics()
 
     @suppress_warnings
     def test_get_slots_invalid_dates(self):
@@ -99,6 +113,21 @@ class ActivityAdminTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['num_dummy_slots'], 0)
 
+    # Tests whether automatically created slots are numbered per occurrence
+    def test_auto_slot_numbers(self):
+        # Users can join several slots, and subscriptions are open for the next two occurrences
+        Activity.objects.filter(id=2).update(slot_creation="CREATION_AUTO", max_slots_join_per_participant=-1,
+            subscriptions_open=timezone.timedelta(days=14))
+        url = '/calendar/slots/2?' + urlencode({'date': (self.upcoming_occurence_date + timezone.timedelta(days=7)).isoformat()})
+
+        for slot_number in range(1, 3):
+            response = self.client.post(url, data={})
+            self.assertEqual(response.status_code, 302)
+
+            slot = ActivitySlot.objects.filter(parent_activity__id=2).latest('id')
+            self.assertEqual((slot.slot_number, slot.title), (slot_number, f"Slot {slot_number}"))
+            self.assertEqual(list(slot.participants.all()), [self.user])
+
 
     # Test POST without a correct url
     # Even if the data is invalid, we expect a 400 bad request
@@ -152,6 +181,33 @@ class ActivityAdminTest(TestCase):
                 parent_activity__id=2).first())
     
 
+    # Creating a slot registers the user, so it is subject to the same limits
+    @suppress_warnings
+    def test_post_exceeds_limits(self):
+        url = '/calendar/slots/2?' + self.encoded_upcoming_occurence_date
+        num_slots = ActivitySlot.objects.count()
+
+        # Can only subscribe to at most 1 slot (and the user already joined slot 6)
+        response = self.client.post(url, data={'title': 'My new Slot', 'max_participants': 5})
+        self.assertEqual(response.status_code, 400)
+
+        # Activity 2 allows 2 participants
+        Participant.objects.filter(user=self.user).delete()
+        Activity.objects.filter(id=2).update(max_participants=2)
+        response = self.client.post(url, data={'title': 'My new Slot', 'max_participants': 5})
+        self.assertEqual(response.status_code, 400)
+
+        # Activity 2 allows no more slots
+        num_activity_slots = ActivitySlot.objects.filter(parent_activity__id=2,
+            recurrence_id=self.upcoming_occurence_date).count()
+        Activity.objects.filter(id=2).update(max_participants=-1, max_slots=num_activity_slots)
+        response = self.client.post(url, data={'title': 'My new Slot', 'max_participants': 5})
+        self.assertEqual(response.status_code, 400)
+
+        # No slots were created, and the user did not join any
+        self.assertEqual(ActivitySlot.objects.count(), num_slots)
+        self.assertFalse(Participant.objects.filter(user=self.user).exists())
+
     def test_valid_register(self):
         Participant.objects.filter(user=self.user).delete()
         response = self.client.post('/api/calendar/register/2', data={}, follow=True)
@@ -172,6 +228,106 @@ class ActivityAdminTest(TestCase):
         # Should have a deregister message
         self.assertTrue(response.context['deregister'])
 
+    # The number of queries does not depend on the number of slots and participants
+    def test_get_slots_num_queries(self):
+        url = '/calendar/slots/2?' + self.encoded_upcoming_occurence_date
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        num_queries = len(context.captured_queries)
+
+        # Add slots (with images and owners) and participants
+        activity = Activity.objects.get(id=2)
+        for user in User.objects.all():
+            slot = ActivitySlot.objects.create(title=f"Slot of {user}", parent_activity=activity, owner=user,
+                recurrence_id=self.upcoming_occurence_date, image=PresetImage.objects.first())
+            slot.participants.add(*User.objects.all(), through_defaults={})
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['slot_list']), 8)
+        self.assertEqual(len(context.captured_queries), num_queries)
+
+    # Test registrations that exceed a limit
+    @suppress_warnings
+    def test_invalid_register(self):
+        # Can only subscribe to at most 1 slot
+        response = self.client.post('/api/calendar/register/2', data={})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Cannot subscribe to another slot")
+
+        # Can only subscribe once to each slot
+        Activity.objects.filter(id=2).update(max_slots_join_per_participant=-1)
+        response = self.client.post('/api/calendar/register/6', data={})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Cannot subscribe to the same slot more than once")
+
+        # Slot 6 allows a single participant
+        Participant.objects.filter(user=self.user).delete()
+        response = self.client.post('/api/calendar/register/6', data={})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Slot is full")
+
+        # Activity 2 allows 2 participants
+        Activity.objects.filter(id=2).update(max_participants=2)
+        response = self.client.post('/api/calendar/register/2', data={})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Cannot subscribe")
+        self.assertFalse(Participant.objects.filter(user=self.user).exists())
+
+    # Test (de)registering for slots that do not exist
+    @suppress_warnings
+    def test_nonexistent_slot(self):
+        response = self.client.post('/api/calendar/register/999', data={})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/api/calendar/deregister/999', data={})
+        self.assertEqual(response.status_code, 400)
+
+    # Registrations take a constant number of queries (within a single transaction)
+    def test_register_num_queries(self):
+        Participant.objects.filter(user=self.user).delete()
+
+        # SAVEPOINT, slot, statistics lock, user's registrations, statistics, 2 counter updates, INSERT, RELEASE
+        with self.assertNumQueries(9):
+            register_participant(2, self.user)
+        self.assertTrue(Participant.objects.filter(user=self.user, activity_slot__id=2).exists())
+
+    # Places are reserved by the counter updates, which fail if the slot was filled concurrently
+    @suppress_warnings
+    def test_register_slot_filled_concurrently(self):
+        Participant.objects.filter(user=self.user).delete()
+        num_participants = Activity.objects.get(id=2).get_occurrence_statistics(self.upcoming_occurence_date).num_participants
+
+        with patch('activity_calendar.registration.reserve_slot_participant', return_value=False):
+            with self.assertRaisesMessage(RegistrationError, "Slot is full"):
+                register_participant(2, self.user)
+
+        # The reservation for the activity was rolled back
+        self.assertFalse(Participant.objects.filter(user=self.user).exists())
+        self.assertEqual(Activity.objects.get(id=2).get_occurrence_statistics(self.upcoming_occurence_date).num_participants,
+            num_participants)
+
+    # Users cannot join the same slot twice through concurrent registrations
+    @suppress_warnings
+    def test_register_same_slot_concurrently(self):
+        Participant.objects.filter(user=self.user).delete()
+        num_participants = Activity.objects.get(id=2).get_occurrence_statistics(self.upcoming_occurence_date).num_participants
+
+        # Another registration of the user is created after the user's registrations were counted
+        def register_concurrently(slot):
+            Participant.objects.bulk_create([Participant(user=self.user, activity_slot_id=slot.id)])
+            return True
+
+        with patch('activity_calendar.registration.reserve_slot_participant', side_effect=register_concurrently):
+            with self.assertRaisesMessage(RegistrationError, "Cannot subscribe to the same slot more than once"):
+                register_participant(2, self.user)
+
+        # The reservation was rolled back
+        self.assertEqual(Activity.objects.get(id=2).get_occurrence_statistics(self.upcoming_occurence_date).num_participants,
+            num_participants)
+
     # Test if unauthenticated users are redirected to the login page
     @suppress_warnings
     def test_must_be_authenticated(self):
@@ -190,3 +346,219 @@ class ActivityAdminTest(TestCase):
         })
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, settings.LOGIN_URL + '?' + urlencode({'next': '/calendar/slots/2?' + self.encoded_upcoming_occurence_date}))
+
+
+# Tests the admission queue for registrations
+class TestCaseAdmissionQueue(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.get(username='test_user')
+        self.client.force_login(self.user)
+
+        # Ensure that all dates are in the future (and subscriptions are open)
+        upcoming_occurence_date = next_weekday(timezone.now(), 2).replace(hour=14, minute=0, second=0, microsecond=0)
+        ActivitySlot.objects.filter(parent_activity__id=2).update(recurrence_id=upcoming_occurence_date)
+        rebuild_statistics()
+
+        # Subscriptions opened less than 8 days ago
+        Activity.objects.filter(id=2).update(admission_queue=True, admission_queue_duration=datetime.timedelta(days=8))
+        Participant.objects.filter(activity_slot__id=6).delete()
+
+    def test_queued_registration(self):
+        response = self.client.post('/api/calendar/register/6', data={})
+        self.assertEqual(response.status_code, 302)
+        ticket = RegistrationTicket.objects.get(user=self.user, slot__id=6)
+        self.assertIn(f"ticket={ticket.id}", response.url)
+
+        # Not yet registered
+        self.assertEqual(ticket.status, RegistrationTicket.STATUS_QUEUED)
+        self.assertFalse(Participant.objects.filter(user=self.user).exists())
+
+        # Registering again does not result in another ticket
+        self.client.post('/api/calendar/register/6', data={})
+        self.assertEqual(RegistrationTicket.objects.filter(user=self.user).count(), 1)
+
+        response = self.client.get(f'/api/calendar/tickets/{ticket.id}')
+        self.assertEqual(response.json(), {'status': 'QUEUED', 'position': 1, 'message': ''})
+
+        # The slot page polls the ticket
+        response = self.client.get(
+            f"/calendar/slots/2?{urlencode({'date': ticket.slot.recurrence_id.isoformat(), 'ticket': ticket.id})}")
+        self.assertEqual(response.context['ticket'], ticket)
+
+        self.assertEqual(process_registration_queue(), 1)
+        self.assertTrue(Participant.objects.filter(user=self.user, activity_slot__id=6).exists())
+        response = self.client.get(f'/api/calendar/tickets/{ticket.id}')
+        self.assertEqual(response.json(), {'status': 'ACCEPTED', 'position': None, 'message': ''})
+
+    # Tickets are processed in the order they were created
+    def test_fifo(self):
+        other_user = User.objects.get(username='test_user_alt')
+        first_ticket = submit_registration(6, other_user)[1]
+        second_ticket = submit_registration(6, self.user)[1]
+        self.assertEqual(second_ticket.get_position(), 2)
+
+        out = StringIO()
+        call_command('process_registration_queue', once=True, stdout=out)
+
+        first_ticket.refresh_from_db()
+        second_ticket.refresh_from_db()
+        self.assertEqual(first_ticket.status, RegistrationTicket.STATUS_ACCEPTED)
+        # Slot 6 allows a single participant
+        self.assertEqual(second_ticket.status, RegistrationTicket.STATUS_REJECTED)
+        self.assertEqual(second_ticket.message, "Slot is full")
+
+    # Creating a slot queues the registration of its creator as well
+    def test_create_slot(self):
+        date = ActivitySlot.objects.get(id=6).recurrence_id
+        response = self.client.post('/calendar/slots/2?' + urlencode({'date': date.isoformat()}), data={
+            'title': 'My new Slot',
+            'max_participants': 5,
+        })
+        self.assertEqual(response.status_code, 302)
+        ticket = RegistrationTicket.objects.get(user=self.user, slot__title='My new Slot')
+        self.assertIn(f"ticket={ticket.id}", response.url)
+        self.assertFalse(Participant.objects.filter(user=self.user).exists())
+
+    # The slot is removed if the registration of its creator is rejected
+    def test_create_slot_rejected(self):
+        date = ActivitySlot.objects.get(id=6).recurrence_id
+        self.client.post('/calendar/slots/2?' + urlencode({'date': date.isoformat()}), data={
+            'title': 'My new Slot',
+            'max_participants': 5,
+        })
+        ticket = RegistrationTicket.objects.get(user=self.user, slot__title='My new Slot')
+
+        Activity.objects.filter(id=2).update(max_slots_join_per_participant=0)
+        self.assertEqual(process_registration_queue(), 1)
+        self.assertFalse(ActivitySlot.objects.filter(title='My new Slot').exists())
+
+        # The user can still see why
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.status, RegistrationTicket.STATUS_REJECTED)
+        self.assertEqual(ticket.message, "Cannot subscribe to another slot")
+        self.assertIsNone(ticket.slot)
+
+    # The slot is kept if someone else registered for it in the meantime
+    def test_create_slot_rejected_joined(self):
+        date = ActivitySlot.objects.get(id=6).recurrence_id
+        self.client.post('/calendar/slots/2?' + urlencode({'date': date.isoformat()}), data={
+            'title': 'My new Slot',
+            'max_participants': 5,
+        })
+        slot = ActivitySlot.objects.get(title='My new Slot')
+        submit_registration(slot.id, User.objects.get(username='test_user_alt'))
+
+        # The creator's ticket is processed first
+        Activity.objects.filter(id=2).update(max_slots_join_per_participant=0)
+        self.assertEqual(process_registration_queue(), 2)
+        self.assertTrue(ActivitySlot.objects.filter(id=slot.id).exists())
+
+    # Tickets of removed slots are rejected
+    def test_slot_removed(self):
+        ticket = submit_registration(6, self.user)[1]
+        ActivitySlot.objects.filter(id=6).delete()
+        self.assertEqual(process_registration_queue(), 1)
+
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.status, RegistrationTicket.STATUS_REJECTED)
+        self.assertEqual(ticket.message, "The slot no longer exists")
+
+    # Unexpected errors reject the ticket, without keeping the next tickets from being processed
+    @suppress_warnings
+    def test_unexpected_error(self):
+        first_ticket = submit_registration(6, User.objects.get(username='test_user_alt'))[1]
+        second_ticket = submit_registration(2, self.user)[1]
+
+        with patch('activity_calendar.registration.register_participant', side_effect=[ValueError, None]), \
+                self.assertLogs('activity_calendar.registration', level='ERROR'):
+            self.assertEqual(process_registration_queue(), 2)
+
+        first_ticket.refresh_from_db()
+        second_ticket.refresh_from_db()
+        self.assertEqual(first_ticket.status, RegistrationTicket.STATUS_REJECTED)
+        self.assertEqual(first_ticket.message, "Your registration could not be processed")
+        self.assertEqual(second_ticket.status, RegistrationTicket.STATUS_ACCEPTED)
+
+    # Registrations are processed immediately if the queue is not active
+    def test_inactive_queue(self):
+        Activity.objects.filter(id=2).update(admission_queue_duration=datetime.timedelta(0))
+        response = self.client.post('/api/calendar/register/6', data={})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Participant.objects.filter(user=self.user, activity_slot__id=6).exists())
+        self.assertFalse(RegistrationTicket.objects.exists())
+
+    # Users can only see their own tickets
+    @suppress_warnings
+    def test_ticket_of_other_user(self):
+        ticket = submit_registration(6, User.objects.get(username='test_user_alt'))[1]
+        response = self.client.get(f'/api/calendar/tickets/{ticket.id}')
+        self.assertEqual(response.status_code, 404)
+
+
+# Tests the live updates of the slot page
+class TestCaseSlotEvents(TestCase):
+    fixtures = ['test_users.json', 'test_activity_slots.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.get(username='test_user_alt')
+        self.url = '/api/calendar/slots/2/events?' + urlencode({'date': '2020-08-19T14:00:00+00:00'})
+
+    def get_events(self, **headers):
+        response = self.client.get(self.url, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = response.content.decode()
+        return [event for event in content.split('\n\n') if event.startswith('id: ')]
+
+    def test_events(self):
+        events = self.get_events()
+        self.assertEqual(len(events), 1)
+        event_id, event_type, data = events[0].split('\n')
+        self.assertEqual(event_type, 'event: update')
+
+        state = json.loads(data[len('data: '):])
+        self.assertFalse(state['subscriptionsOpen'])
+        self.assertIn({'id': 6, 'numParticipants': 2, 'maxParticipants': 1}, state['slots'])
+
+        # Nothing changed since the last event; only the versions are looked up
+        with self.assertNumQueries(0), assertNumCacheCalls(self, 1):
+            self.assertEqual(self.get_events(HTTP_LAST_EVENT_ID=event_id[len('id: '):]), [])
+
+        # Participants changed
+        ActivitySlot.objects.get(id=2).participants.add(self.user, through_defaults={})
+        events = self.get_events(HTTP_LAST_EVENT_ID=event_id[len('id: '):])
+        self.assertEqual(len(events), 1)
+        self.assertIn('{"id": 2, "numParticipants": 1, "maxParticipants": -1}', events[0])
+
+    # Changes to the activity itself are pushed as well
+    def test_activity_changed(self):
+        event_id = self.get_events()[0].split('\n')[0][len('id: '):]
+        activity = Activity.objects.get(id=2)
+        activity.subscriptions_open = datetime.timedelta(days=1000)
+        activity.save()
+        self.assertEqual(len(self.get_events(HTTP_LAST_EVENT_ID=event_id)), 1)
+
+    # An update is pushed once subscriptions open
+    def test_subscriptions_opened(self):
+        with patch('django.utils.timezone.now', return_value=dateparse.parse_datetime('2020-08-10T14:00:00+00:00')):
+            events = self.get_events()
+        self.assertIn('"subscriptionsOpen": false', events[0])
+        event_id = events[0].split('\n')[0][len('id: '):]
+
+        with patch('django.utils.timezone.now', return_value=dateparse.parse_datetime('2020-08-11T14:00:00+00:00')):
+            self.assertEqual(self.get_events(HTTP_LAST_EVENT_ID=event_id), [])
+        with patch('django.utils.timezone.now', return_value=dateparse.parse_datetime('2020-08-15T14:00:00+00:00')):
+            events = self.get_events(HTTP_LAST_EVENT_ID=event_id)
+        self.assertEqual(len(events), 1)
+        self.assertIn('"subscriptionsOpen": true', events[0])
+
+    @suppress_warnings
+    def test_invalid_occurrence(self):
+        response = self.client.get('/api/calendar/slots/2/events?date=2020-08-20T14:00:00%2B00:00')
+        self.assertEqual(response.status_code, 404)
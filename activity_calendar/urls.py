@@ -1,13 +1,20 @@
 from django.urls import path
 from . import views
-from .feeds import CESTEventFeed
+from .feeds import CESTEventFeed, StreamingCESTEventFeed, UserRegistrationsFeed
 
 urlpatterns = [
     path('calendar/slots/<int:activity_id>', views.ActivitySlotList.as_view(), name='activity_slots_on_day'),
     path('calendar/google_html', views.googlehtml_activity_collection, name='googlehtml_activity_collection'),
     path('calendar', views.activity_collection, name='activity_collection'),
     path('api/calendar/ical', CESTEventFeed(), name='icalendar'),
+    path('api/calendar/ical/stream', StreamingCESTEventFeed(), name='icalendar_stream'),
+    path('api/calendar/ical/registrations/<str:token>', UserRegistrationsFeed(), name='user_registrations_icalendar'),
+    path('calendar/token/reset', views.reset_calendar_token, name='reset_calendar_token'),
     path('api/calendar/fullcalendar', views.fullcalendar_feed, name='fullcalendar_feed'),
+    path('api/calendar/activities/<int:activity_id>', views.activity_details, name='activity_details'),
+    path('api/calendar/occurrences', views.occurrence_stream, name='occurrence_stream'),
     path('api/calendar/register/<int:slot_id>', views.register, name='activity_register'),
     path('api/calendar/deregister/<int:slot_id>', views.deregister, name='activity_deregister'),
+    path('api/calendar/slots/<int:activity_id>/events', views.slot_events, name='activity_slot_events'),
+    path('api/calendar/tickets/<int:ticket_id>', views.registration_ticket_status, name='registration_ticket_status'),
 ]
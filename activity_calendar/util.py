@@ -1,7 +1,115 @@
+from django.core.cache import cache
+from django.db.models import Count, Max
 from django.utils.timezone import pytz
 from django.utils.timezone import now
+from functools import lru_cache
+import calendar
 import icalendar
 import datetime
+import uuid
+
+from .models import Activity
+
+# Cache keys under which the version of the calendar data, and the moment at which it was last changed, are stored
+CALENDAR_VERSION_CACHE_KEY = 'activity_calendar:version'
+CALENDAR_LAST_MODIFIED_CACHE_KEY = 'activity_calendar:last_modified'
+
+# Cache key under which the version of the activities (excluding their slots and participants) is stored
+ACTIVITY_VERSION_CACHE_KEY = 'activity_calendar:activity_version'
+
+# Versions are random tokens rather than counters. Incrementing is not atomic in every cache backend
+# (e.g. the database cache), so concurrent increments could otherwise end up with the same version.
+# This also ensures that versions from before a cache eviction are never reused
+def _new_version():
+    return uuid.uuid4().hex
+
+# The versions are shared by all worker processes through the (shared) cache, see CACHES in the settings
+def _get_version(cache_key):
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, _new_version(), None)
+        version = cache.get(cache_key)
+    return version
+
+def _bump_version(cache_key):
+    cache.set(cache_key, _new_version(), None)
+
+# Obtains the version of the calendar data (activities, slots and participants)
+# Cached data derived from the calendar should include this version in its cache key
+def get_calendar_version():
+    return _get_version(CALENDAR_VERSION_CACHE_KEY)
+
+# Invalidates all cached data derived from the calendar
+def bump_calendar_version():
+    cache.set(CALENDAR_LAST_MODIFIED_CACHE_KEY, now(), None)
+    _bump_version(CALENDAR_VERSION_CACHE_KEY)
+
+# Obtains the version of the activities. Unlike the calendar version, this version
+# does not change if only slots or participants change
+def get_activity_version():
+    return _get_version(ACTIVITY_VERSION_CACHE_KEY)
+
+# Invalidates all cached data derived from the activities
+def bump_activity_version():
+    _bump_version(ACTIVITY_VERSION_CACHE_KEY)
+
+# Cache key under which the version of the slots and participants of an occurrence is stored
+def get_occurrence_version_cache_key(activity_id, recurrence_id):
+    # Recurrence ids may be passed in different timezones
+    recurrence_key = int(recurrence_id.timestamp()) if recurrence_id is not None else ''
+    return f'activity_calendar:occurrence_version:{activity_id}:{recurrence_key}'
+
+# Obtains the version of the slots and participants of an occurrence (its recurrence_id is None if the
+# activity is non-recurring). This allows clients to detect changes without querying the database
+def get_occurrence_version(activity_id, recurrence_id):
+    return _get_version(get_occurrence_version_cache_key(activity_id, recurrence_id))
+
+# Notifies clients that the slots or participants of an occurrence changed
+def bump_occurrence_version(activity_id, recurrence_id):
+    _bump_version(get_occurrence_version_cache_key(activity_id, recurrence_id))
+
+# Cache key under which the version of the registrations of a user is stored
+def get_user_registrations_version_cache_key(user_id):
+    return f'activity_calendar:registrations_version:{user_id}'
+
+# Obtains the version of the registrations (participations) of a user
+# Cached data derived from a user's registrations should include this version in its cache key
+def get_user_registrations_version(user_id):
+    return _get_version(get_user_registrations_version_cache_key(user_id))
+
+# Invalidates all cached data derived from the registrations of the user
+def bump_user_registrations_version(user_id):
+    _bump_version(get_user_registrations_version_cache_key(user_id))
+
+# Obtains the moment at which the calendar data (activities, slots and participants) was last changed
+def get_calendar_last_modified():
+    last_modified = cache.get(CALENDAR_LAST_MODIFIED_CACHE_KEY)
+    if last_modified is None:
+        # Not cached (anymore); assume that it changed just now
+        last_modified = now()
+        cache.add(CALENDAR_LAST_MODIFIED_CACHE_KEY, last_modified, None)
+    return last_modified
+
+# Obtains validators for conditional requests on data derived from the published calendar, as a
+# (last modified, version string)-tuple. The version string changes whenever the calendar data changes.
+def get_calendar_validators():
+    # Activities can also change without firing signals (e.g. through QuerySet.update), and become
+    # visible once they are published
+    info = Activity.objects.filter(published_date__lte=now()).aggregate(
+            last_updated=Max('last_updated_date'), last_published=Max('published_date'), num_activities=Count('id'))
+
+    last_modified = max(filter(None, [info['last_updated'], info['last_published'], get_calendar_last_modified()]))
+    version = f"{get_calendar_version()}:{info['num_activities']}:{last_modified.timestamp()}"
+    return last_modified, version
+
+# Obtains a VTIMEZONE component for the given timezone, starting at the given year
+# Components are generated only once per process, and must therefore not be modified
+@lru_cache(maxsize=None)
+def get_vtimezone(timezone, start_year, num_years=None):
+    vtimezone = generate_vtimezone(timezone, datetime.datetime(start_year, 1, 1), num_years)
+    if vtimezone is not None:
+        vtimezone.add('x-lic-location', timezone)
+    return vtimezone
 
 # Based on: https://djangosnippets.org/snippets/10569/
 def generate_vtimezone(timezone, for_date=None, num_years=None):
@@ -36,59 +144,76 @@ def _vtimezone_without_dst(std, timezone):
     return vtimezone
 
 def _vtimezone_with_dst(tzswitches, timezone):
-    daylight = []
-    standard = []
-
-    prev_prev_transition_info = None
-    prev_prev_component = None
-    prev_component = None
+    # Onsets (in local time) of each kind of DST-change, keyed by
+    # (is_dst, tzoffsetfrom, tzoffsetto, tzname) in order of first appearance
+    onsets = {}
     _, prev_transition_info = next(tzswitches, None)
 
     if prev_transition_info is not None:
-        
         for (transition_time, transition_info) in tzswitches:
             utc_offset, dst_offset, tz_name = transition_info
 
             # utc-offset of the previous component
             prev_utc_offset = prev_transition_info[0]
 
-            if prev_prev_component is not None and transition_info == prev_prev_transition_info:
-                # DST-change is the same as earlier; merge the components rather than creating a new one!
-                prev_prev_component.add('rdate', transition_time + prev_utc_offset)
+            # DST-changes that are the same as earlier ones are merged into the same component
+            key = (dst_offset.total_seconds() != 0, prev_utc_offset, utc_offset, tz_name)
+            onsets.setdefault(key, []).append(transition_time + prev_utc_offset)
 
-                # Swap prev_prev and prev components
-                temp_component = prev_component
-                prev_component = prev_prev_component
-                prev_prev_component = temp_component
-            else:
-                component = None
-                lst = None
-                is_dst = dst_offset.total_seconds() != 0
-
-                if is_dst:
-                    component = icalendar.TimezoneDaylight()
-                    lst = daylight
-                else:
-                    component = icalendar.TimezoneStandard()
-                    lst = standard
-
-                component.add('dtstart', transition_time + prev_utc_offset)
-                component.add('rdate', transition_time + prev_utc_offset)
-                component.add('tzoffsetfrom', prev_utc_offset)
-                component.add('tzoffsetto', utc_offset)
-                component.add('tzname', tz_name)
-
-                lst.append(component)
-                prev_prev_component = prev_component
-                prev_component = component
-
-            prev_prev_transition_info = prev_transition_info
             prev_transition_info = transition_info
+            last_transition_year = transition_time.year
 
         # Create timezone component, and add all standard/dst components to it
         vtimezone = icalendar.Timezone(tzid=timezone)
-        for d in daylight:
-            vtimezone.add_component(d)
-        for s in standard:
-            vtimezone.add_component(s)
+        daylight = [key for key in onsets if key[0]]
+        standard = [key for key in onsets if not key[0]]
+        for key in daylight + standard:
+            is_dst, prev_utc_offset, utc_offset, tz_name = key
+            component = icalendar.TimezoneDaylight() if is_dst else icalendar.TimezoneStandard()
+
+            component.add('dtstart', onsets[key][0])
+            rrule = _yearly_rrule(onsets[key])
+            if rrule is not None:
+                # The rule stops if the zone stopped making this change (e.g. abolished DST) before
+                # the end of its transitions. Such an UNTIL must be specified in UTC
+                if onsets[key][-1].year < last_transition_year:
+                    rrule['until'] = pytz.utc.localize(onsets[key][-1] - prev_utc_offset)
+                # Describe the onsets by a single rule rather than listing them all
+                component.add('rrule', rrule)
+            else:
+                for onset in onsets[key]:
+                    component.add('rdate', onset)
+            component.add('tzoffsetfrom', prev_utc_offset)
+            component.add('tzoffsetto', utc_offset)
+            component.add('tzname', tz_name)
+
+            vtimezone.add_component(component)
         return vtimezone
+
+# Obtains a yearly RRULE (e.g. the last sunday of March) that generates exactly the given onsets,
+# or None if no such rule exists
+def _yearly_rrule(onsets):
+    if len(onsets) < 2:
+        return None
+
+    first = onsets[0]
+    for year_offset, onset in enumerate(onsets):
+        # Onsets must occur every year, in the same month, on the same weekday and time
+        if onset.year != first.year + year_offset or onset.month != first.month \
+                or onset.weekday() != first.weekday() or onset.time() != first.time():
+            return None
+
+    # E.g. the 2nd sunday of a month
+    nths = {(onset.day - 1) // 7 + 1 for onset in onsets}
+    # E.g. the last sunday of a month
+    is_last = all(onset.day + 7 > calendar.monthrange(onset.year, onset.month)[1] for onset in onsets)
+
+    if is_last:
+        nth = -1
+    elif len(nths) == 1:
+        nth = nths.pop()
+    else:
+        return None
+
+    weekday = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU'][first.weekday()]
+    return {'freq': 'yearly', 'bymonth': first.month, 'byday': f'{nth}{weekday}'}
@@ -1,21 +1,35 @@
-from datetime import datetime
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import hashlib
+import json
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Exists, OuterRef, Sum, Count
-from django.http import (JsonResponse, HttpResponseBadRequest, HttpResponse,
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef, Sum
+from django.http import (JsonResponse, HttpResponseBadRequest, HttpResponse, StreamingHttpResponse,
         HttpResponseRedirect, HttpResponseNotFound, HttpResponseNotAllowed, HttpResponseForbidden)
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 from django.utils import timezone, dateparse
-from django.utils.http import urlencode
+from django.utils.http import http_date, quote_etag, urlencode
+from django.utils.translation import get_language
 from django.utils.decorators import method_decorator
 
-from django.views.decorators.http import require_safe, require_POST
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_safe, require_POST, condition
 from django.views.generic import DetailView
 
 from .forms import ActivitySlotForm
-from .models import Activity, Participant, ActivitySlot
-from core.models import ExtendedUser, PresetImage
+from .models import (Activity, ActivityOccurrence, ActivityOccurrenceStatistics, Participant, ActivitySlot,
+        RegistrationTicket, CalendarToken)
+from .registration import submit_registration, deregister_participant, RegistrationError
+from .slots import save_numbered_slot
+from .util import (get_activity_version, get_calendar_version, get_calendar_validators, get_occurrence_version,
+        get_occurrence_version_cache_key, ACTIVITY_VERSION_CACHE_KEY)
+from core.models import PresetImage
 
 # Renders the simple v1 calendar
 @require_safe
@@ -25,166 +39,554 @@ def googlehtml_activity_collection(request):
 # Renders the calendar page, which utilises FullCalendar
 @require_safe
 def activity_collection(request):
-    return render(request, 'activity_calendar/fullcalendar.html', {})
-
-# The view that is accessed by FullCalendar to retrieve events
-def get_activity_json(activity, start, end, user):
-    activity_participants = activity.get_subscribed_participants(start)
-    max_activity_participants = activity.get_max_num_participants(start)
+    context = {}
+    if request.user.is_authenticated:
+        # The (secret) URL of the calendar feed of the user's registrations, if they requested one
+        # NB: Tokens are only created through reset_calendar_token, so that rendering this page does not write
+        token = CalendarToken.objects.filter(user__id=request.user.id).values_list('token', flat=True).first()
+        if token is not None:
+            context['registrations_feed_url'] = request.build_absolute_uri(
+                reverse('activity_calendar:user_registrations_icalendar', kwargs={'token': token}))
+    return render(request, 'activity_calendar/fullcalendar.html', context)
+
+# Creates the token in the URL of the calendar feed of the user's registrations, or replaces it
+# so that anyone who obtained the previous URL can no longer see them
+@require_POST
+@login_required
+def reset_calendar_token(request):
+    token, created = CalendarToken.objects.get_or_create(user_id=request.user.id)
+    if not created:
+        token.reset()
+    return redirect(reverse('activity_calendar:activity_collection'))
+
+# The key of an occurrence of an activity
+# Non-recurring activities only have a single occurrence, and do not have a recurrence id
+def get_occurrence_key(activity, start):
+    return (activity.id, start if activity.is_recurring else None)
+
+# Obtains a filter for the slots belonging to the occurrences with the given keys
+# activity_field is the name of the field that refers to the activity
+def get_occurrence_slot_filter(keys, activity_field='parent_activity'):
+    non_recurring_ids = {activity_id for activity_id, recurrence_id in keys if recurrence_id is None}
+    recurring_ids = {activity_id for activity_id, recurrence_id in keys if recurrence_id is not None}
+    recurrence_ids = [recurrence_id for _, recurrence_id in keys if recurrence_id is not None]
+
+    slot_filter = Q(**{f'{activity_field}__id__in': non_recurring_ids})
+    if recurrence_ids:
+        slot_filter |= Q(**{f'{activity_field}__id__in': recurring_ids,
+                'recurrence_id__range': (min(recurrence_ids), max(recurrence_ids))})
+    return slot_filter
+
+# Obtains the key (see get_occurrence_key) of the occurrence that a slot belongs to, or None if
+# that occurrence is not part of the given keys
+def get_slot_occurrence_key(keys, activity_id, recurrence_id):
+    if (activity_id, None) in keys:
+        return (activity_id, None)
+    if (activity_id, recurrence_id) in keys:
+        return (activity_id, recurrence_id)
+    return None
+
+# Obtains participant and slot statistics of the occurrences with the given keys.
+# This is done using a single query, regardless of the number of occurrences.
+# Returns a dictionary with the occurrence keys as keys
+def get_occurrence_statistics(keys):
+    keys = set(keys)
+    statistics = {key: {
+            'num_slots': 0,
+            'num_max_slot_participants': 0,
+            'num_participants': 0,
+        } for key in keys}
+    if not keys:
+        return statistics
+
+    # The statistics are kept up to date automatically
+    occurrence_statistics = ActivityOccurrenceStatistics.objects.filter(
+            get_occurrence_slot_filter(keys, activity_field='activity')) \
+            .values('activity_id', 'recurrence_id', 'num_slots', 'num_max_slot_participants', 'num_participants')
+    for info in occurrence_statistics:
+        key = get_slot_occurrence_key(keys, info['activity_id'], info['recurrence_id'])
+        if key is None:
+            continue
+        stats = statistics[key]
+        stats['num_slots'] += info['num_slots']
+        stats['num_participants'] += info['num_participants']
+        if info['num_max_slot_participants'] == -1 or stats['num_max_slot_participants'] == -1:
+            # At least one slot allows for infinite participants
+            stats['num_max_slot_participants'] = -1
+        else:
+            stats['num_max_slot_participants'] += info['num_max_slot_participants']
+
+    return statistics
+
+# Obtains the keys of the occurrences (out of the given keys) that the user is subscribed to
+def get_user_subscribed_occurrences(keys, user):
+    keys = set(keys)
+    if user.is_anonymous or not keys:
+        return set()
+
+    user_subscriptions = Participant.objects.filter(user__id=user.id,
+            activity_slot__in=ActivitySlot.objects.filter(get_occurrence_slot_filter(keys))) \
+            .values_list('activity_slot__parent_activity_id', 'activity_slot__recurrence_id').distinct()
+
+    subscribed = set()
+    for activity_id, recurrence_id in user_subscriptions:
+        key = get_slot_occurrence_key(keys, activity_id, recurrence_id)
+        if key is not None:
+            subscribed.add(key)
+    return subscribed
+
+# Obtains the human-readable recurrence information of an activity, in the active language
+# Rendering these texts is relatively expensive, so they are cached per activity and language
+def get_recurrence_info(activity):
+    cache_key = f"activity_calendar:recurrence_info:{get_activity_version()}:{activity.id}:{get_language()}"
+    recurrence_info = cache.get(cache_key)
+    if recurrence_info is None:
+        recurrence_info = {
+            'rrules': [rule.to_text() for rule in activity.recurrences.rrules],
+            'exrules': [rule.to_text() for rule in activity.recurrences.exrules],
+            'rdates': [occ.date().strftime("%A, %B %d, %Y") for occ in activity.recurrences.rdates],
+            'exdates': [occ.date().strftime("%A, %B %d, %Y") for occ in activity.recurrences.exdates],
+        }
+        cache.set(cache_key, recurrence_info, settings.ACTIVITY_CALENDAR_CACHE_TIMEOUT)
+    return recurrence_info
 
+# The metadata of an activity that is the same for each of its occurrences
+def get_activity_group_json(activity):
     return {
-        'groupId': activity.id,
         'title': activity.title,
         'description': activity.description,
         'location': activity.location,
-        'recurrenceInfo': {
-            'rrules': [rule.to_text() for rule in activity.recurrences.rrules],
-            'exrules': [rule.to_text() for rule in activity.recurrences.exrules],
-            'rdates': [occ.date().strftime("%A, %B %d, %Y") for occ in activity.recurrences.rdates],
-            'exdates': [occ.date().strftime("%A, %B %d, %Y") for occ in activity.recurrences.exdates],
-        },
+        'recurrenceInfo': get_recurrence_info(activity),
         'subscriptionsRequired': activity.subscriptions_required,
-        'numParticipants': activity_participants.count(),
+        'allDay': False,
+    }
+
+# The data of a single occurrence of an activity (excluding its metadata; see get_activity_group_json)
+def get_occurrence_json(activity, start, end, user, statistics, is_subscribed=False):
+    max_activity_participants = activity.get_max_num_participants(start,
+            num_slots=statistics['num_slots'], num_max_slot_participants=statistics['num_max_slot_participants'])
+
+    return {
+        'groupId': activity.id,
+        'numParticipants': statistics['num_participants'],
         'maxParticipants': max_activity_participants,
-        'isSubscribed': activity.is_user_subscribed(user, start,
-                participants=activity_participants),
+        'isSubscribed': is_subscribed,
         'canSubscribe': activity.can_user_subscribe(user, start,
-                participants=activity_participants, max_participants=max_activity_participants),
+                num_participants=statistics['num_participants'], max_participants=max_activity_participants),
         'start': start.isoformat(),
         'end': end.isoformat(),
-        'allDay': False,
     }
 
-@require_safe
-def fullcalendar_feed(request):
+# The view that is accessed by FullCalendar to retrieve events
+def get_activity_json(activity, start, end, user, statistics, is_subscribed=False):
+    return {
+        **get_activity_group_json(activity),
+        **get_occurrence_json(activity, start, end, user, statistics, is_subscribed=is_subscribed),
+    }
+
+# Obtains all (activity, start, end)-occurrences of published activities in the given timeframe
+def get_occurrences(start_date, end_date):
+    occurrences = []
+
+    # Obtain non-recurring activities that overlap with the timeframe
+    non_recurring_activities = Activity.objects.filter(recurring=False, published_date__lte=timezone.now(),
+            start_date__lte=end_date, end_date__gte=start_date)
+    
+    for non_recurring_activity in non_recurring_activities:
+        occurrences.append((
+            non_recurring_activity,
+            non_recurring_activity.start_date,
+            non_recurring_activity.end_date,
+        ))
+
+    # Obtain occurrences of recurring activities in the relevant timeframe
+    # Use the stored occurrences of activities that are indexed beyond the requested timeframe
+    indexed_occurrences = ActivityOccurrence.objects.filter(
+            activity__published_date__lte=timezone.now(), activity__occurrences_indexed_until__gte=end_date,
+            recurrence_id__gte=start_date, recurrence_id__lte=end_date).select_related('activity')
+
+    for occurrence in indexed_occurrences:
+        occurrences.append((
+            occurrence.activity,
+            timezone.localtime(occurrence.start_date),
+            timezone.localtime(occurrence.end_date),
+        ))
+
+    # Other recurring activities need to be expanded on the fly
+    unindexed_recurring_activities = Activity.objects.filter(recurring=True, published_date__lte=timezone.now()) \
+            .filter(Q(occurrences_indexed_until__isnull=True) | Q(occurrences_indexed_until__lt=end_date))
+
+    for recurring_activity in unindexed_recurring_activities:
+        for _, occurence_start, occurence_end in recurring_activity.expand_occurrences(start_date, end_date):
+            occurrences.append((recurring_activity, occurence_start, occurence_end))
+
+    return occurrences
+
+# Builds the part of the FullCalendar feed that is the same for every user, i.e. the activities as
+# they are shown to anonymous users. Also includes the (occurrence key, subscriptions open,
+# subscriptions close)-information needed to personalise these activities (see apply_user_overlay)
+def get_fullcalendar_payload(start_date, end_date):
+    occurrences = get_occurrences(start_date, end_date)
+
+    # Participant and slot information of all occurrences is obtained at once
+    statistics = get_occurrence_statistics([get_occurrence_key(activity, start) for activity, start, _ in occurrences])
+
+    # The metadata of each activity is only included once, rather than for each of its occurrences
+    groups = {}
+    activities = []
+    overlay = []
+    for activity, start, end in occurrences:
+        if activity.id not in groups:
+            groups[activity.id] = get_activity_group_json(activity)
+
+        key = get_occurrence_key(activity, start)
+        activities.append(get_occurrence_json(activity, start, end, AnonymousUser(), statistics[key]))
+
+        recurrence_id = start if activity.is_recurring else activity.start_date
+        overlay.append((key, recurrence_id - activity.subscriptions_open, recurrence_id - activity.subscriptions_close))
+
+    return {'groups': groups, 'activities': activities, 'overlay': overlay}
+
+# Cache key under which the (sorted) moments at which subscriptions open or close for the occurrences
+# in the timeframe are stored. These only depend on the activities, not on their slots or participants
+def get_subscription_moments_cache_key(start_date, end_date):
+    return f"activity_calendar:subscription_moments:{get_activity_version()}:" \
+            f"{start_date.isoformat()}:{end_date.isoformat()}"
+
+# Obtains the FullCalendar feed payload from the cache, or builds it if it is not cached (anymore)
+# Cached payloads are invalidated whenever calendar data changes (see get_calendar_version)
+def get_cached_fullcalendar_payload(start_date, end_date):
+    cache_key = f"activity_calendar:fullcalendar:{get_calendar_version()}:{get_language()}:" \
+            f"{start_date.isoformat()}:{end_date.isoformat()}"
+    payload = cache.get(cache_key)
+    if payload is None:
+        payload = get_fullcalendar_payload(start_date, end_date)
+        cache.set(cache_key, payload, settings.ACTIVITY_CALENDAR_CACHE_TIMEOUT)
+
+        # Allows conditional requests to be answered without building the payload (see get_fullcalendar_validators)
+        moments = sorted(moment for _, subscriptions_open, subscriptions_close in payload['overlay']
+                for moment in (subscriptions_open, subscriptions_close))
+        cache.set(get_subscription_moments_cache_key(start_date, end_date), moments,
+                settings.ACTIVITY_CALENDAR_CACHE_TIMEOUT)
+    return payload
+
+# Personalises the occurrences in the payload (see get_fullcalendar_payload) for a given user
+def apply_user_overlay(payload, user):
+    if user.is_anonymous:
+        # The payload is already built for anonymous users
+        return payload['activities']
+
+    subscribed = get_user_subscribed_occurrences([key for key, _, _ in payload['overlay']], user)
+    now = timezone.now()
+
+    activities = []
+    for activity_json, (key, subscriptions_open, subscriptions_close) in zip(payload['activities'], payload['overlay']):
+        max_participants = activity_json['maxParticipants']
+        activities.append({
+            **activity_json,
+            'isSubscribed': key in subscribed,
+            # See Activity.can_user_subscribe
+            'canSubscribe': subscriptions_open <= now and now <= subscriptions_close \
+                and (max_participants == -1 or activity_json['numParticipants'] < max_participants),
+        })
+    return activities
+
+# Obtains the timeframe requested by FullCalendar
+# Raises a ValueError if the timeframe is missing or invalid
+def get_fullcalendar_timeframe(request):
     start_date = request.GET.get('start', None)
     end_date = request.GET.get('end', None)
 
     # Start and end dates should be provided
     if start_date is None or end_date is None:
-        return HttpResponseBadRequest("start and end date must be provided")
+        raise ValueError("start and end date must be provided")
 
     # Start and end dates should be provided in ISO format
     try: 
         start_date = datetime.fromisoformat(start_date)
         end_date = datetime.fromisoformat(end_date)
     except ValueError:
-        return HttpResponseBadRequest("start and end date must be in yyyy-mm-ddThh:mm:ss+hh:mm format")
+        raise ValueError("start and end date must be in yyyy-mm-ddThh:mm:ss+hh:mm format")
     
     # Start and end dates cannot differ more than a 'month' (7 days, 6 weeks)
     if (end_date - start_date).days > 42:
-        return HttpResponseBadRequest("start and end date cannot differ more than 42 days")
+        raise ValueError("start and end date cannot differ more than 42 days")
+
+    return start_date, end_date
+
+# Whether FullCalendar requested the compact feed, which includes the metadata of each activity only once
+def is_compact_fullcalendar_request(request):
+    return request.GET.get('format', None) == 'compact'
+
+# Obtains the (last modified, ETag)-validators of the FullCalendar feed for the given request,
+# or (None, None) if the request is invalid or the validators are unknown. The validators are obtained
+# without expanding any activities, so that conditional requests can be answered cheaply. If they are
+# unknown, the full response is sent (which makes them known for subsequent requests)
+def get_fullcalendar_validators(request):
+    if not hasattr(request, '_fullcalendar_validators'):
+        request._fullcalendar_validators = (None, None)
+        try:
+            start_date, end_date = get_fullcalendar_timeframe(request)
+        except ValueError:
+            return request._fullcalendar_validators
+
+        last_modified, version = get_calendar_validators()
+
+        # Subscriptions opening or closing changes canSubscribe
+        moments = cache.get(get_subscription_moments_cache_key(start_date, end_date))
+        if moments is None:
+            return request._fullcalendar_validators
+        passed_subscription_changes = moments[:bisect_right(moments, timezone.now())]
+        if passed_subscription_changes:
+            last_modified = max(last_modified, passed_subscription_changes[-1])
+
+        # The feed differs per user
+        etag = hashlib.sha1(f"{version}:{start_date.isoformat()}:{end_date.isoformat()}:{request.user.id}:" \
+                f"{len(passed_subscription_changes)}:{get_language()}:{is_compact_fullcalendar_request(request)}".encode()).hexdigest()
+        request._fullcalendar_validators = (last_modified, etag)
+    return request._fullcalendar_validators
 
-    # Obtain non-recurring activities
-    activities = []
-    non_recurring_activities = Activity.objects.filter(recurrences="", published_date__lte=timezone.now()) \
-            .filter((Q(start_date__gte=start_date) | Q(end_date__lte=end_date)))
-    
-    for non_recurring_activity in non_recurring_activities:
-        activities.append(get_activity_json(
-            non_recurring_activity,
-            non_recurring_activity.start_date,
-            non_recurring_activity.end_date,
-            request.user
-        ))
+@require_safe
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request: get_fullcalendar_validators(request)[1],
+        last_modified_func=lambda request: get_fullcalendar_validators(request)[0])
+def fullcalendar_feed(request):
+    try:
+        start_date, end_date = get_fullcalendar_timeframe(request)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+
+    payload = get_cached_fullcalendar_payload(start_date, end_date)
+    occurrences = apply_user_overlay(payload, request.user)
+
+    if is_compact_fullcalendar_request(request):
+        # The metadata of each activity is sent once (keyed by groupId), and descriptions are
+        # obtained separately once they are needed (see activity_details)
+        groups = {activity_id: {field: value for field, value in group.items() if field != 'description'}
+                for activity_id, group in payload['groups'].items()}
+        response = JsonResponse({'groups': groups, 'activities': occurrences})
+    else:
+        groups = payload['groups']
+        response = JsonResponse({'activities': [{**groups[occurrence['groupId']], **occurrence}
+                for occurrence in occurrences]})
+
+    # The validators are known once the payload is built, even if they were not known before
+    if get_fullcalendar_validators(request) == (None, None):
+        del request._fullcalendar_validators
+        last_modified, etag = get_fullcalendar_validators(request)
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+# Obtains the (start, end)-timeframes requested from the occurrence stream, either through (repeated)
+# range=<start>/<end> parameters, or through a single pair of start and end parameters. Overlapping
+# timeframes are merged, so that no occurrence is included twice.
+# Raises a ValueError if the timeframes are missing, invalid, or exceed the limits of the stream
+def get_occurrence_stream_timeframes(request):
+    ranges = request.GET.getlist('range')
+    if not ranges and ('start' in request.GET or 'end' in request.GET):
+        ranges = [f"{request.GET.get('start', '')}/{request.GET.get('end', '')}"]
+    if not ranges:
+        raise ValueError("at least one range (or a start and end date) must be provided")
+    if len(ranges) > settings.ACTIVITY_OCCURRENCE_STREAM_MAX_RANGES:
+        raise ValueError(f"at most {settings.ACTIVITY_OCCURRENCE_STREAM_MAX_RANGES} ranges can be provided")
+
+    timeframes = []
+    for timeframe in ranges:
+        try:
+            start_date, end_date = timeframe.split('/')
+            start_date = datetime.fromisoformat(start_date)
+            end_date = datetime.fromisoformat(end_date)
+        except ValueError:
+            raise ValueError("ranges must be in yyyy-mm-ddThh:mm:ss+hh:mm/yyyy-mm-ddThh:mm:ss+hh:mm format")
+        if start_date.tzinfo is None or end_date.tzinfo is None:
+            raise ValueError("start and end dates must include a UTC offset")
+        if start_date >= end_date:
+            raise ValueError("start date must be before the end date")
+        timeframes.append((start_date, end_date))
+
+    timeframes.sort()
+    merged = [timeframes[0]]
+    for start_date, end_date in timeframes[1:]:
+        if start_date <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end_date))
+        else:
+            merged.append((start_date, end_date))
+
+    if sum((end_date - start_date for start_date, end_date in merged), timedelta()) > \
+            settings.ACTIVITY_OCCURRENCE_STREAM_MAX_SPAN:
+        raise ValueError(f"the ranges can span at most {settings.ACTIVITY_OCCURRENCE_STREAM_MAX_SPAN.days} days in total")
+    return merged
+
+# Generates the feed payloads (see get_fullcalendar_payload) of consecutive chunks of the given timeframes,
+# so that only a single chunk is kept in memory at a time. The chunks are not cached, as they are unlikely to be
+# requested again and would only push the FullCalendar feed's timeframes out of the cache
+def generate_occurrence_chunks(timeframes):
+    for start_date, end_date in timeframes:
+        chunk_start = start_date
+        while chunk_start < end_date:
+            chunk_end = min(chunk_start + settings.ACTIVITY_OCCURRENCE_STREAM_CHUNK, end_date)
+            yield get_fullcalendar_payload(chunk_start, chunk_end)
+            chunk_start = chunk_end
+
+# Generates the lines of the occurrence stream: the metadata of each activity (the first time one of its
+# occurrences is encountered), followed by its occurrences in the given timeframes
+def generate_occurrence_stream(timeframes, user):
+    seen_groups = set()
+    previous_keys = set()
+    for payload in generate_occurrence_chunks(timeframes):
+        keys = set()
+        occurrences = apply_user_overlay(payload, user)
+        for occurrence, (key, _, _) in sorted(zip(occurrences, payload['overlay']),
+                key=lambda item: datetime.fromisoformat(item[0]['start'])):
+            # Occurrences at the boundary of two chunks are part of both
+            keys.add(key)
+            if key in previous_keys:
+                continue
+
+            group_id = occurrence['groupId']
+            if group_id not in seen_groups:
+                seen_groups.add(group_id)
+                yield json.dumps({'type': 'group', 'groupId': group_id, **payload['groups'][group_id]}) + '\n'
+            yield json.dumps({'type': 'occurrence', **occurrence}) + '\n'
+        previous_keys = keys
+
+# Streams the occurrences of published activities in one or more (arbitrarily long) timeframes as
+# JSON lines. Each activity's metadata is sent once, as a line of type "group", before its first
+# occurrence (a line of type "occurrence", which refers to its activity through its groupId)
+@require_safe
+@cache_control(private=True, no_cache=True)
+def occurrence_stream(request):
+    try:
+        timeframes = get_occurrence_stream_timeframes(request)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
 
-    # Obtain occurrences of recurring activities in the relevant timeframe
-    all_recurring_activities = Activity.objects.exclude(recurrences="").filter(published_date__lte=timezone.now())
-
-    for recurring_activity in all_recurring_activities:
-        recurrences = recurring_activity.recurrences
-        event_start_time = recurring_activity.start_date.astimezone(timezone.get_current_timezone()).time()
-        utc_start_time = recurring_activity.start_date.time()
-
-        # recurrence expects each EXDATE's time to match the event's start time (in UTC; ignores DST)
-        # Why it doesn't store it that way in the first place remains a mystery
-        recurrences.exdates = list(map(lambda dt:
-                datetime.combine(timezone.localtime(dt).date(),
-                    utc_start_time, tzinfo=timezone.utc),
-                recurrences.exdates
-        ))
+    return StreamingHttpResponse(generate_occurrence_stream(timeframes, request.user),
+        content_type='application/x-ndjson')
+
+# The details of a published activity that are not part of the compact FullCalendar feed
+@require_safe
+def activity_details(request, activity_id):
+    activity = get_object_or_404(Activity, id=activity_id, published_date__lte=timezone.now())
+    return JsonResponse({
+        'groupId': activity.id,
+        'description': activity.description,
+    })
 
-        # If the activity ends on a different day than it starts, this also needs to be the case for the occurrence
-        time_diff = recurring_activity.end_date - recurring_activity.start_date
-
-        for occurence in recurrences.between(start_date, end_date, dtstart=recurring_activity.start_date, inc=True):
-            # recurrence does not handle daylight-saving time! If we were to keep the occurence as is,
-            # then summer events would occur an hour earlier in winter!
-            occurence = timezone.get_current_timezone().localize(
-                datetime.combine(timezone.localtime(occurence).date(), event_start_time)
-            )
-            
-            activities.append(get_activity_json(
-                recurring_activity,
-                occurence,
-                (occurence + time_diff),
-                request.user
-            ))
-
-    return JsonResponse({'activities': activities})
-
-
-def check_join_constraints(request, parent_activity, recurrence_id):
-    # Can only subscribe to at most X slots
-    if parent_activity.max_slots_join_per_participant != -1 and \
-            parent_activity.get_user_subscriptions(user=request.user, recurrence_id=recurrence_id).count() \
-                >= parent_activity.max_slots_join_per_participant:
-        return HttpResponseBadRequest("Cannot subscribe to another slot")
 
 @require_POST
 @login_required
 def register(request, slot_id):
-    slot = ActivitySlot.objects.filter(id=slot_id).first()
-    parent_activity = slot.parent_activity
-    if slot is None:
-        return HttpResponseBadRequest(f"Expected the id of an existing ActivitySlot, but got <{slot_id}>")
-
-    check_join_constraints(request, parent_activity, slot.recurrence_id)
-
-    # Base check for general activity constraints: subscription period, max number of total participants, etc.
-    if not slot.parent_activity.can_user_subscribe(request.user, recurrence_id=slot.recurrence_id):
-        return HttpResponseBadRequest("Cannot subscribe")
-
-    slot_participants = slot.participants.all()
-
-    # Can only subscribe at most once to each slot
-    if request.user in slot_participants:
-        return HttpResponseBadRequest("Cannot subscribe to the same slot more than once")    
-
-    # Slot participants limit
-    if slot.max_participants != -1 and len(slot_participants) >= slot.max_participants:
-        return HttpResponseBadRequest("Slot is full")
-    
-    request.user.__class__ = ExtendedUser
-    # Suscribe to slot
-    participant = slot.participants.add(
-       request.user, through_defaults={}
-    )
-
-    q_str = urlencode({'date': slot.recurrence_id.isoformat()})
+    try:
+        slot, ticket = submit_registration(slot_id, request.user)
+    except RegistrationError as error:
+        return HttpResponseBadRequest(str(error))
+
+    query = {'date': slot.recurrence_id.isoformat()}
+    if ticket is not None:
+        # The registration was queued
+        query['ticket'] = ticket.id
+    q_str = urlencode(query)
     return HttpResponseRedirect(
-        f"{reverse('activity_calendar:activity_slots_on_day', kwargs={'activity_id': parent_activity.id})}?{q_str}")
+        f"{reverse('activity_calendar:activity_slots_on_day', kwargs={'activity_id': slot.parent_activity.id})}?{q_str}")
 
 @require_POST
 @login_required
 def deregister(request, slot_id):
-    slot = ActivitySlot.objects.filter(id=slot_id).first()
-    parent_activity = slot.parent_activity
-    if slot is None:
-        return HttpResponseBadRequest(f"Expected the id of an existing ActivitySlot, but got <{slot_id}>")
+    try:
+        slot = deregister_participant(slot_id, request.user)
+    except RegistrationError as error:
+        return HttpResponseBadRequest(str(error))
 
-    # Subscriptions must be open
-    if not slot.are_subscriptions_open():
-        return HttpResponseBadRequest(f"Cannot unsubscribe once subscriptions are closed")
+    q_str = urlencode({'date': slot.recurrence_id.isoformat(), 'deregister': True})
+    return HttpResponseRedirect(
+        f"{reverse('activity_calendar:activity_slots_on_day', kwargs={'activity_id': slot.parent_activity.id})}?{q_str}")
 
-    user_slot_participants = slot.participants.filter(id=request.user.id)
 
-    for usr in user_slot_participants:
-        slot.participants.remove(usr)
+# The status of a queued registration, which is polled by the slot page
+@require_safe
+@login_required
+@cache_control(private=True, no_cache=True)
+def registration_ticket_status(request, ticket_id):
+    ticket = get_object_or_404(RegistrationTicket, id=ticket_id, user__id=request.user.id)
+    return JsonResponse({
+        'status': ticket.status,
+        'position': ticket.get_position(),
+        'message': ticket.message,
+    })
+
+
+# The state of the slots of an occurrence, as pushed to the slot page
+def get_occurrence_slot_state(activity, recurrence_id, subscriptions_open):
+    slots = activity.get_slots(recurrence_id=recurrence_id).order_by('id') \
+            .values_list('id', 'num_participants', 'max_participants')
+    return {
+        'subscriptionsOpen': subscriptions_open,
+        'slots': [{'id': slot_id, 'numParticipants': num_participants, 'maxParticipants': max_participants}
+            for slot_id, num_participants, max_participants in slots],
+    }
 
-    q_str = urlencode({'date': slot.recurrence_id.isoformat(), 'deregister': True})
-    return HttpResponseRedirect(
-        f"{reverse('activity_calendar:activity_slots_on_day', kwargs={'activity_id': parent_activity.id})}?{q_str}")
+# Event ids of slot_events, which identify the state that was pushed by the versions it was derived from, along
+# with whether subscriptions were open and the moment at which that changes (if ever). This allows checking whether
+# a client is up to date without loading the activity, as: recurring:occurrence version:activity version:open:until
+# Returns the event id along with whether subscriptions are open
+def get_slot_event_id(activity, recurrence_id, activity_version):
+    # Determined for a single moment (unlike through are_subscriptions_open), so that both are consistent
+    occurrence_start = recurrence_id if activity.is_recurring else activity.start_date
+    opens = occurrence_start - activity.subscriptions_open
+    closes = occurrence_start - activity.subscriptions_close
+    now = timezone.now()
+    subscriptions_open = opens <= now <= closes
+    until = opens if now < opens else closes if subscriptions_open else None
+
+    occurrence_version = get_occurrence_version(activity.id, recurrence_id if activity.is_recurring else None)
+    event_id = f"{int(activity.is_recurring)}:{occurrence_version}:{activity_version}:" \
+        f"{int(subscriptions_open)}:{until.timestamp() if until else ''}"
+    return event_id, subscriptions_open
+
+# Whether the state identified by the given event id is still current (see get_slot_event_id)
+def is_slot_event_id_current(activity_id, recurrence_id, event_id):
+    try:
+        is_recurring, occurrence_version, activity_version, _, until = event_id.split(':')
+        until = float(until) if until else None
+    except ValueError:
+        return False
+
+    occurrence_key = get_occurrence_version_cache_key(activity_id, recurrence_id if is_recurring == '1' else None)
+    versions = cache.get_many([occurrence_key, ACTIVITY_VERSION_CACHE_KEY])
+    return versions.get(occurrence_key) == occurrence_version \
+        and versions.get(ACTIVITY_VERSION_CACHE_KEY) == activity_version \
+        and (until is None or timezone.now().timestamp() < until)
+
+# Pushes the participant counts of the slots of an occurrence (and whether subscriptions are open)
+# to the slot page using Server-Sent Events, whenever they change. Browsers pass the id of the last event
+# they received, which is compared against the (shared) versions first; the activity and its slots are only
+# loaded if something actually changed. Each request answers at once (so that it does not hold up a worker)
+# and closes the connection; browsers reconnect after the retry interval
+@require_safe
+def slot_events(request, activity_id):
+    recurrence_id = dateparse.parse_datetime(request.GET.get('date', ''))
+    if recurrence_id is None:
+        return HttpResponseNotFound()
+
+    content = f"retry: {settings.ACTIVITY_SLOT_EVENTS_INTERVAL * 1000}\n\n"
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID')
+    if last_event_id is None or not is_slot_event_id_current(activity_id, recurrence_id, last_event_id):
+        # Obtain the version before loading the activity, so that concurrent changes are not missed
+        activity_version = get_activity_version()
+        activity = get_object_or_404(Activity, id=activity_id)
+        if not activity.has_occurence_at(recurrence_id):
+            return HttpResponseNotFound()
+
+        event_id, subscriptions_open = get_slot_event_id(activity, recurrence_id, activity_version)
+        state = get_occurrence_slot_state(activity, recurrence_id, subscriptions_open)
+        content += f"id: {event_id}\nevent: update\ndata: {json.dumps(state)}\n\n"
+
+    response = HttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 class ActivitySlotList(DetailView):
@@ -194,6 +596,9 @@ class ActivitySlotList(DetailView):
     context_object_name = 'activity'
     pk_url_kwarg = 'activity_id'
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('image')
+
     def get(self, request, *args, **kwargs):
         # Obtain the relevant recurrence id
         self.object = self.get_object()
@@ -210,9 +615,16 @@ class ActivitySlotList(DetailView):
         recurrence_id = self.recurrence_id
 
         # Obtain information that is needed by the template
-        slots = self.object.get_slots(recurrence_id=recurrence_id)
-        num_total_participants = slots.aggregate(Count('participants'))['participants__count']
-        num_max_participants = self.object.get_max_num_participants(recurrence_id=recurrence_id)
+        # Load everything the slot blocks need at once, rather than per slot
+        slots = list(self.object.get_slots(recurrence_id=recurrence_id)
+                .select_related('owner', 'image').prefetch_related('participants'))
+        for slot in slots:
+            # Slots without an image use the (already loaded) image of the activity
+            slot.parent_activity = self.object
+        statistics = self.object.get_occurrence_statistics(recurrence_id)
+        num_total_participants = statistics.num_participants
+        num_max_participants = self.object.get_max_num_participants(recurrence_id=recurrence_id,
+                num_slots=statistics.num_slots, num_max_slot_participants=statistics.num_max_slot_participants)
 
         context['deregister'] = self.request.GET.get('deregister', False)
         context['recurrence_id'] = recurrence_id
@@ -220,12 +632,23 @@ class ActivitySlotList(DetailView):
         context['num_total_participants'] = num_total_participants
         context['max_participants'] = num_max_participants
 
-        num_user_registrations = self.object.get_num_user_subscriptions(self.request.user, recurrence_id=recurrence_id)
+        num_user_registrations = 0
+        if self.request.user.is_authenticated:
+            num_user_registrations = sum(any(participant.id == self.request.user.id for participant in slot.participants.all())
+                    for slot in slots)
         context['num_registered_slots'] = num_user_registrations
         context['can_create_slot'] = self.object.can_user_create_slot(self.request.user, recurrence_id=recurrence_id,
-                num_slots=len(slots), num_user_registrations=num_user_registrations,
+                num_slots=statistics.num_slots, num_user_registrations=num_user_registrations,
                 num_total_participants=num_total_participants, num_max_participants=num_max_participants)
         context['subscriptions_open'] = self.object.are_subscriptions_open(recurrence_id=recurrence_id)
+        context['events_url'] = reverse('activity_calendar:activity_slot_events', kwargs={'activity_id': self.object.id}) \
+                + '?' + urlencode({'date': recurrence_id.isoformat()})
+
+        # A queued registration of the user
+        context['ticket'] = None
+        ticket_id = self.request.GET.get('ticket', '')
+        if ticket_id.isdigit() and self.request.user.is_authenticated:
+            context['ticket'] = RegistrationTicket.objects.filter(id=ticket_id, user__id=self.request.user.id).first()
         
         
         duration = self.object.end_date - self.object.start_date
@@ -265,7 +688,8 @@ class ActivitySlotList(DetailView):
 
         if self.object.slot_creation == "CREATION_AUTO":
             form.data.update({
-                'title':        'Slot ' + str(self.object.get_num_slots(recurrence_id=self.recurrence_id) + 1),
+                # Replaced by the slot's number once it is saved
+                'title':        'Slot',
                 'description':  None,
                 'location':     None,
                 'start_date':   None,
@@ -276,11 +700,26 @@ class ActivitySlotList(DetailView):
             })        
 
         if form.is_valid():
-            # Save the slot and add the user
-            slot = form.save(commit=True)
-            request.user.__class__ = ExtendedUser
-            slot.participants.add(request.user, through_defaults={})
-
+            if not self.object.can_user_create_slot(request.user, recurrence_id=self.recurrence_id):
+                return HttpResponseBadRequest("Cannot create another slot")
+
+            try:
+                # Save the slot and register the user (or queue the registration, like any other). The slot
+                # is only kept if the user can join it; it is removed again if a queued registration is rejected
+                with transaction.atomic():
+                    slot = form.save(commit=False)
+                    if self.object.slot_creation == "CREATION_AUTO":
+                        save_numbered_slot(slot)
+                    else:
+                        slot.save()
+                    form.save_m2m()
+                    ticket = submit_registration(slot.id, request.user, creates_slot=True)[1]
+            except RegistrationError as error:
+                return HttpResponseBadRequest(str(error))
+
+            if ticket is not None:
+                # The registration was queued
+                return redirect(f"{request.path}?{urlencode({'date': self.recurrence_id.isoformat(), 'ticket': ticket.id})}")
             return redirect(request.get_full_path())
         else:
             context = context = self.get_context_data(**kwargs)
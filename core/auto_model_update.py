@@ -0,0 +1,27 @@
+# Allows methods to fire automatically if a DB-model is updated
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import UserDisplayName
+
+##################################################################################
+# Methods that keep the stored display names of users up to date
+# @since 18 OCT 2020
+##################################################################################
+
+# Fields of a user that its (default) display name depends on
+DISPLAY_NAME_FIELDS = {'username', 'first_name'}
+
+# Fires when a user (or any of its proxies) gets created or updated
+@receiver(post_save)
+def post_save_user(sender, instance, raw, update_fields, **kwargs):
+    # Do not resolve names if the database is not yet in a consistent state
+    if raw or sender._meta.concrete_model is not User:
+        return
+
+    # E.g. only the last login date changed
+    if update_fields is not None and not DISPLAY_NAME_FIELDS.intersection(update_fields):
+        return
+
+    UserDisplayName.update_for_users([instance.id])
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Stores the display names of the existing users: the full names of members, and the simple display names of others
+def store_display_names(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Member = apps.get_model('membership_file', 'Member')
+    UserDisplayName = apps.get_model('core', 'UserDisplayName')
+
+    member_names = {}
+    for user_id, first_name, tussenvoegsel, last_name in Member.objects.filter(user__isnull=False) \
+            .values_list('user_id', 'first_name', 'tussenvoegsel', 'last_name'):
+        if tussenvoegsel is not None:
+            member_names[user_id] = f"{first_name} {tussenvoegsel} {last_name}"
+        else:
+            member_names[user_id] = f"{first_name} {last_name}"
+
+    UserDisplayName.objects.bulk_create([
+        UserDisplayName(user_id=user_id, display_name=member_names.get(user_id, first_name or username))
+        for user_id, first_name, username in User.objects.values_list('id', 'first_name', 'username').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('core', '0002_presetimage'),
+        # Members are displayed by their full names
+        ('membership_file', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDisplayName',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stored_display_name', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('display_name', models.CharField(max_length=1023)),
+            ],
+        ),
+        migrations.RunPython(store_display_names, migrations.RunPython.noop),
+    ]
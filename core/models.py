@@ -1,5 +1,5 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils.text import slugify
 
 import os
@@ -22,10 +22,61 @@ class ExtendedUser(User):
     # Stores the method used to display a user's name
     display_name_method = get_simple_display_name
 
+    # Prepares a list of users for obtaining their display names, e.g. by loading the data
+    # these depend on for all of them at once. Does nothing for the default display method
+    @staticmethod
+    def prepare_display_names(users):
+        pass
+
     # Allows other modules to change the way a user is displayed across the entire application
+    # If given, prepare_method is used to prepare many users at once (see prepare_display_names)
     @staticmethod
-    def set_display_name_method(method):
+    def set_display_name_method(method, prepare_method=None):
         ExtendedUser.display_name_method = method
+        if prepare_method is not None:
+            ExtendedUser.prepare_display_names = staticmethod(prepare_method)
+
+
+# Stores the display name of a user, so that lists of users can be displayed without
+# resolving the name of each user separately. Kept up to date through signals
+class UserDisplayName(models.Model):
+    user = models.OneToOneField(User, primary_key=True, related_name="stored_display_name", on_delete=models.CASCADE)
+    display_name = models.CharField(max_length=1023)
+
+    # Resolves and stores the current display names of the users with the given ids
+    # using a constant number of queries
+    # Returns a dictionary that maps user ids to their display names
+    @staticmethod
+    def update_for_users(user_ids):
+        users = list(ExtendedUser.objects.filter(id__in=set(user_ids) - {None}))
+        ExtendedUser.prepare_display_names(users)
+        display_names = {user.id: user.get_display_name() for user in users}
+
+        with transaction.atomic():
+            stored_user_ids = set(UserDisplayName.objects.filter(user__id__in=display_names.keys())
+                .values_list('user_id', flat=True))
+            UserDisplayName.objects.bulk_update([UserDisplayName(user_id=user_id, display_name=display_name)
+                for user_id, display_name in display_names.items() if user_id in stored_user_ids], ['display_name'])
+            # Names that were stored concurrently are skipped
+            UserDisplayName.objects.bulk_create([UserDisplayName(user_id=user_id, display_name=display_name)
+                for user_id, display_name in display_names.items() if user_id not in stored_user_ids],
+                ignore_conflicts=True)
+        return display_names
+
+    # Obtains the display names of the users with the given ids in a single query
+    # Names that were not stored yet are resolved (and stored) first
+    # Returns a dictionary that maps user ids to their display names
+    @staticmethod
+    def get_for_users(user_ids):
+        user_ids = set(user_ids) - {None}
+        display_names = dict(UserDisplayName.objects.filter(user__id__in=user_ids).values_list('user_id', 'display_name'))
+        missing_user_ids = user_ids - display_names.keys()
+        if missing_user_ids:
+            display_names.update(UserDisplayName.update_for_users(missing_user_ids))
+        return display_names
+
+    def __str__(self):
+        return self.display_name
 
 
 # File path to upload achievement images to
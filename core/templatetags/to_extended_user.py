@@ -1,5 +1,6 @@
 from django import template
 from core.models import ExtendedUser
+from core.util import cast_to_proxy
 
 register = template.Library()
 
@@ -10,5 +11,4 @@ register = template.Library()
 
 @register.filter
 def to_extended_user(user):
-    attrs = {field.name: getattr(user, field.name) for field in user._meta.fields}
-    return ExtendedUser(**attrs)
+    return cast_to_proxy(user, ExtendedUser)
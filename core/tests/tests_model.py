@@ -1,13 +1,79 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
 from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 
-from core.models import ExtendedUser, get_image_upload_path, PresetImage
+from core.models import ExtendedUser, get_image_upload_path, PresetImage, UserDisplayName
+from core.util import cast_to_proxy
 
 ##################################################################################
 # Test cases for the models in core
 # @since 16 MAR 2020
 ##################################################################################
 
+# Tests for casting users to proxy models
+class CastToProxyTest(TestCase):
+    def setUp(self):
+        User.objects.create(username='the_rock', first_name='Dwayne')
+        self.user = User.objects.prefetch_related('groups').get(username='the_rock')
+
+    # Tests if the cast reuses the loaded data without querying the database
+    def test_cast(self):
+        with self.assertNumQueries(0):
+            extended_user = cast_to_proxy(self.user, ExtendedUser)
+            self.assertIsInstance(extended_user, ExtendedUser)
+            self.assertEqual(extended_user.pk, self.user.pk)
+            self.assertEqual(extended_user.get_simple_display_name(), "Dwayne")
+            self.assertIs(extended_user._state, self.user._state)
+            self.assertFalse(extended_user._state.adding)
+            self.assertEqual(list(extended_user.groups.all()), [])
+
+        # The original is left untouched
+        self.assertIs(type(self.user), User)
+        extended_user.first_name = "The Rock"
+        self.assertEqual(self.user.first_name, "Dwayne")
+
+    # Tests casting lazy objects and instances that already are of the proxy class
+    def test_cast_lazy_or_same(self):
+        extended_user = cast_to_proxy(SimpleLazyObject(lambda: self.user), ExtendedUser)
+        self.assertIsInstance(extended_user, ExtendedUser)
+        self.assertIs(cast_to_proxy(extended_user, ExtendedUser), extended_user)
+
+    # Tests if instances of other models cannot be cast
+    def test_cast_other_model(self):
+        with self.assertRaises(TypeError):
+            cast_to_proxy(PresetImage(name="image"), ExtendedUser)
+
+# Tests for the stored display names of users
+class UserDisplayNameTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='the_rock', first_name='Dwayne')
+
+    # Tests if display names are stored when users are created or renamed
+    def test_update_on_save(self):
+        self.assertEqual(UserDisplayName.objects.get(user=self.user).display_name, "Dwayne")
+
+        self.user.first_name = "The Rock"
+        self.user.save()
+        self.assertEqual(UserDisplayName.objects.get(user=self.user).display_name, "The Rock")
+
+        # Unrelated fields do not affect the name
+        self.user.first_name = "Dwayne"
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(UserDisplayName.objects.get(user=self.user).display_name, "The Rock")
+
+    # Tests if the names of multiple users are obtained at once
+    def test_get_for_users(self):
+        other_user = User.objects.create(username='kevin_hart')
+        with self.assertNumQueries(1):
+            display_names = UserDisplayName.get_for_users([self.user.id, other_user.id])
+        self.assertDictEqual(display_names, {self.user.id: "Dwayne", other_user.id: "kevin_hart"})
+
+        # Missing names are resolved and stored
+        UserDisplayName.objects.all().delete()
+        self.assertDictEqual(UserDisplayName.get_for_users([self.user.id]), {self.user.id: "Dwayne"})
+        self.assertTrue(UserDisplayName.objects.filter(user=self.user).exists())
+
 # Tests for ExtendedUser
 class ExtendedUserTest(TestCase):
     def setUp(self):
@@ -25,6 +91,8 @@ class ExtendedUserTest(TestCase):
     def test_get_set_display_name(self):
         self.assertEqual(self.user.get_display_name(), self.user.get_simple_display_name())
 
+        # Restore the display method afterwards, as it is shared by the whole application
+        self.addCleanup(ExtendedUser.set_display_name_method, ExtendedUser.display_name_method)
         ExtendedUser.set_display_name_method(lambda x: f"{x.first_name} 'the Rock' {x.last_name}")
         self.assertEqual(self.user.get_display_name(), "Dwayne 'the Rock' Johnson")
 
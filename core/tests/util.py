@@ -1,7 +1,9 @@
 from django.test import TestCase
 from django.test import Client
 from django.conf import settings
+from django.core.cache import caches
 
+from contextlib import contextmanager
 from enum import Enum
 
 from core.models import ExtendedUser as User
@@ -95,3 +97,52 @@ def checkAccessPermissions(test: TestCase, url: str, httpMethod: str, permission
 
     # Ensure a redirection to the login page took place
     test.assertRedirects(response, '{0}?next={1}'.format(settings.LOGIN_URL, url))
+
+
+#
+# Captures the calls that are made to the (default) cache within the context, as (method, key)-tuples
+# Calls that a cache method makes to other methods of the cache (e.g. get_many to get) are not included
+#
+class CaptureCacheCallsContext:
+    METHODS = ('get', 'get_many', 'set', 'set_many', 'add', 'delete', 'delete_many', 'incr', 'decr')
+
+    def __init__(self, cache=None):
+        self.cache = cache or caches['default']
+        self.captured_calls = []
+        self.depth = 0
+
+    def __len__(self):
+        return len(self.captured_calls)
+
+    def capture(self, method_name, method):
+        def captured_method(key, *args, **kwargs):
+            if not self.depth:
+                self.captured_calls.append((method_name, key))
+            self.depth += 1
+            try:
+                return method(key, *args, **kwargs)
+            finally:
+                self.depth -= 1
+        return captured_method
+
+    def __enter__(self):
+        for method_name in self.METHODS:
+            setattr(self.cache, method_name, self.capture(method_name, getattr(self.cache, method_name)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for method_name in self.METHODS:
+            delattr(self.cache, method_name)
+
+#
+# Asserts that exactly num calls are made to the (default) cache within the context (see CaptureCacheCallsContext)
+#
+# @param test A testcase instance used to make Assertions
+# @param num The expected number of cache calls
+#
+@contextmanager
+def assertNumCacheCalls(test: TestCase, num: int):
+    with CaptureCacheCallsContext() as context:
+        yield context
+    test.assertEqual(len(context), num, "{0} cache calls made, {1} expected\nCaptured calls were:\n{2}".format(
+        len(context), num, "\n".join(f"{method}({key!r})" for method, key in context.captured_calls)))
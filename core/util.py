@@ -1,6 +1,8 @@
 import logging
 from enum import Enum
 
+from django.utils.functional import LazyObject, empty
+
 """
 Contains various utility functions for the whole application.
 """
@@ -44,3 +46,26 @@ def suppress_warnings(original_function):
         # lower logging level back to previous
         logger.setLevel(previous_logging_level)
     return new_function
+
+def cast_to_proxy(instance, proxy_class):
+    """
+    Returns the given model instance as an instance of proxy_class (e.g. a User as a MemberUser).
+    proxy_class must be (a proxy of) the same concrete model as the instance.
+    Rather than constructing a new instance field by field, this makes a shallow copy that shares
+    the loaded field values, _state (including cached relations) and prefetched data of the instance.
+    Lazy objects (such as request.user) are evaluated first.
+    """
+    if isinstance(instance, LazyObject):
+        if instance._wrapped is empty:
+            instance._setup()
+        instance = instance._wrapped
+
+    if type(instance) is proxy_class:
+        return instance
+
+    if instance._meta.concrete_model is not proxy_class._meta.concrete_model:
+        raise TypeError(f"Cannot cast a {type(instance).__name__} to a {proxy_class.__name__}")
+
+    proxy_instance = proxy_class.__new__(proxy_class)
+    proxy_instance.__dict__ = instance.__dict__.copy()
+    return proxy_instance
@@ -0,0 +1 @@
+default_app_config = 'membership_file.apps.MembershipFileConfig'
@@ -6,6 +6,22 @@ from django.contrib import admin
 class MemberWithLog(admin.ModelAdmin):
     # Show the date and user that last updated the member
 
+    # Marks the selected members for deletion at once (which still creates their MemberLogs)
+    def mark_for_deletion(self, request, queryset):
+        num_members = queryset.filter(marked_for_deletion=False).update_with_log(request.user, marked_for_deletion=True)
+        self.message_user(request, f"Marked {num_members} member(s) for deletion")
+    mark_for_deletion.short_description = 'Mark selected members for deletion'
+    mark_for_deletion.allowed_permissions = ('change',)
+
+    # Unmarks the selected members for deletion at once (which still creates their MemberLogs)
+    def unmark_for_deletion(self, request, queryset):
+        num_members = queryset.filter(marked_for_deletion=True).update_with_log(request.user, marked_for_deletion=False)
+        self.message_user(request, f"Unmarked {num_members} member(s) for deletion")
+    unmark_for_deletion.short_description = 'Unmark selected members for deletion'
+    unmark_for_deletion.allowed_permissions = ('change',)
+
+    actions = ['mark_for_deletion', 'unmark_for_deletion']
+
     # Override the admin panel's save method to automatically include the user that updated the member
     def save_model(self, request, obj, form, change):
         obj.last_updated_by = request.user
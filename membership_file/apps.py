@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class MembershipFileConfig(AppConfig):
     name = 'membership_file'
+
+    def ready(self):
+        # Register signal handlers
+        from . import auto_model_update
@@ -1,8 +1,8 @@
 # Allows methods to fire automatically if a DB-model is updated
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
-from .serializers import MemberSerializer
-from .models import Member, MemberLog, MemberLogField
+from core.models import UserDisplayName
+from .models import Member, MemberLog
 
 ##################################################################################
 # Methods that automatically create Log data when a Member gets updated
@@ -16,78 +16,57 @@ def pre_save_member(sender, instance, raw, **kwargs):
     if raw:
         return
 
-    # if instance is being updated, it has an id
-    if instance.id:
-        pPreSaveMember = Member.objects.get(pk=instance.id)
+    # The values of members loaded from the database are known already (see Member.from_db)
+    # Only members that were constructed with an existing id need to be looked up
+    if instance.id and not hasattr(instance, 'loaded_values'):
+        stored_member = Member.objects.filter(id=instance.id).first()
+        instance.loaded_values = {} if stored_member is None else stored_member.loaded_values
 
-        # Pass the old values on to the post_save_member method
-        # as only there can it be guaranteed that the save was successful
-        instance.old_values = MemberSerializer(pPreSaveMember).data
-    else:
-        instance.old_values = {}
+    # Pass the old values on to the post_save_member method
+    # as only there can it be guaranteed that the save was successful
+    instance.old_values = dict(getattr(instance, 'loaded_values', {})) if instance.id else {}
 
 # Fires when the member update/creation has completed successfully
 @receiver(post_save, sender=Member)
-def post_save_member(sender, instance, created, raw, **kwargs):
+def post_save_member(sender, instance, created, raw, update_fields, **kwargs):
     # Do not create logs if the database is not yet in a consistent state
     if raw:
         return
 
-    old_values_that_changed = {}
-    iterableMember = MemberSerializer(instance).data
+    new_values = instance.get_field_values(update_fields)
+    # The stored values are now the saved values
+    instance.snapshot_field_values(update_fields)
 
-    # Ignore fields that make no sense to keep track of
-    ignore_fields = ['last_updated_date', 'last_updated_by']
+    update_type = "INSERT" if created else "UPDATE"
+    old_values = {} if created else instance.old_values
 
-    update_type = "UPDATE"
+    # Create the MemberLogs (and their MemberLogFields) for the changed values
+    MemberLog.bulk_create_with_fields(MemberLog.get_logs_for_changes(instance.id, instance.last_updated_by_id,
+        update_type, old_values, new_values))
 
-    # New Member created
-    if not ('id' in instance.old_values):
-        update_type = "INSERT"
-        
-    # Loop over all fields in the member, and store updated values
-    for field in iterableMember: 
-        # Skip fields that should be ignored
-        if field in ignore_fields:
-            continue
-        # Obtain the old value
-        oldValue = instance.old_values[field] if (field in instance.old_values) else None
-        # If it is different, store the change
-        if oldValue != iterableMember[field]:
-            old_values_that_changed[field] = oldValue
 
-    # Assert: Both dictionaries have different values for each of their keys. I.e.
-    # (\forall string k; iterableMember.hasKey(k); old_values_that_changed.hasKey(k) && iterableMember[k] != old_values_that_changed[k])
-
-    # The object was saved but no values were changed
-    if not old_values_that_changed:
-        return
-
-    
-    # Create a new UPDATE MemberLog
-    # but only if the marked_for_deletion-value changed from T to F, or more values were changed
-    if old_values_that_changed.get('marked_for_deletion', True) or len(old_values_that_changed) > 1:
-        memberlog = MemberLog.objects.create(user=instance.last_updated_by, member=instance, log_type=update_type)
-
-        # Create a new MemberLogField for each updated field
-        for field in old_values_that_changed:
-            # Do not create a memberLogEntry if marked_for_deletion has just changed to true or was just initialised
-            if field == 'marked_for_deletion' and not old_values_that_changed[field]:
-                continue
+# Fires when a member is about to be deleted
+@receiver(pre_delete, sender=Member)
+def pre_delete_member(sender, instance, **kwargs):
+    # Manually delete the MemberLogs of the member that is being deleted, as they would otherwise
+    # no longer be related to any member. This happens in the same transaction as the deletion itself.
+    # Not enforced through a models.CASCADE as to circumvent permissions to keep the logs read only
+    MemberLog.objects.filter(member__id=instance.id).delete()
 
-            field = MemberLogField.objects.create(member_log=memberlog, field=field, old_value=old_values_that_changed[field], new_value=iterableMember[field])
-    
-    # Create a special memberlog if a member got marked for deletion
-    # I.e. the old value for marked_for_deletion was False
-    if not old_values_that_changed.get('marked_for_deletion', True) and iterableMember.get('marked_for_deletion', False):
-        # Create a new DELETE Memberlog
-        MemberLog.objects.create(user=instance.last_updated_by, member=instance, log_type="DELETE")
+##################################################################################
+# Methods that keep the stored display names of users up to date when their members change
+# @since 18 OCT 2020
+##################################################################################
 
+# Fires when the member update/creation has completed successfully
+@receiver(post_save, sender=Member)
+def update_member_display_names(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    # Both the current and the previously linked user (if the member was linked to another user)
+    UserDisplayName.update_for_users({instance.user_id, getattr(instance, 'old_values', {}).get('user')})
 
 # Fires when the member deletion has completed successfully
 @receiver(post_delete, sender=Member)
-def post_delete_member(sender, instance, **kwargs):
-    # Manually delete all MemberLogs that are not related to a member
-    # (I.e. they belonged to the just-deleted member)
-    # Not enforced through a models.CASCADE as to circumvent permissions to keep the logs read only
-    pMemberLogs = MemberLog.objects.filter(member=None).delete()
+def delete_member_display_names(sender, instance, **kwargs):
+    UserDisplayName.update_for_users([instance.user_id])
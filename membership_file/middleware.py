@@ -0,0 +1,21 @@
+from django.utils.functional import SimpleLazyObject
+
+from .util import get_request_member
+
+##################################################################################
+# Middleware that provides the member linked to the requesting user as request.member
+# @since 18 OCT 2020
+##################################################################################
+
+class MemberMiddleware:
+    """
+    Sets request.member to the member linked to request.user (or None if there is no such member).
+    The member is only looked up once it is used, and at most once per request.
+    Must be placed after django.contrib.auth.middleware.AuthenticationMiddleware
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.member = SimpleLazyObject(lambda: get_request_member(request))
+        return self.get_response(request)
@@ -1,13 +1,13 @@
 from django.conf import settings
 from django.core.validators import RegexValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from datetime import date
 
 import datetime
 import re
 
-from core.models import ExtendedUser as User
+from core.models import ExtendedUser as User, UserDisplayName
 
 ##################################################################################
 # Models related to the Membership File-functionality of the application.
@@ -16,13 +16,20 @@ from core.models import ExtendedUser as User
 
 # Display method for a user that may also be a member
 def get_member_display_name(user):
-    member = MemberUser(user.id).get_member()
+    # Reuse the member if it was already looked up for this user (e.g. through request.member)
+    member = user._cached_member if hasattr(user, '_cached_member') else MemberUser(user.id).get_member()
     if member is not None:
         return member.get_full_name()
     return user.get_simple_display_name()
 
+# Looks up the members of the given users at once, so that their display names do not require a query each
+def prepare_member_display_names(users):
+    members = {member.user_id: member for member in Member.objects.filter(user__id__in=[user.id for user in users])}
+    for user in users:
+        user._cached_member = members.get(user.id)
+
 # Users should be displayed by their names according to the membership file (if they're a member)
-User.set_display_name_method(get_member_display_name)
+User.set_display_name_method(get_member_display_name, prepare_member_display_names)
 
 # Provides additional methods on the ExtendedUser model
 class MemberUser(User):
@@ -30,8 +37,11 @@ class MemberUser(User):
         proxy = True
 
     # Returns the associated member to a given user
+    # The member is only looked up once per MemberUser (see also membership_file.util.get_user_member)
     def get_member(self):
-        return Member.objects.filter(user__id=self.id).first()
+        if not hasattr(self, '_cached_member'):
+            self._cached_member = Member.objects.filter(user__id=self.id).first()
+        return self._cached_member
 
     # Checks whether a given user is a member
     def is_member(self):
@@ -40,8 +50,45 @@ class MemberUser(User):
 
 ##################################################################################
 
+# Fields of a member that determine how its user is displayed
+DISPLAY_NAME_FIELDS = {'user', 'first_name', 'tussenvoegsel', 'last_name'}
+
+# Allows many members to be updated at once, while still logging their changes
+class MemberQuerySet(models.QuerySet):
+    # Updates the given fields of all members in the queryset in a single statement on behalf of the
+    # given user. The MemberLogs (and MemberLogFields) are the same as if each member was saved
+    # separately, but are created in bulk. Values must be plain values (i.e. not expressions).
+    # Returns the number of updated members
+    def update_with_log(self, user, **values):
+        new_values = {}
+        for name, value in values.items():
+            field = self.model._meta.get_field(name)
+            if not field.concrete or field.primary_key or name in MemberLog.IGNORED_FIELDS:
+                raise ValueError(f"Cannot update the field <{name}> of members with a log")
+            # Foreign keys are logged by the primary keys of the objects they refer to
+            if isinstance(value, models.Model):
+                value = value.pk
+            new_values[name] = field.to_python(value)
+
+        user_id = None if user is None else user.id
+        with transaction.atomic():
+            # The current values (and users) of the members, locked until they are updated
+            members = list(self.select_for_update().order_by('id').values('id', 'user', *(new_values.keys() - {'user'})))
+            num_updated = self.update(last_updated_by_id=user_id, last_updated_date=timezone.now(), **new_values)
+
+            MemberLog.bulk_create_with_fields([log for member in members
+                for log in MemberLog.get_logs_for_changes(member['id'], user_id, "UPDATE", member, new_values)])
+
+            # bulk updates do not fire signals, so update the display names here
+            if DISPLAY_NAME_FIELDS.intersection(new_values):
+                UserDisplayName.update_for_users({member['user'] for member in members} | {new_values.get('user')})
+        return num_updated
+
+
 # The Member model represents a Member in the membership file
 class Member(models.Model):
+    objects = MemberQuerySet.as_manager()
+
     # The User that is linked to this member
     # NB: Only one user can be linked to one member at the same time!
     user = models.OneToOneField(
@@ -131,6 +178,36 @@ class Member(models.Model):
     # Members can be marked for deletion, after which another user
     # can permanently delete the member
     marked_for_deletion = models.BooleanField(default=False)
+
+    ##################################
+    # CHANGE TRACKING
+    # The values of a member are remembered when it is loaded from the database, so that
+    # changes can be logged without querying the database again (see auto_model_update)
+    ##################################
+    # Obtains the current values of the loaded fields (or the given fields) by field name
+    # Foreign keys are represented by the primary keys of the objects they refer to
+    def get_field_values(self, field_names=None):
+        deferred_fields = self.get_deferred_fields()
+        return {field.name: getattr(self, field.attname) for field in self._meta.concrete_fields
+            if field.attname not in deferred_fields and (field_names is None or field.name in field_names)}
+
+    # Remembers the current values of the loaded fields (or the given fields) as their stored values
+    def snapshot_field_values(self, field_names=None):
+        if field_names is None or not hasattr(self, 'loaded_values'):
+            self.loaded_values = {}
+        self.loaded_values.update(self.get_field_values(field_names))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.snapshot_field_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is not None:
+            fields = {self._meta.get_field(field).name for field in fields}
+        self.snapshot_field_values(fields)
     
     ##################################
     # STRING REPRESENTATION METHODS
@@ -217,6 +294,63 @@ class MemberLog(models.Model):
     # Automatically handled by Django and cannot be overridden
     date = models.DateTimeField(auto_now_add=True)
 
+    # Fields that make no sense to keep track of
+    IGNORED_FIELDS = ['last_updated_date', 'last_updated_by']
+
+    # Obtains the (unsaved) logs of the changes to a member as a list of (MemberLog, [MemberLogField])-tuples
+    # old_values and new_values map field names to values. Only the fields in new_values are compared
+    @staticmethod
+    def get_logs_for_changes(member_id, user_id, log_type, old_values, new_values):
+        # Store the old values of all fields that changed
+        old_values_that_changed = {field: old_values.get(field) for field, value in new_values.items()
+            if field not in MemberLog.IGNORED_FIELDS and old_values.get(field) != value}
+
+        # The object was saved but no values were changed
+        if not old_values_that_changed:
+            return []
+
+        logs = []
+
+        # Create a new UPDATE MemberLog
+        # but only if the marked_for_deletion-value changed from T to F, or more values were changed
+        if old_values_that_changed.get('marked_for_deletion', True) or len(old_values_that_changed) > 1:
+            logs.append((MemberLog(user_id=user_id, member_id=member_id, log_type=log_type), [
+                MemberLogField(field=field, old_value=old_value, new_value=new_values[field])
+                for field, old_value in old_values_that_changed.items()
+                # Do not create a MemberLogField if marked_for_deletion has just changed to true or was just initialised
+                if field != 'marked_for_deletion' or old_value
+            ]))
+
+        # Create a special memberlog if a member got marked for deletion
+        # I.e. the old value for marked_for_deletion was False
+        if not old_values_that_changed.get('marked_for_deletion', True) and new_values.get('marked_for_deletion', False):
+            logs.append((MemberLog(user_id=user_id, member_id=member_id, log_type="DELETE"), []))
+
+        return logs
+
+    # Saves (MemberLog, [MemberLogField])-tuples (see get_logs_for_changes), using one bulk_create
+    # for all MemberLogs and one for all MemberLogFields. The logs are created in the given order
+    @staticmethod
+    def bulk_create_with_fields(logs):
+        if not logs:
+            return
+        with transaction.atomic():
+            memberlogs = MemberLog.objects.bulk_create([memberlog for memberlog, fields in logs])
+            if memberlogs[0].id is None:
+                # The database does not return the ids of bulk created rows (e.g. SQLite)
+                # The logs were just inserted in order, so they are the newest logs of their members
+                log_ids = MemberLog.objects.filter(member__id__in={memberlog.member_id for memberlog in memberlogs}) \
+                    .order_by('-id').values_list('id', flat=True)[:len(memberlogs)]
+                for memberlog, log_id in zip(memberlogs, reversed(list(log_ids))):
+                    memberlog.id = log_id
+
+            memberlogfields = []
+            for memberlog, fields in logs:
+                for memberlogfield in fields:
+                    memberlogfield.member_log = memberlog
+                    memberlogfields.append(memberlogfield)
+            MemberLogField.objects.bulk_create(memberlogfields)
+
     # String-representation of an instance of a MemberLog
     def __str__(self):
         return "[{3}] {1} updated {2}'s information ({0})".format(self.id, self.user, self.member, self.log_type)
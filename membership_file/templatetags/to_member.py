@@ -1,5 +1,5 @@
 from django import template
-from membership_file.util import user_to_member
+from membership_file.util import get_user_member, user_to_member
 
 register = template.Library()
 
@@ -10,4 +10,7 @@ register = template.Library()
 
 @register.filter
 def to_member(user):
+    # Look up the member on the user itself (e.g. request.user), so that this happens
+    # only once even if the filter is used multiple times (see also request.member)
+    get_user_member(user)
     return user_to_member(user)
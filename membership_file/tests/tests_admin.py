@@ -466,6 +466,39 @@ class DeleteMemberTest(TestCase):
         # The member should be deleted
         self.assertEqual(0, Member.objects.all().count())
         
+    # Tests if members can be (un)marked for deletion in bulk
+    def test_mark_for_deletion_action(self):
+        self.client.force_login(self.admin)
+        MemberLog.objects.all().delete()
+
+        response = self.client.post('/admin/membership_file/member/', data={
+            'action': 'mark_for_deletion',
+            '_selected_action': [self.member.id],
+        }, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        member = Member.objects.get(id=self.member.id)
+        self.assertTrue(member.marked_for_deletion)
+        self.assertEqual(member.last_updated_by, self.admin)
+        # Only a DELETE-log is created
+        self.assertListEqual(list(MemberLog.objects.values_list('log_type', 'user', 'member')),
+            [("DELETE", self.admin.id, self.member.id)])
+        self.assertIsNone(MemberLogField.objects.first())
+
+        # Another user unmarks the member again
+        self.client.force_login(self.admin2)
+        response = self.client.post('/admin/membership_file/member/', data={
+            'action': 'unmark_for_deletion',
+            '_selected_action': [self.member.id],
+        }, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Member.objects.get(id=self.member.id).marked_for_deletion)
+
+        memberlog = MemberLog.objects.get(log_type="UPDATE")
+        self.assertEqual(memberlog.user, self.admin2)
+        self.assertListEqual(list(MemberLogField.objects.filter(member_log=memberlog)
+            .values_list('field', 'old_value', 'new_value')), [('marked_for_deletion', 'True', 'False')])
+
     # Tests if a member cannot have its information updated if it is marked for deletion
     def test_update_member_when_marked_for_deletion(self):
         # Ensure the admin is logged in
@@ -2,11 +2,14 @@ from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.models import AnonymousUser
 from django.http import HttpResponse
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, Client
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 
 from core.models import ExtendedUser as User
 from membership_file.models import MemberUser
+from membership_file.middleware import MemberMiddleware
 from membership_file.util import membership_required, request_member
 
 
@@ -113,3 +116,49 @@ class RequestMemberDecoratorTest(TestCase):
             return HttpResponse()
 
         test_decorator(self, request_member, factory=self.factory, view=view)
+
+
+# Tests the middleware that provides request.member
+class MemberMiddlewareTest(TestCase):
+    fixtures = ['test_users.json', 'test_members.json']
+
+    def setUp(self):
+        self.member_user = User.objects.filter(username="test_user").first()
+        self.nonmember_user = User.objects.filter(username="test_user_alt").first()
+        self.factory = RequestFactory()
+
+    def get_request(self, user):
+        request = self.factory.get("/some_url")
+        request.user = user
+        MemberMiddleware(lambda request: HttpResponse())(request)
+        return request
+
+    # Tests if the member is only looked up once it is used, and only once
+    def test_lazy(self):
+        with self.assertNumQueries(0):
+            request = self.get_request(self.member_user)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(request.member.user_id, self.member_user.id)
+            self.assertTrue(request.member)
+
+            # The decorators reuse the member
+            test_decorator(self, membership_required, user=request.user, factory=self.factory)
+
+    def test_nonmember(self):
+        self.assertFalse(self.get_request(self.nonmember_user).member)
+        self.assertFalse(self.get_request(AnonymousUser()).member)
+
+    # Tests if membership is resolved only once when rendering membership pages
+    def test_num_member_queries(self):
+        client = Client()
+        client.force_login(self.member_user)
+
+        for url in ['/account', '/account/membership', '/account/membership/edit']:
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            member_queries = [query for query in context.captured_queries
+                if query['sql'].startswith('SELECT "membership_file_member"."id"')]
+            self.assertEqual(len(member_queries), 1, msg=url)
@@ -1,4 +1,8 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from core.models import UserDisplayName
 
 from membership_file.models import Member, get_member_display_name, MemberLog, MemberLogField
 from membership_file.models import MemberUser as User
@@ -26,6 +30,44 @@ class MemberModelTest(TestCase):
         display_str = get_member_display_name(user)
         self.assertEqual(display_str, user.get_simple_display_name())
 
+    # Tests if the stored display names follow changes of members
+    def test_member_stored_display_name(self):
+        member = Member.objects.filter(user__username="test_user").first()
+        user = User.objects.get(id=member.user_id)
+        other_user = User.objects.filter(username="test_user_alt").first()
+
+        member.first_name = "Charlie"
+        member.save()
+        self.assertEqual(UserDisplayName.get_for_users([user.id])[user.id], member.get_full_name())
+
+        # Linked to another user
+        member.user = other_user
+        member.save()
+        self.assertDictEqual(UserDisplayName.get_for_users([user.id, other_user.id]), {
+            user.id: user.get_simple_display_name(),
+            other_user.id: member.get_full_name(),
+        })
+
+        member.delete()
+        self.assertEqual(UserDisplayName.get_for_users([other_user.id])[other_user.id],
+            other_user.get_simple_display_name())
+
+    # Tests if the display names of many users are resolved and stored at once
+    def test_update_stored_display_names(self):
+        user_ids = list(User.objects.values_list('id', flat=True))
+        UserDisplayName.update_for_users(user_ids)
+
+        # One of the names is outdated, and another is missing
+        member = Member.objects.filter(user__username="test_user").first()
+        Member.objects.filter(id=member.id).update(first_name="Charles")
+        UserDisplayName.objects.filter(user__id__in=set(user_ids) - {member.user_id}).first().delete()
+
+        # Users, their members, SAVEPOINT, stored names, UPDATE, INSERT, RELEASE SAVEPOINT
+        with self.assertNumQueries(7):
+            display_names = UserDisplayName.update_for_users(user_ids)
+        self.assertEqual(display_names[member.user_id], "Charles van der Dommel")
+        self.assertDictEqual(dict(UserDisplayName.objects.values_list('user_id', 'display_name')), display_names)
+
     # Tests the display method of the MemberLog
     def test_memberlog_display(self):
         memberlog = MemberLog(id=1, user=User.objects.first(), member=Member.objects.first(), log_type="UPDATE")
@@ -35,3 +77,111 @@ class MemberModelTest(TestCase):
     def test_memberlogfield_display(self):
         memberlogfield = MemberLogField(id=2, field="name", old_value="Bob", new_value="Charlie")
         self.assertEqual(str(memberlogfield), f"name was updated: <Bob> -> <Charlie> (2)")
+
+
+# Tests the MemberLogs that are created when members change
+class MemberChangeLogTest(TestCase):
+    fixtures = ['test_users.json', 'test_members.json']
+
+    def setUp(self):
+        self.member = Member.objects.get(id=1)
+
+    # Tests if changes are logged without looking up the member again
+    def test_update_queries(self):
+        self.member.first_name = "Bob"
+        self.member.city = "Utrecht"
+        with CaptureQueriesContext(connection) as context:
+            self.member.save()
+
+        member_queries = [query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and 'WHERE "membership_file_member"."id"' in query['sql']]
+        self.assertListEqual(member_queries, [])
+        # All fields are inserted at once
+        field_inserts = [query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('INSERT INTO "membership_file_memberlogfield"')]
+        self.assertEqual(len(field_inserts), 1)
+
+        memberlog = MemberLog.objects.get(member=self.member, log_type="UPDATE")
+        self.assertSetEqual(set(MemberLogField.objects.filter(member_log=memberlog)
+            .values_list('field', 'new_value')), {('first_name', "Bob"), ('city', "Utrecht")})
+
+        # Saving again without changes does not create another log
+        self.member.save()
+        self.assertEqual(MemberLog.objects.count(), 1)
+
+    # Tests if changes to members that were not loaded from the database are logged too
+    def test_update_unloaded_member(self):
+        member = Member(**{field.attname: getattr(self.member, field.attname) for field in Member._meta.concrete_fields})
+        member.first_name = "Bob"
+        member.save()
+        self.assertTrue(MemberLogField.objects.filter(field='first_name',
+            old_value=self.member.first_name, new_value="Bob").exists())
+        self.assertEqual(MemberLogField.objects.count(), 1)
+
+    # Tests if only the given fields are compared if specific fields are saved
+    def test_update_fields(self):
+        self.member.first_name = "Bob"
+        self.member.city = "Utrecht"
+        self.member.save(update_fields=['city'])
+        self.assertListEqual(list(MemberLogField.objects.values_list('field', flat=True)), ['city'])
+
+    # Tests if deleting a member only deletes its own logs
+    def test_delete_member_logs(self):
+        other_log = MemberLog.objects.create(member=None, log_type="UPDATE")
+        self.member.first_name = "Bob"
+        self.member.save()
+
+        self.member.delete()
+        self.assertListEqual(list(MemberLog.objects.all()), [other_log])
+        self.assertFalse(MemberLogField.objects.exists())
+
+    # Obtains the logs of the given member, without their ids
+    def get_logs(self, member):
+        return [(memberlog.log_type, memberlog.user_id, sorted(memberlog.updated_in_member_log
+                .values_list('field', 'old_value', 'new_value')))
+            for memberlog in MemberLog.objects.filter(member=member).order_by('id')]
+
+    # Tests if updating members in bulk creates the same logs as saving them separately
+    def test_update_with_log(self):
+        user = User.objects.get(username="test_user_alt")
+        old_values = self.member.get_field_values()
+
+        self.member.educational_institution = "Fontys"
+        self.member.marked_for_deletion = True
+        self.member.last_updated_by = user
+        self.member.save()
+        saved_logs = self.get_logs(self.member)
+        self.assertListEqual([log_type for log_type, user_id, fields in saved_logs], ["UPDATE", "DELETE"])
+
+        # Revert the changes without logging them
+        MemberLog.objects.all().delete()
+        Member.objects.filter(id=self.member.id).update(educational_institution=old_values['educational_institution'],
+            marked_for_deletion=False)
+
+        with CaptureQueriesContext(connection) as context:
+            num_updated = Member.objects.all().update_with_log(user, educational_institution="Fontys", marked_for_deletion=True)
+        self.assertEqual(num_updated, 2)
+        self.assertListEqual(self.get_logs(self.member), saved_logs)
+
+        # A single update, and a single insert for all logs and for all their fields
+        queries = [' '.join(query['sql'].split(' ')[:3])
+            for query in context.captured_queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertListEqual(queries, ['UPDATE "membership_file_member" SET',
+            'INSERT INTO "membership_file_memberlog"', 'INSERT INTO "membership_file_memberlogfield"'])
+
+        member = Member.objects.get(id=self.member.id)
+        self.assertEqual(member.educational_institution, "Fontys")
+        self.assertEqual(member.last_updated_by_id, user.id)
+
+    # Tests if unchanged members are not logged, and display names are updated
+    def test_update_with_log_unchanged(self):
+        Member.objects.filter(id=self.member.id).update_with_log(None, first_name=self.member.first_name)
+        self.assertFalse(MemberLog.objects.exists())
+
+        # The previously stored name is replaced
+        UserDisplayName.update_for_users([self.member.user_id])
+        Member.objects.filter(id=self.member.id).update_with_log(None, first_name="Bob")
+        self.assertEqual(UserDisplayName.objects.get(user__id=self.member.user_id).display_name, "Bob van der Dommel")
+
+        with self.assertRaises(ValueError):
+            Member.objects.update_with_log(None, last_updated_by=None)
@@ -7,13 +7,32 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import resolve_url
 from functools import wraps
 
+from core.util import cast_to_proxy
+
 def user_to_member(user):
     """
     Transforms a User to a MemberUser with the same data
+    (including the member, if it was already looked up)
+    """
+    return cast_to_proxy(user, MemberUser)
+
+def get_user_member(user):
+    """
+    Returns the member linked to the given user (or None if there is no such member).
+    The member is looked up at most once per user object, and remembered on that object
+    """
+    if not user.is_authenticated:
+        return None
+    if not hasattr(user, '_cached_member'):
+        user._cached_member = Member.objects.filter(user__id=user.id).first()
+    return user._cached_member
+
+def get_request_member(request):
+    """
+    Returns the member linked to the user that made the request (or None if there is no such member).
+    Membership is resolved at most once per request (see MemberMiddleware)
     """
-    # Copy over all old information
-    attrs = {field.name: getattr(user, field.name) for field in user._meta.fields}
-    return MemberUser(**attrs)
+    return get_user_member(request.user)
 
 def request_member(function=None):
     """
@@ -23,7 +42,8 @@ def request_member(function=None):
         @wraps(view_func)
         def _wrapped_view(request, *args, **kwargs):
             if request.user.is_authenticated:
-                # Override request.user with a MemberUser with the same data
+                # Override request.user with a MemberUser with the same data (and the same member)
+                get_request_member(request)
                 request.user = user_to_member(request.user)
             return view_func(request, *args, **kwargs)
         return _wrapped_view
@@ -45,7 +65,7 @@ def membership_required(function=None, fail_url=None, redirect_field_name=REDIRE
         def _wrapped_view(request, *args, **kwargs):
 
             # If the user is authenticated and a member with the same userID exists, continue
-            if request.user.is_authenticated and MemberUser(request.user.id).is_member():
+            if get_request_member(request) is not None:
                 return view_func(request, *args, **kwargs)
             
             # Otherwise show the "Not a member" error page
@@ -11,7 +11,7 @@ from django.views.decorators.http import require_safe
 from .models import MemberUser as User
 from .models import Member, MemberLog
 from .forms import MemberForm
-from .util import membership_required, request_member
+from .util import get_request_member, membership_required, request_member
 
 from core.views import TemplateManager
 
@@ -34,7 +34,7 @@ def viewNoMember(request):
 @membership_required
 @request_member
 def viewOwnMembership(request):
-    tData = {'member': request.user.get_member()}
+    tData = {'member': get_request_member(request)}
     return render(request, 'membership_file/view_member.html', tData)
 
 
@@ -42,7 +42,7 @@ def viewOwnMembership(request):
 @membership_required
 @request_member
 def editOwnMembership(request):
-    member = request.user.get_member()
+    member = get_request_member(request)
 
     # Prevent access if the user is not authenticated, or if there was no membership
     # information linked to the user. I.e. the reuqest was forged!
@@ -69,6 +69,6 @@ def editOwnMembership(request):
 
     # if a GET (or any other method) we'll create a blank form
     else:
-        form = MemberForm(instance=request.user.get_member())
+        form = MemberForm(instance=member)
 
     return render(request, 'membership_file/edit_member.html', {'form': form})
@@ -10,7 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
+import datetime
 import os
+
+from django.core.exceptions import ImproperlyConfigured
+
 from . import util
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -67,6 +71,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'membership_file.middleware.MemberMiddleware', #Provides the requesting user's membership as request.member
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -104,6 +109,29 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# The cache must be shared by all worker processes (e.g. of gunicorn), as the activity calendar stores the
+# versions of its data in it to invalidate cached feeds and to notice changes made by other processes.
+# Hence production uses memcached (at MEMCACHED_LOCATION, e.g. 127.0.0.1:11211). A per-process cache
+# (Django's default LocMemCache) is only used during development, where runserver uses a single process
+
+if os.getenv('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.getenv('MEMCACHED_LOCATION'),
+        }
+    }
+elif not DEBUG: # pragma: no cover
+    raise ImproperlyConfigured("MEMCACHED_LOCATION must be set in production (see CACHES)")
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -238,6 +266,41 @@ LOGOUT_REDIRECT_URL = '/logout/success'
 # when the membership_required-decorator does not receive a fail_url parameter
 MEMBERSHIP_FAIL_URL = '/no_member'
 
+####################################################################
+# Activity Calendar Settings
+
+# Not a native Django setting, but used to specify how far ahead occurrences of recurring
+# activities are stored in the database. Run `python manage.py index_occurrences` periodically
+# to move this horizon forward
+ACTIVITY_OCCURRENCE_HORIZON = datetime.timedelta(days=365)
+
+# Not a native Django setting, but used to specify the number of recurring activities whose
+# occurrences are kept in memory (per process) for fast occurrence lookups
+ACTIVITY_RECURRENCE_CACHE_SIZE = 256
+
+# Not a native Django setting, but used to specify how long (in seconds) the calendar feed may be cached.
+# Cached feeds are invalidated automatically whenever an activity, slot or participant changes,
+# so this only bounds how long it takes for newly published activities to show up
+ACTIVITY_CALENDAR_CACHE_TIMEOUT = 5 * 60
+
+# Not a native Django setting, but used to specify the size of the timeframes in which the occurrence
+# stream (/api/calendar/occurrences) expands activities. Only a single such timeframe is kept in memory
+ACTIVITY_OCCURRENCE_STREAM_CHUNK = datetime.timedelta(days=28)
+
+# Not a native Django setting, but used to limit the timeframes that can be requested from the occurrence
+# stream at once: the number of ranges, and the total time they span (after merging overlapping ranges)
+ACTIVITY_OCCURRENCE_STREAM_MAX_RANGES = 12
+ACTIVITY_OCCURRENCE_STREAM_MAX_SPAN = datetime.timedelta(days=2 * 366)
+
+# Not a native Django setting, but used to specify how often (in seconds) the slot page checks for live
+# slot updates (Server-Sent Events). Each check is answered at once, after which the browser reconnects
+ACTIVITY_SLOT_EVENTS_INTERVAL = 2
+
+# Not a native Django setting, but used to specify for how many upcoming occurrences slots are created in
+# advance (for activities that create their slots automatically) when using the "Create slots for upcoming
+# occurrences" admin action, or `python manage.py create_auto_slots`
+ACTIVITY_AUTO_SLOTS_OCCURRENCES = 8
+
 ####################################################################
 # Other Settings
 # Non-native Django setting